@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+Async load harness for the Credit Card Token Management API
+Drives the FastAPI app in-process through httpx's ASGI transport (default)
+or a running server (--url) with a fixed number of concurrent virtual users,
+each picking scenarios from a weighted mix. Reports p50/p95/p99 latency,
+requests/s and error rate per route, optionally as JSON (--json) so runs
+can be diffed.
+
+Run from backend/:
+    python benchmarks/load_harness.py --concurrency 50 --duration 15
+    python benchmarks/load_harness.py --url http://localhost:8001 \
+        --mix list_tokens=5,provision=1,paginate_transactions=3 --json run.json
+
+In-process runs start the app's lifespan, so MONGO_URL must be reachable.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+LOAD_CARD = "loadtest_card"
+ALL_MERCHANT_APP_IDS = [1, 2, 3, 4, 5, 6, 7]
+
+
+class Recorder:
+    """
+    Latency samples and outcomes per route label
+    """
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.status_codes: Dict[str, Dict[int, int]] = defaultdict(lambda: defaultdict(int))
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    async def request(self, client: httpx.AsyncClient, route: str, method: str, url: str, **kwargs) -> Optional[httpx.Response]:
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            self.latencies[route].append(time.perf_counter() - start)
+            self.errors[route] += 1
+            return None
+        self.latencies[route].append(time.perf_counter() - start)
+        self.status_codes[route][response.status_code] += 1
+        if response.status_code >= 400:
+            self.errors[route] += 1
+        return response
+
+    def report(self, elapsed: float) -> Dict[str, Dict]:
+        routes = {}
+        for route, samples in sorted(self.latencies.items()):
+            ordered = sorted(samples)
+            routes[route] = {
+                "requests": len(ordered),
+                "requests_per_second": len(ordered) / elapsed,
+                "error_rate": self.errors[route] / len(ordered),
+                "status_codes": {str(code): count for code, count in sorted(self.status_codes[route].items())},
+                "latency_ms": {
+                    "p50": percentile(ordered, 50) * 1000,
+                    "p95": percentile(ordered, 95) * 1000,
+                    "p99": percentile(ordered, 99) * 1000,
+                    "max": ordered[-1] * 1000,
+                    "mean": sum(ordered) / len(ordered) * 1000,
+                },
+            }
+        return routes
+
+
+def percentile(ordered: List[float], pct: float) -> float:
+    """
+    Nearest-rank percentile of an already sorted sample
+    """
+    if not ordered:
+        return 0.0
+    rank = max(1, int(round(pct / 100 * len(ordered))))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+# Scenarios: each is one user action and may issue several requests
+
+async def list_tokens(client, recorder, args):
+    await recorder.request(client, "GET /api/tokens", "GET", "/api/tokens", params={"card_identifier": LOAD_CARD})
+
+
+async def token_detail(client, recorder, args):
+    response = await recorder.request(
+        client, "GET /api/tokens", "GET", "/api/tokens", params={"card_identifier": LOAD_CARD, "limit": 1}
+    )
+    if response is not None and response.status_code == 200 and response.json()["tokens"]:
+        token_id = response.json()["tokens"][0]["token_reference_id"]
+        await recorder.request(client, "GET /api/tokens/{id}", "GET", f"/api/tokens/{token_id}")
+
+
+async def provision(client, recorder, args):
+    await recorder.request(
+        client, "POST /api/push-provisioning", "POST", "/api/push-provisioning",
+        json={"merchant_app_ids": ALL_MERCHANT_APP_IDS[:args.merchants], "card_identifier": LOAD_CARD}
+    )
+
+
+async def paginate_transactions(client, recorder, args):
+    params = {"limit": args.page_size}
+    for _ in range(args.pages):
+        response = await recorder.request(
+            client, "GET /api/cards/transactions", "GET", "/api/cards/transactions", params=params
+        )
+        if response is None or response.status_code != 200 or not response.json().get("next_cursor"):
+            return
+        params = {"limit": args.page_size, "after": response.json()["next_cursor"]}
+
+
+async def merchants(client, recorder, args):
+    await recorder.request(client, "GET /api/push-provisioning/merchants", "GET", "/api/push-provisioning/merchants")
+
+
+async def card_details(client, recorder, args):
+    await recorder.request(client, "GET /api/cards/details", "GET", "/api/cards/details")
+
+
+SCENARIOS: Dict[str, Callable[..., Awaitable[None]]] = {
+    "list_tokens": list_tokens,
+    "token_detail": token_detail,
+    "provision": provision,
+    "paginate_transactions": paginate_transactions,
+    "merchants": merchants,
+    "card_details": card_details,
+}
+
+
+def parse_mix(value: str) -> Dict[str, int]:
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"Unknown scenario '{name}' (choose from {', '.join(SCENARIOS)})")
+        mix[name] = int(weight or 1)
+    return mix
+
+
+async def run_users(client: httpx.AsyncClient, args) -> Dict:
+    recorder = Recorder()
+    names = list(args.mix)
+    weights = [args.mix[name] for name in names]
+    deadline = time.perf_counter() + args.duration
+    remaining = [args.requests] if args.requests else None
+
+    # Seed some tokens so list/detail scenarios have data to read
+    await provision(client, Recorder(), args)
+
+    async def _user(index: int):
+        rng = random.Random(args.seed + index)
+        while time.perf_counter() < deadline:
+            if remaining is not None:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            scenario = SCENARIOS[rng.choices(names, weights)[0]]
+            await scenario(client, recorder, args)
+
+    started_at = datetime.utcnow()
+    started = time.perf_counter()
+    await asyncio.gather(*(_user(index) for index in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+
+    routes = recorder.report(elapsed)
+    total_requests = sum(route["requests"] for route in routes.values())
+    total_errors = sum(recorder.errors.values())
+    return {
+        "started_at": started_at.isoformat(),
+        "target": args.url or "in-process",
+        "config": {
+            "concurrency": args.concurrency,
+            "duration_seconds": args.duration,
+            "max_scenarios": args.requests,
+            "mix": args.mix,
+            "merchants": args.merchants,
+            "pages": args.pages,
+            "page_size": args.page_size,
+            "seed": args.seed,
+        },
+        "elapsed_seconds": elapsed,
+        "totals": {
+            "requests": total_requests,
+            "requests_per_second": total_requests / elapsed if elapsed else 0.0,
+            "error_rate": total_errors / total_requests if total_requests else 0.0,
+        },
+        "routes": routes,
+    }
+
+
+async def run(args) -> Dict:
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    timeout = httpx.Timeout(args.timeout)
+
+    if args.url:
+        async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=timeout) as client:
+            return await run_users(client, args)
+
+    from server import app
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=timeout) as client:
+            return await run_users(client, args)
+
+
+def print_report(result: Dict) -> None:
+    print(f"\nTarget: {result['target']}  elapsed: {result['elapsed_seconds']:.1f}s  "
+          f"concurrency: {result['config']['concurrency']}")
+    print(f"{'route':<38} {'reqs':>7} {'req/s':>9} {'err%':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for route, stats in result["routes"].items():
+        latency = stats["latency_ms"]
+        print(f"{route:<38} {stats['requests']:>7} {stats['requests_per_second']:>9.1f} "
+              f"{stats['error_rate'] * 100:>6.2f} {latency['p50']:>8.2f} {latency['p95']:>8.2f} {latency['p99']:>8.2f}")
+    totals = result["totals"]
+    print(f"{'TOTAL':<38} {totals['requests']:>7} {totals['requests_per_second']:>9.1f} {totals['error_rate'] * 100:>6.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="Base URL of a running server (default: drive the app in-process)")
+    parser.add_argument("--concurrency", type=int, default=20, help="Concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds to run")
+    parser.add_argument("--requests", type=int, default=0, help="Stop after this many scenarios (0 = duration only)")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("list_tokens=4,paginate_transactions=3,token_detail=2,provision=1"),
+                        help="Weighted scenarios, e.g. list_tokens=5,provision=1")
+    parser.add_argument("--merchants", type=int, default=3, choices=range(1, len(ALL_MERCHANT_APP_IDS) + 1),
+                        help="Merchants per provisioning request")
+    parser.add_argument("--pages", type=int, default=3, help="Transaction pages followed per scenario")
+    parser.add_argument("--page-size", type=int, default=10)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", dest="json_path", help="Write the machine-readable report here")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    print_report(result)
+
+    if args.json_path:
+        Path(args.json_path).write_text(json.dumps(result, indent=2))
+        print(f"\nReport written to {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Serialization micro-benchmark
+Compares the default FastAPI response path (build validated models, re-validate
+against response_model, jsonable_encoder, json.dumps) with FastJSONResponse
+(stored rows encoded as plain data, models through their compiled
+pydantic-core serializer) for the payload shapes our endpoints return.
+
+Run from backend/:  python benchmarks/serialization_bench.py [--iterations N]
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from models.token_models import (
+    PushProvisioningResponse, PushProvisioningResult, TokenInfo, TokenListResponse,
+    TokenStatus, Transaction, TransactionListResponse
+)
+from services.serialization import FastJSONResponse
+
+
+def token_rows(count):
+    now = datetime.utcnow()
+    return [
+        {
+            "token_reference_id": f"TKN_{uuid.uuid4().hex[:8].upper()}",
+            "merchant_id": f"VISA_MERCHANT_{i % 7:03d}",
+            "merchant_name": "Merchant",
+            "token_status": "ACTIVE" if i % 2 else "INACTIVE",
+            "created_timestamp": now - timedelta(days=i),
+            "last_used_timestamp": now if i % 3 else None,
+            "token_expiry_date": "202912",
+        }
+        for i in range(count)
+    ]
+
+
+def transaction_rows(count):
+    return [
+        {
+            "id": f"TXN_{i:06d}",
+            "merchant": "Uber",
+            "amount": 100 + i,
+            "date": "2024-01-15",
+            "type": "ride",
+            "status": "completed",
+            "token_used": bool(i % 2),
+            "token_reference_id": "TKN_UBER_001" if i % 2 else None,
+        }
+        for i in range(count)
+    ]
+
+
+def provisioning_results(count):
+    now = datetime.utcnow()
+    return [
+        PushProvisioningResult(
+            merchant_id=f"VISA_MERCHANT_{i:03d}",
+            merchant_name="Merchant",
+            token_reference_id=f"TKN_{uuid.uuid4().hex[:8].upper()}",
+            token_status=TokenStatus.ACTIVE,
+            provisioning_result="SUCCESS",
+            token_expiry_date="202912",
+            created_timestamp=now,
+            last_updated_timestamp=now,
+        )
+        for i in range(count)
+    ]
+
+
+def scenarios():
+    tokens = token_rows(200)
+    transactions = transaction_rows(100)
+    results = provisioning_results(7)
+    now = datetime.utcnow()
+
+    return [
+        (
+            "GET /api/tokens (200 tokens)",
+            TokenListResponse,
+            lambda: TokenListResponse(
+                tokens=[TokenInfo(**row) for row in tokens],
+                total_count=len(tokens), response_timestamp=now
+            ),
+            lambda: {
+                "tokens": tokens, "total_count": len(tokens),
+                "response_timestamp": now, "next_cursor": None
+            },
+        ),
+        (
+            "GET /api/cards/transactions (100 rows)",
+            TransactionListResponse,
+            lambda: TransactionListResponse(
+                transactions=[Transaction(**row) for row in transactions],
+                total_count=len(transactions), response_timestamp=now
+            ),
+            lambda: {
+                "transactions": transactions, "total_count": len(transactions),
+                "response_timestamp": now, "next_cursor": None
+            },
+        ),
+        (
+            "POST /api/push-provisioning (7 merchants)",
+            PushProvisioningResponse,
+            lambda: PushProvisioningResponse(
+                request_id="REQ", status="ACCEPTED", timestamp=now, push_provisioning_results=results
+            ),
+            lambda: PushProvisioningResponse(
+                request_id="REQ", status="ACCEPTED", timestamp=now, push_provisioning_results=results
+            ),
+        ),
+        (
+            "GET /api/cards/transactions/{id}",
+            Transaction,
+            lambda: Transaction(**transactions[0]),
+            lambda: transactions[0],
+        ),
+    ]
+
+
+async def fastapi_path(field, build):
+    content = await serialize_response(field=field, response_content=build())
+    return JSONResponse(content).body
+
+
+def fast_path(build):
+    return FastJSONResponse(build()).body
+
+
+async def measure(iterations):
+    rows = []
+    for name, model, build_default, build_fast in scenarios():
+        field = create_response_field(name=f"Response_{model.__name__}", type_=model)
+
+        # Warm up and sanity-check that both paths encode the same data
+        assert json.loads(await fastapi_path(field, build_default)) == json.loads(fast_path(build_fast)), name
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            await fastapi_path(field, build_default)
+        default_us = (time.perf_counter() - start) / iterations * 1e6
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            fast_path(build_fast)
+        fast_us = (time.perf_counter() - start) / iterations * 1e6
+
+        rows.append((name, default_us, fast_us))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    rows = asyncio.run(measure(args.iterations))
+
+    print(f"{'endpoint':<45} {'fastapi (us)':>14} {'fast (us)':>12} {'speedup':>9}")
+    for name, default_us, fast_us in rows:
+        print(f"{name:<45} {default_us:>14.1f} {fast_us:>12.1f} {default_us / fast_us:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Transaction snapshot builder
+Writes a columnar, memory-mapped snapshot of the transaction history (all
+partitions) into TRANSACTION_SNAPSHOT_DIR and points CURRENT at it.
+Running servers pick it up within TRANSACTION_SNAPSHOT_REFRESH_SECONDS and
+read only the rows recorded since its watermark from MongoDB. Reads the
+same backend/.env as the server; run it periodically (e.g. from cron).
+
+Run from backend/:
+    python build_transaction_snapshot.py
+    python build_transaction_snapshot.py --dir /var/lib/cards/snapshots --keep 3
+"""
+
+import argparse
+import asyncio
+import os
+
+import server
+from services.config import env_str
+from services.transaction_repository import transaction_repository
+from services.transaction_snapshot import build_snapshot
+
+
+async def build(directory: str, margin_seconds: float, batch_size: int, keep: int) -> None:
+    client = server.create_mongo_client()
+    db = client[os.environ.get('DB_NAME', 'credit_card_tokens')]
+    partitions = server.create_partition_router(db, server.create_mongo_client)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        path = await build_snapshot(
+            partitions, transaction_repository.collection_name, directory,
+            margin_seconds=margin_seconds, batch_size=batch_size, keep=keep
+        )
+        print(f"Snapshot written to {path}")
+    finally:
+        partitions.close()
+        client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dir", default=env_str("TRANSACTION_SNAPSHOT_DIR"),
+                        help="Snapshot root (default: TRANSACTION_SNAPSHOT_DIR)")
+    parser.add_argument("--margin", type=float, default=60.0,
+                        help="Seconds before now to place the watermark, covering writes still in flight")
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument("--keep", type=int, default=2, help="Snapshots to keep, including the new one")
+    args = parser.parse_args()
+    if not args.dir:
+        parser.error("--dir or TRANSACTION_SNAPSHOT_DIR is required")
+    asyncio.run(build(args.dir, args.margin, args.batch_size, args.keep))
+
+
+if __name__ == "__main__":
+    main()
@@ -29,10 +29,10 @@ class PushProvisioningRequest(BaseModel):
 class PushProvisioningResult(BaseModel):
     merchant_id: str
     merchant_name: str
-    token_reference_id: str
+    token_reference_id: Optional[str] = None  # None when provisioning FAILED or is still PENDING
     token_status: TokenStatus
     provisioning_result: ProvisioningStatus
-    token_expiry_date: str
+    token_expiry_date: Optional[str] = None
     created_timestamp: datetime
     last_updated_timestamp: datetime
 
@@ -44,6 +44,16 @@ class PushProvisioningResponse(BaseModel):
     push_provisioning_results: List[PushProvisioningResult]
 
 
+class PushProvisioningJobStatus(BaseModel):
+    request_id: str
+    status: str  # QUEUED, IN_PROGRESS, COMPLETED, PARTIAL or FAILED
+    timestamp: datetime
+    message: str
+    merchant_count: int
+    completed_count: int
+    push_provisioning_results: List[PushProvisioningResult]
+
+
 class TokenInfo(BaseModel):
     token_reference_id: str
     merchant_id: str
@@ -58,6 +68,7 @@ class TokenListResponse(BaseModel):
     tokens: List[TokenInfo]
     total_count: int
     response_timestamp: datetime
+    next_cursor: Optional[str] = None
 
 
 class TokenUpdateRequest(BaseModel):
@@ -71,6 +82,30 @@ class TokenUpdateResponse(BaseModel):
     update_result: str
 
 
+class TokenBatchItem(BaseModel):
+    token_reference_id: str
+    token_status: TokenStatus  # DELETED deletes the token
+
+
+class TokenBatchRequest(BaseModel):
+    updates: List[TokenBatchItem] = Field(..., min_length=1, max_length=500)
+
+
+class TokenBatchItemResult(BaseModel):
+    token_reference_id: str
+    token_status: Optional[TokenStatus] = None
+    last_updated_timestamp: Optional[datetime] = None
+    update_result: str  # SUCCESS or FAILED
+    error: Optional[str] = None
+
+
+class TokenBatchResponse(BaseModel):
+    results: List[TokenBatchItemResult]
+    success_count: int
+    failure_count: int
+    response_timestamp: datetime
+
+
 class CardDetails(BaseModel):
     card_number: str
     card_holder_name: str
@@ -84,6 +119,17 @@ class CardDetails(BaseModel):
 
 
 class Transaction(BaseModel):
+    id: str
+    merchant: Optional[str] = None  # missing on some historical rows
+    amount: int
+    date: str
+    type: Optional[str] = None
+    status: Optional[str] = None
+    token_used: bool = False
+    token_reference_id: Optional[str] = None
+
+
+class TransactionRecord(BaseModel):
     id: str
     merchant: str
     amount: int
@@ -94,7 +140,37 @@ class Transaction(BaseModel):
     token_reference_id: Optional[str] = None
 
 
+class TransactionRecordRequest(BaseModel):
+    card_identifier: str = "default_card"
+    transactions: List[TransactionRecord] = Field(..., min_length=1, max_length=500)
+
+
+class TransactionRecordResponse(BaseModel):
+    card_identifier: str
+    recorded_count: int  # transactions whose id was already stored are skipped
+    total_count: int
+    response_timestamp: datetime
+
+
 class TransactionListResponse(BaseModel):
     transactions: List[Transaction]
-    total_count: int
-    response_timestamp: datetime
\ No newline at end of file
+    total_count: int  # all transactions on the card, regardless of filters
+    response_timestamp: datetime
+    next_cursor: Optional[str] = None
+
+
+class SpendBucket(BaseModel):
+    key: str
+    total_amount: int
+    transaction_count: int
+
+
+class SpendAnalyticsResponse(BaseModel):
+    card_identifier: str
+    total_amount: int
+    transaction_count: int
+    by_merchant: List[SpendBucket]  # highest spend first
+    by_type: List[SpendBucket]  # highest spend first
+    by_month: List[SpendBucket]  # YYYY-MM, oldest first
+    by_token_used: List[SpendBucket]  # "true" / "false"
+    response_timestamp: datetime
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Partition rebalancer
+After adding or removing a partition in MONGO_PARTITIONS, moves every
+token and transaction to the partition that now owns its card_identifier
+and rebuilds the moved cards' counters there. Reads the same backend/.env
+as the server. It is safe to interrupt and run again.
+
+Run from backend/ with the new MONGO_PARTITIONS in place:
+    python rebalance_partitions.py
+    python rebalance_partitions.py --batch-size 1000
+"""
+
+import argparse
+import asyncio
+import os
+
+import server
+from services.token_repository import token_repository
+from services.transaction_repository import transaction_repository
+
+
+async def rebalance(batch_size: int) -> None:
+    client = server.create_mongo_client()
+    db = client[os.environ.get('DB_NAME', 'credit_card_tokens')]
+    partitions = server.create_partition_router(db, server.create_mongo_client)
+    try:
+        # init creates the indexes on any partition that is new
+        await token_repository.init(db, partitions)
+        await transaction_repository.init(db, partitions)
+        print(f"Partitions: {', '.join(partitions.names)}")
+        print(f"tokens moved: {await token_repository.rebalance(batch_size=batch_size)}")
+        print(f"transactions moved: {await transaction_repository.rebalance(batch_size=batch_size)}")
+    finally:
+        partitions.close()
+        client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=500, help="Documents copied per insert_many")
+    args = parser.parse_args()
+    asyncio.run(rebalance(args.batch_size))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,68 +2,147 @@
 Card management API endpoints
 """
 
-from fastapi import APIRouter, HTTPException
-from typing import List
-from models.token_models import CardDetails, Transaction, TransactionListResponse
-from services.mock_data import MOCK_CARD_DATA, MOCK_TRANSACTIONS
-from datetime import datetime
+from fastapi import APIRouter, HTTPException, Query, Request
+from typing import List, Optional
+from models.token_models import (
+    CardDetails, SpendAnalyticsResponse, Transaction, TransactionListResponse,
+    TransactionRecordRequest, TransactionRecordResponse
+)
+from services.mock_data import MOCK_CARD_DATA
+from services.transaction_repository import transaction_repository
+from services.serialization import FastJSONResponse
+from services.http_cache import Representation, RepresentationCache, conditional_response
+from services.config import env_str
+from datetime import date, datetime
 
 router = APIRouter(prefix="/api/cards", tags=["cards"])
 
+# Card details are per user: only the browser may cache them, and it must
+# revalidate each time (answered with a 304 while unchanged)
+CARD_DETAILS_CACHE_CONTROL = env_str("CARD_DETAILS_CACHE_CONTROL", "private, no-cache")
+
+card_details_cache = RepresentationCache()
+
 
 @router.get("/details", response_model=CardDetails)
-async def get_card_details():
+async def get_card_details(request: Request):
     """
     Get credit card details for the logged-in user
+    Sent with an ETag; If-None-Match with the current one returns 304.
     """
     try:
-        # Convert camelCase keys to snake_case for Pydantic model
-        card_data = {
-            "card_number": MOCK_CARD_DATA["cardNumber"],
-            "card_holder_name": MOCK_CARD_DATA["cardHolderName"],
-            "expiry_date": MOCK_CARD_DATA["expiryDate"],
-            "cvv": MOCK_CARD_DATA["cvv"],
-            "card_type": MOCK_CARD_DATA["cardType"],
-            "available_limit": MOCK_CARD_DATA["availableLimit"],
-            "total_outstanding": MOCK_CARD_DATA["totalOutstanding"],
-            "next_statement_date": MOCK_CARD_DATA["nextStatementDate"],
-            "unspent_amount": MOCK_CARD_DATA["unspentAmount"]
-        }
-        return CardDetails(**card_data)
+        # Rebuilt only when the card data itself changes
+        representation = card_details_cache.get(tuple(MOCK_CARD_DATA.items()), _build_card_details)
+        return conditional_response(request, representation, CARD_DETAILS_CACHE_CONTROL)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch card details: {str(e)}")
 
 
+def _build_card_details() -> Representation:
+    # Convert camelCase keys to snake_case for Pydantic model
+    card_data = {
+        "card_number": MOCK_CARD_DATA["cardNumber"],
+        "card_holder_name": MOCK_CARD_DATA["cardHolderName"],
+        "expiry_date": MOCK_CARD_DATA["expiryDate"],
+        "cvv": MOCK_CARD_DATA["cvv"],
+        "card_type": MOCK_CARD_DATA["cardType"],
+        "available_limit": MOCK_CARD_DATA["availableLimit"],
+        "total_outstanding": MOCK_CARD_DATA["totalOutstanding"],
+        "next_statement_date": MOCK_CARD_DATA["nextStatementDate"],
+        "unspent_amount": MOCK_CARD_DATA["unspentAmount"]
+    }
+    return Representation(CardDetails(**card_data), tag="card")
+
+
 @router.get("/transactions", response_model=TransactionListResponse)
-async def get_transaction_history(limit: int = 10, offset: int = 0):
+async def get_transaction_history(
+    card_identifier: str = "default_card",
+    limit: int = Query(10, ge=1, le=100),
+    after: Optional[str] = Query(None, description="next_cursor from the previous page"),
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    merchant: Optional[str] = None,
+    token_used: Optional[bool] = None
+):
     """
-    Get transaction history for the user's card
+    Get transaction history for the user's card, newest first
     """
     try:
-        # Apply pagination
-        transactions = MOCK_TRANSACTIONS[offset:offset + limit]
-        
-        return TransactionListResponse(
-            transactions=[Transaction(**txn) for txn in transactions],
-            total_count=len(MOCK_TRANSACTIONS),
-            response_timestamp=datetime.utcnow()
+        transactions, next_cursor = await transaction_repository.list_transactions(
+            card_identifier,
+            limit=limit,
+            after=after,
+            date_from=date_from,
+            date_to=date_to,
+            merchant=merchant,
+            token_used=token_used
         )
+        
+        # Rows are projected to the Transaction fields, so encode them as-is
+        return FastJSONResponse({
+            "transactions": transactions,
+            "total_count": await transaction_repository.count_transactions(card_identifier),
+            "response_timestamp": datetime.utcnow(),
+            "next_cursor": next_cursor
+        })
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch transactions: {str(e)}")
 
 
+@router.post("/transactions", response_model=TransactionRecordResponse)
+async def record_transactions(request: TransactionRecordRequest):
+    """
+    Record new transactions for a card
+    The card's cached spend analytics are updated in place rather than
+    recomputed from the full history.
+    """
+    try:
+        recorded = await transaction_repository.insert(
+            request.card_identifier,
+            [transaction.model_dump() for transaction in request.transactions]
+        )
+        
+        return FastJSONResponse({
+            "card_identifier": request.card_identifier,
+            "recorded_count": len(recorded),
+            "total_count": await transaction_repository.count_transactions(request.card_identifier),
+            "response_timestamp": datetime.utcnow()
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to record transactions: {str(e)}")
+
+
 @router.get("/transactions/{transaction_id}", response_model=Transaction)
 async def get_transaction_details(transaction_id: str):
     """
     Get details of a specific transaction
     """
     try:
-        transaction = next((txn for txn in MOCK_TRANSACTIONS if txn["id"] == transaction_id), None)
-        if not transaction:
+        transaction = await transaction_repository.get(transaction_id)
+        if transaction is None:
             raise HTTPException(status_code=404, detail="Transaction not found")
         
-        return Transaction(**transaction)
+        return FastJSONResponse(transaction)
     except HTTPException:
         raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to fetch transaction details: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Failed to fetch transaction details: {str(e)}")
+
+@router.get("/analytics", response_model=SpendAnalyticsResponse)
+async def get_spend_analytics(card_identifier: str = "default_card"):
+    """
+    Spend totals and counts for the card by merchant, type, month and
+    whether a token was used; failed and declined transactions are excluded
+    """
+    try:
+        summary = await transaction_repository.spend_summary(card_identifier)
+        
+        return FastJSONResponse({
+            "card_identifier": card_identifier,
+            **summary.to_dict(),
+            "response_timestamp": datetime.utcnow()
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to compute spend analytics: {str(e)}")
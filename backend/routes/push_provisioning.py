@@ -3,33 +3,92 @@ Push Provisioning API endpoints
 Based on Visa TMS Push Provisioning workflow
 """
 
-from fastapi import APIRouter, HTTPException, BackgroundTasks
-from typing import List
+from fastapi import APIRouter, HTTPException, BackgroundTasks, Header, Query, Request
+from fastapi.responses import Response, StreamingResponse
+from typing import List, Optional
 from models.token_models import (
     PushProvisioningRequest, PushProvisioningResponse, 
-    PushProvisioningResult, TokenStatus, ProvisioningStatus
+    PushProvisioningJobStatus, PushProvisioningResult, ProvisioningStatus
 )
-from services.visa_service import VisaTokenManagementService
-from services.mock_data import MERCHANT_APPS, MOCK_CARD_DATA
-from datetime import datetime
-import logging
+from services.merchant_registry import merchant_registry
+from services.provisioning_jobs import (
+    provisioning_job_store, provisioning_worker_pool, run_provisioning, JOB_FAILED
+)
+from services.idempotency import idempotency_store, request_fingerprint
+from services.resilience import UpstreamUnavailable, service_unavailable
+from services.visa_service import visa_service
+from services.config import env_float, env_int
+from services.serialization import FastJSONResponse
+from services.http_cache import Representation, RepresentationCache, conditional_response
 import asyncio
+import json
+import logging
+import uuid
 
 router = APIRouter(prefix="/api/push-provisioning", tags=["push-provisioning"])
-visa_service = VisaTokenManagementService()
 logger = logging.getLogger(__name__)
 
+# Seconds between SSE keep-alive comments while waiting for the next merchant
+STREAM_HEARTBEAT_SECONDS = env_float("PROVISIONING_STREAM_HEARTBEAT_SECONDS", 10.0)
+
+# The catalog changes only on reload; clients may reuse it for a minute and
+# then revalidate with If-None-Match
+MERCHANTS_CACHE_CONTROL = f"public, max-age={env_int('MERCHANTS_MAX_AGE_SECONDS', 60)}"
+
+merchants_cache = RepresentationCache()
+
+# Provisioning runs started by streaming requests; they are kept referenced
+# here so they finish even if the client disconnects mid-stream
+_stream_tasks = set()
+
+JOB_STATUS_MESSAGES = {
+    "QUEUED": "Push provisioning request is queued",
+    "IN_PROGRESS": "Push provisioning is in progress",
+    "COMPLETED": "Push provisioning completed successfully",
+    "PARTIAL": "Push provisioning completed for some merchants",
+    "FAILED": "Push provisioning failed",
+}
 
-@router.post("", response_model=PushProvisioningResponse)
-async def create_push_provisioning_request(request: PushProvisioningRequest, background_tasks: BackgroundTasks):
+
+@router.post(
+    "",
+    response_model=PushProvisioningResponse,
+    responses={202: {"description": "Accepted for asynchronous processing (async=true)"}}
+)
+async def create_push_provisioning_request(
+    request: PushProvisioningRequest,
+    background_tasks: BackgroundTasks,
+    async_mode: bool = Query(False, alias="async", description="Queue the request and return 202 immediately"),
+    idempotency_key: Optional[str] = Header(None, max_length=255, description="Retries with the same key replay the first response")
+):
     """
     Create push provisioning request for selected merchant apps
-    This endpoint initiates the token creation process for multiple merchants
+    This endpoint initiates the token creation process for multiple merchants.
+    With ?async=true the request is queued and its progress is available from
+    GET /api/push-provisioning/status/{request_id}.
+    With an Idempotency-Key header, retries of the same request replay the
+    stored response instead of provisioning again.
     """
+    if idempotency_key is None:
+        return await _create_push_provisioning(request, background_tasks, async_mode)
+    
+    fingerprint = request_fingerprint(router.prefix, async_mode, request.model_dump_json())
+    
+    return await idempotency_store.run(
+        idempotency_key,
+        fingerprint,
+        lambda: _create_push_provisioning(request, background_tasks, async_mode)
+    )
+
+
+async def _create_push_provisioning(
+    request: PushProvisioningRequest,
+    background_tasks: BackgroundTasks,
+    async_mode: bool
+) -> Response:
     try:
-        # Validate merchant app IDs
-        valid_app_ids = [app["id"] for app in MERCHANT_APPS]
-        invalid_ids = [app_id for app_id in request.merchant_app_ids if app_id not in valid_app_ids]
+        # Validate merchant app IDs against the indexed registry
+        selected_apps, invalid_ids = merchant_registry.resolve(request.merchant_app_ids)
         
         if invalid_ids:
             raise HTTPException(
@@ -37,93 +96,189 @@ async def create_push_provisioning_request(request: PushProvisioningRequest, bac
                 detail=f"Invalid merchant app IDs: {invalid_ids}"
             )
         
-        # Get merchant app names for the request
-        selected_apps = [
-            app for app in MERCHANT_APPS 
-            if app["id"] in request.merchant_app_ids
-        ]
-        merchant_names = [app["name"] for app in selected_apps]
-        
-        logger.info(f"Starting push provisioning for merchants: {merchant_names}")
+        # Shed load immediately while TMS provisioning is failing
+        visa_service.guards.check("push_provisioning")
         
-        # Call Visa TMS service for push provisioning
-        visa_response = await visa_service.create_push_provisioning_request(
-            card_data=MOCK_CARD_DATA,
-            merchant_apps=merchant_names
-        )
+        merchant_names = [app["name"] for app in selected_apps]
+        request_id = str(uuid.uuid4())
+        await provisioning_job_store.create(request_id, request.card_identifier, selected_apps)
         
-        # Convert Visa response to our API response format
-        provisioning_results = []
-        for result in visa_response["pushProvisioningResults"]:
-            provisioning_results.append(
-                PushProvisioningResult(
-                    merchant_id=result["merchantId"],
-                    merchant_name=result["merchantName"],
-                    token_reference_id=result["tokenReferenceId"],
-                    token_status=TokenStatus(result["tokenStatus"]),
-                    provisioning_result=ProvisioningStatus(result["provisioningResult"]),
-                    token_expiry_date=result["tokenExpiryDate"],
-                    created_timestamp=datetime.fromisoformat(result["createdTimestamp"].replace('Z', '+00:00')),
-                    last_updated_timestamp=datetime.fromisoformat(result["lastUpdatedTimestamp"].replace('Z', '+00:00'))
-                )
+        if async_mode:
+            if not provisioning_worker_pool.submit(request_id, request.card_identifier, selected_apps):
+                await provisioning_job_store.finish(request_id, JOB_FAILED, error="Provisioning queue is full")
+                raise HTTPException(status_code=503, detail="Push provisioning queue is full, retry later")
+            
+            logger.info(f"Queued push provisioning for merchants: {merchant_names}. Request ID: {request_id}")
+            status_url = f"{router.prefix}/status/{request_id}"
+            return FastJSONResponse(
+                status_code=202,
+                content={"request_id": request_id, "status": "QUEUED", "status_url": status_url},
+                headers={"Location": status_url}
             )
         
-        response = PushProvisioningResponse(
-            request_id=visa_response["requestId"],
-            status=visa_response["status"],
-            timestamp=datetime.fromisoformat(visa_response["timestamp"].replace('Z', '+00:00')),
-            push_provisioning_results=provisioning_results
-        )
+        logger.info(f"Starting push provisioning for merchants: {merchant_names}")
+        
+        response = await run_provisioning(request_id, request.card_identifier, selected_apps)
         
-        logger.info(f"Push provisioning completed successfully. Request ID: {response.request_id}")
+        logger.info(f"Push provisioning completed with status {response.status}. Request ID: {response.request_id}")
         
         # Add background task for any post-processing if needed
-        background_tasks.add_task(log_provisioning_completion, response.request_id, len(provisioning_results))
+        created_count = sum(
+            1 for result in response.push_provisioning_results
+            if result.provisioning_result == ProvisioningStatus.SUCCESS
+        )
+        background_tasks.add_task(log_provisioning_completion, response.request_id, created_count)
         
-        return response
+        return FastJSONResponse(response)
         
     except HTTPException:
         raise
+    except UpstreamUnavailable as e:
+        raise service_unavailable(e)
     except Exception as e:
         logger.error(f"Push provisioning failed: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Push provisioning failed: {str(e)}")
 
 
-@router.get("/status/{request_id}")
+@router.post("/stream")
+async def stream_push_provisioning_request(request: PushProvisioningRequest, http_request: Request):
+    """
+    Create push provisioning request and stream progress as Server-Sent Events
+    Emits an `accepted` event with the request_id, one `result` event per
+    merchant as soon as it finishes, then a `summary` (or `error`) event.
+    If the client disconnects, provisioning still completes and its outcome
+    stays available from GET /api/push-provisioning/status/{request_id}.
+    """
+    selected_apps, invalid_ids = merchant_registry.resolve(request.merchant_app_ids)
+    if invalid_ids:
+        raise HTTPException(status_code=400, detail=f"Invalid merchant app IDs: {invalid_ids}")
+    try:
+        visa_service.guards.check("push_provisioning")
+    except UpstreamUnavailable as e:
+        raise service_unavailable(e)
+    
+    request_id = str(uuid.uuid4())
+    try:
+        await provisioning_job_store.create(request_id, request.card_identifier, selected_apps)
+    except Exception as e:
+        logger.error(f"Push provisioning failed: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Push provisioning failed: {str(e)}")
+    
+    # Unbounded so producers never block on a slow or departed client; the
+    # events per stream are bounded by the merchant count anyway
+    events: asyncio.Queue = asyncio.Queue()
+    
+    async def _on_result(result: PushProvisioningResult):
+        events.put_nowait(("result", result.model_dump_json()))
+    
+    async def _provision():
+        try:
+            response = await run_provisioning(
+                request_id, request.card_identifier, selected_apps, on_result=_on_result
+            )
+            events.put_nowait(("summary", response.model_dump_json()))
+        except Exception as e:
+            logger.error(f"Push provisioning failed: {str(e)}")
+            events.put_nowait(("error", json.dumps({"request_id": request_id, "detail": str(e)})))
+    
+    task = asyncio.create_task(_provision())
+    _stream_tasks.add(task)
+    task.add_done_callback(_stream_tasks.discard)
+    
+    async def _event_stream():
+        yield _sse_event("accepted", json.dumps({"request_id": request_id, "merchant_count": len(selected_apps)}))
+        while True:
+            if await http_request.is_disconnected():
+                logger.info(f"Client left provisioning stream {request_id}; provisioning continues in background")
+                return
+            try:
+                event, data = await asyncio.wait_for(events.get(), timeout=STREAM_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            yield _sse_event(event, data)
+            if event in ("summary", "error"):
+                return
+    
+    return StreamingResponse(
+        _event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+def _sse_event(event: str, data: str) -> str:
+    return f"event: {event}\ndata: {data}\n\n"
+
+
+@router.get("/status/{request_id}", response_model=PushProvisioningJobStatus)
 async def get_push_provisioning_status(request_id: str):
     """
     Get the status of a push provisioning request
     """
     try:
-        # In a real implementation, this would check the actual status
-        # For now, return a mock success status
-        return {
-            "request_id": request_id,
-            "status": "COMPLETED",
-            "timestamp": datetime.utcnow().isoformat(),
-            "message": "Push provisioning completed successfully"
-        }
+        job = await provisioning_job_store.get(request_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Push provisioning request not found")
+        
+        results = [
+            PushProvisioningResult(**job["results"][merchant_id])
+            for merchant_id in job["merchant_ids"]
+            if merchant_id in job["results"]
+        ]
+        
+        return FastJSONResponse(PushProvisioningJobStatus(
+            request_id=request_id,
+            status=job["status"],
+            timestamp=job["last_updated_timestamp"],
+            message=job.get("error") or JOB_STATUS_MESSAGES.get(job["status"], job["status"]),
+            merchant_count=len(job["merchant_ids"]),
+            completed_count=job["completed_count"],
+            push_provisioning_results=results
+        ))
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Failed to get provisioning status: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to get provisioning status: {str(e)}")
 
 
 @router.get("/merchants")
-async def get_available_merchants():
+async def get_available_merchants(request: Request):
     """
     Get list of available merchant apps for push provisioning
+    The body is serialized once per catalog version and sent with a strong
+    ETag derived from its bytes, so every worker serving the same catalog
+    agrees on it; If-None-Match with the current one returns 304.
     """
     try:
-        return {
-            "merchants": MERCHANT_APPS,
-            "total_count": len(MERCHANT_APPS),
-            "response_timestamp": datetime.utcnow().isoformat()
-        }
+        snapshot = merchant_registry.snapshot
+        representation = merchants_cache.get(
+            snapshot.version, lambda: Representation(snapshot.listing, tag="merchants")
+        )
+        return conditional_response(request, representation, MERCHANTS_CACHE_CONTROL)
     except Exception as e:
         logger.error(f"Failed to get merchants: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to get merchants: {str(e)}")
 
 
+@router.post("/merchants/reload")
+async def reload_merchants():
+    """
+    Reload the merchant catalog from MongoDB without restarting the server
+    """
+    try:
+        snapshot = await merchant_registry.reload()
+        return {
+            "version": snapshot.version,
+            "total_count": len(snapshot.apps),
+            "loaded_at": snapshot.loaded_at.isoformat()
+        }
+    except Exception as e:
+        logger.error(f"Failed to reload merchants: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to reload merchants: {str(e)}")
+
+
 async def log_provisioning_completion(request_id: str, token_count: int):
     """
     Background task to log completion of push provisioning
@@ -2,51 +2,168 @@
 Token management API endpoints
 """
 
-from fastapi import APIRouter, HTTPException
-from typing import List
+from fastapi import APIRouter, HTTPException, Query
+from typing import List, Optional
 from models.token_models import (
     TokenInfo, TokenListResponse, TokenUpdateRequest, 
-    TokenUpdateResponse, TokenStatus
+    TokenUpdateResponse, TokenStatus, TokenBatchRequest,
+    TokenBatchItem, TokenBatchItemResult, TokenBatchResponse
 )
-from services.visa_service import VisaTokenManagementService
-from services.mock_data import MERCHANT_APPS
+from services.visa_service import visa_service
+from services.token_repository import token_repository
+from services.expiry_sweeper import token_expiry_sweeper
+from services.cache import TTLCache
+from services.resilience import UpstreamUnavailable, service_unavailable
+from services.config import env_float, env_int
+from services.serialization import FastJSONResponse
 from datetime import datetime
+import asyncio
 import logging
 
 router = APIRouter(prefix="/api/tokens", tags=["tokens"])
-visa_service = VisaTokenManagementService()
 logger = logging.getLogger(__name__)
 
+# Read-through cache for upstream token status, keyed by token reference id
+token_status_cache = TTLCache(
+    max_size=env_int("TOKEN_STATUS_CACHE_SIZE", 10000),
+    ttl=env_float("TOKEN_STATUS_CACHE_TTL", 30.0),
+    stale_ttl=env_float("TOKEN_STATUS_CACHE_STALE_TTL", 60.0),
+    name="token_status"
+)
+
+# Upstream calls in flight at once for a single batch request
+TOKEN_BATCH_CONCURRENCY = env_int("TOKEN_BATCH_CONCURRENCY", 10)
+
 
 @router.get("", response_model=TokenListResponse)
-async def list_user_tokens(card_identifier: str = "default_card"):
+async def list_user_tokens(
+    card_identifier: str = "default_card",
+    status: Optional[List[TokenStatus]] = Query(None, description="Only return tokens in these statuses (default: all but DELETED)"),
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page")
+):
     """
-    List all tokens for the user's card
+    List tokens for the user's card, newest first, one keyset page at a time
     """
     try:
-        # Call Visa TMS service to get tokens
-        visa_response = await visa_service.list_tokens(card_identifier)
-        
-        return TokenListResponse(
-            tokens=[TokenInfo(**token) for token in visa_response["tokens"]],
-            total_count=visa_response["totalCount"],
-            response_timestamp=datetime.fromisoformat(visa_response["responseTimestamp"].replace('Z', '+00:00'))
+        tokens, next_cursor = await token_repository.list_tokens(
+            card_identifier, statuses=status, limit=limit, cursor=cursor
         )
+        total_count = await token_repository.count_tokens(card_identifier, statuses=status)
+        
+        # Rows are projected to the TokenInfo fields, so encode them as-is
+        return FastJSONResponse({
+            "tokens": tokens,
+            "total_count": total_count,
+            "response_timestamp": datetime.utcnow(),
+            "next_cursor": next_cursor
+        })
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Failed to list tokens: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to fetch tokens: {str(e)}")
 
 
+@router.post("/batch", response_model=TokenBatchResponse)
+async def batch_update_tokens(request: TokenBatchRequest):
+    """
+    Update or delete many tokens in one request
+    Upstream calls run concurrently (up to TOKEN_BATCH_CONCURRENCY), stored
+    tokens are updated with a single bulk write, and each token reports its
+    own result so one failure does not fail the batch.
+    """
+    token_ids = [item.token_reference_id for item in request.updates]
+    if len(set(token_ids)) != len(token_ids):
+        raise HTTPException(status_code=400, detail="Each token_reference_id may appear only once per batch")
+    
+    semaphore = asyncio.Semaphore(TOKEN_BATCH_CONCURRENCY)
+    
+    async def _apply(item: TokenBatchItem) -> TokenBatchItemResult:
+        try:
+            try:
+                async with semaphore:
+                    if item.token_status == TokenStatus.DELETED:
+                        visa_response = await visa_service.delete_token(item.token_reference_id)
+                        token_status = TokenStatus.DELETED
+                        updated_at = visa_response["deletedTimestamp"]
+                    else:
+                        visa_response = await visa_service.update_token_status(
+                            item.token_reference_id, item.token_status.value
+                        )
+                        token_status = TokenStatus(visa_response["tokenStatus"])
+                        updated_at = visa_response["lastUpdatedTimestamp"]
+            finally:
+                # Upstream may have applied the change even if the call failed
+                token_status_cache.invalidate(item.token_reference_id)
+            
+            return TokenBatchItemResult(
+                token_reference_id=item.token_reference_id,
+                token_status=token_status,
+                last_updated_timestamp=datetime.fromisoformat(updated_at.replace('Z', '+00:00')),
+                update_result="SUCCESS"
+            )
+        except Exception as e:
+            logger.error(f"Batch update failed for token {item.token_reference_id}: {str(e)}")
+            return TokenBatchItemResult(
+                token_reference_id=item.token_reference_id,
+                update_result="FAILED",
+                error=str(e)
+            )
+    
+    try:
+        results = await asyncio.gather(*(_apply(item) for item in request.updates))
+        succeeded = [result for result in results if result.update_result == "SUCCESS"]
+        
+        await token_repository.bulk_update_status([
+            (result.token_reference_id, result.token_status, result.last_updated_timestamp)
+            for result in succeeded
+        ])
+        
+        return FastJSONResponse(TokenBatchResponse(
+            results=results,
+            success_count=len(succeeded),
+            failure_count=len(results) - len(succeeded),
+            response_timestamp=datetime.utcnow()
+        ))
+    except Exception as e:
+        logger.error(f"Failed to apply token batch: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to apply token batch: {str(e)}")
+
+
+@router.get("/cache/stats")
+async def get_token_cache_stats():
+    """
+    Hit, miss and eviction counters for the token status cache
+    """
+    return token_status_cache.stats()
+
+
+@router.get("/expiry-sweep")
+async def get_expiry_sweep_status():
+    """
+    Checkpoint of the current or last token expiry sweep (cutoff, progress
+    per partition, renewed/flagged counts)
+    """
+    try:
+        return FastJSONResponse(await token_expiry_sweeper.status() or {"status": "no sweep has run"})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to fetch expiry sweep status: {str(e)}")
+
+
 @router.get("/{token_reference_id}", response_model=TokenInfo)
 async def get_token_details(token_reference_id: str):
     """
     Get details of a specific token
     """
     try:
-        # Call Visa TMS service to get token status
-        visa_response = await visa_service.get_token_status(token_reference_id)
+        # Call Visa TMS service to get token status (served from cache when fresh)
+        visa_response = await token_status_cache.get_or_load(
+            token_reference_id,
+            lambda: visa_service.get_token_status(token_reference_id)
+        )
         
-        return TokenInfo(
+        return FastJSONResponse(TokenInfo(
             token_reference_id=visa_response["tokenReferenceId"],
             merchant_id="UNKNOWN",  # Not provided in mock response
             merchant_name=visa_response["merchantName"],
@@ -54,7 +171,9 @@ async def get_token_details(token_reference_id: str):
             created_timestamp=datetime.utcnow(),  # Mock data
             last_used_timestamp=datetime.fromisoformat(visa_response["lastUsedTimestamp"].replace('Z', '+00:00')) if visa_response.get("lastUsedTimestamp") else None,
             token_expiry_date=visa_response["tokenExpiryDate"]
-        )
+        ))
+    except UpstreamUnavailable as e:
+        raise service_unavailable(e)
     except Exception as e:
         logger.error(f"Failed to get token details: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to fetch token details: {str(e)}")
@@ -67,14 +186,25 @@ async def update_token_status(token_reference_id: str, request: TokenUpdateReque
     """
     try:
         # Call Visa TMS service to update token
-        visa_response = await visa_service.update_token_status(token_reference_id, request.token_status.value)
+        try:
+            visa_response = await visa_service.update_token_status(token_reference_id, request.token_status.value)
+        finally:
+            token_status_cache.invalidate(token_reference_id)
         
-        return TokenUpdateResponse(
+        response = TokenUpdateResponse(
             token_reference_id=visa_response["tokenReferenceId"],
             token_status=TokenStatus(visa_response["tokenStatus"]),
             last_updated_timestamp=datetime.fromisoformat(visa_response["lastUpdatedTimestamp"].replace('Z', '+00:00')),
             update_result=visa_response["updateResult"]
         )
+        
+        await token_repository.update_status(
+            token_reference_id, response.token_status, response.last_updated_timestamp
+        )
+        
+        return FastJSONResponse(response)
+    except UpstreamUnavailable as e:
+        raise service_unavailable(e)
     except Exception as e:
         logger.error(f"Failed to update token: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to update token: {str(e)}")
@@ -87,14 +217,25 @@ async def delete_token(token_reference_id: str):
     """
     try:
         # Call Visa TMS service to delete token
-        visa_response = await visa_service.delete_token(token_reference_id)
+        try:
+            visa_response = await visa_service.delete_token(token_reference_id)
+        finally:
+            token_status_cache.invalidate(token_reference_id)
+        
+        await token_repository.update_status(
+            token_reference_id,
+            TokenStatus.DELETED,
+            datetime.fromisoformat(visa_response["deletedTimestamp"].replace('Z', '+00:00'))
+        )
         
-        return {
+        return FastJSONResponse({
             "message": "Token deleted successfully",
             "token_reference_id": visa_response["tokenReferenceId"],
             "deletion_result": visa_response["deletionResult"],
             "deleted_timestamp": visa_response["deletedTimestamp"]
-        }
+        })
+    except UpstreamUnavailable as e:
+        raise service_unavailable(e)
     except Exception as e:
         logger.error(f"Failed to delete token: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to delete token: {str(e)}")
\ No newline at end of file
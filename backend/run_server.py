@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Production launcher
+Runs the API under uvicorn with one worker process per CPU core (or
+--workers / WEB_CONCURRENCY). Each worker builds its own app through
+server.create_app, so every worker has its own Mongo client, Visa TMS
+connection pool, provisioning workers and caches.
+
+On SIGTERM/SIGINT uvicorn stops accepting connections, waits up to
+--graceful-timeout seconds for in-flight requests, then runs the app's
+lifespan shutdown (readiness turns 503, queued provisioning jobs drain for
+up to SHUTDOWN_DRAIN_SECONDS, pools close).
+
+Run from backend/:
+    python run_server.py --port 8000
+    python run_server.py --workers 8 --graceful-timeout 45
+"""
+
+import argparse
+import os
+
+import uvicorn
+
+
+def default_workers() -> int:
+    return int(os.environ.get("WEB_CONCURRENCY") or os.cpu_count() or 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=os.environ.get("API_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("API_PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=default_workers(),
+                        help="Worker processes (default: WEB_CONCURRENCY or the number of CPU cores)")
+    parser.add_argument("--graceful-timeout", type=float, default=30.0,
+                        help="Seconds to let in-flight requests finish on shutdown")
+    parser.add_argument("--keep-alive", type=int, default=5, help="Idle HTTP keep-alive timeout in seconds")
+    parser.add_argument("--backlog", type=int, default=2048)
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+
+    uvicorn.run(
+        "server:create_app",
+        factory=True,
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        timeout_graceful_shutdown=int(args.graceful_timeout),
+        timeout_keep_alive=args.keep_alive,
+        backlog=args.backlog,
+        log_level=args.log_level,
+        proxy_headers=True,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,78 @@
-from fastapi import FastAPI, APIRouter
+from fastapi import FastAPI, APIRouter, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.uri_parser import parse_uri
+from contextlib import asynccontextmanager
+import asyncio
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List
+from typing import Callable, List, Optional
 import uuid
 from datetime import datetime
 
-# Import new routes
-from routes import cards, tokens, push_provisioning
-
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
-db_name = os.environ.get('DB_NAME', 'credit_card_tokens')
-client = AsyncIOMotorClient(mongo_url)
-db = client[db_name]
+# Import new routes (after .env is loaded so services pick up their settings)
+from routes import cards, tokens, push_provisioning
+from services.visa_service import visa_service
+from services.merchant_registry import merchant_registry
+from services.token_repository import token_repository
+from services.transaction_repository import transaction_repository
+from services.provisioning_jobs import provisioning_job_store, provisioning_worker_pool
+from services.idempotency import idempotency_store
+from services.status_repository import status_check_repository
+from services.expiry_sweeper import token_expiry_sweeper
+from services.write_behind import BufferFullError
+from services.serialization import dump_json
+from services.metrics import MetricsMiddleware, MongoCommandMetrics, registry as metrics_registry, render_samples
+from services.partitioning import Partition, PartitionRouter, parse_partition_spec
+from services.config import env_bool, env_float, env_int, env_str
 
-# Create the main app without a prefix
-app = FastAPI(title="Credit Card Token Management API", version="1.0.0")
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
+# Liveness/readiness probes for the load balancer or orchestrator
+health_router = APIRouter(prefix="/healthz", tags=["health"])
+
+def create_mongo_client(mongo_url: Optional[str] = None) -> AsyncIOMotorClient:
+    mongo_url = mongo_url or os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
+    return AsyncIOMotorClient(mongo_url, event_listeners=[MongoCommandMetrics()])
+
+def create_partition_router(db, make_client: Callable[..., AsyncIOMotorClient]) -> PartitionRouter:
+    """
+    Token/transaction partitions from MONGO_PARTITIONS, e.g.
+    "p0,p1=mongodb://cards-b:27017,p2=mongodb://cards-c:27017/cards"
+    A partition without a URL uses the primary database; the others get
+    their own client and the database named in the URL (default DB_NAME).
+    Unset means a single partition on the primary database.
+    """
+    spec = env_str("MONGO_PARTITIONS")
+    if spec is None:
+        return PartitionRouter.single(db)
+    
+    partitions = []
+    primary_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
+    for name, url in parse_partition_spec(spec, primary_url=primary_url, default_database=db.name):
+        if url is None:
+            partitions.append(Partition(name, db))
+            continue
+        client = make_client(url)
+        db_name = parse_uri(url)["database"] or db.name
+        partitions.append(Partition(name, client[db_name], client=client))
+    return PartitionRouter(partitions, vnodes=env_int("MONGO_PARTITION_VNODES", 64))
+
 # Define Models for existing endpoints
 class StatusCheck(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -46,41 +91,182 @@ async def root():
 async def create_status_check(input: StatusCheckCreate):
     status_dict = input.dict()
     status_obj = StatusCheck(**status_dict)
-    _ = await db.status_checks.insert_one(status_obj.dict())
+    try:
+        await status_check_repository.insert(status_obj.dict())
+    except BufferFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
     return status_obj
 
 @api_router.get("/status", response_model=List[StatusCheck])
-async def get_status_checks():
-    status_checks = await db.status_checks.find().to_list(1000)
-    return [StatusCheck(**status_check) for status_check in status_checks]
-
-# Include the new routers
-app.include_router(cards.router)
-app.include_router(tokens.router)
-app.include_router(push_provisioning.router)
-
-# Include the existing API router
-app.include_router(api_router)
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_credentials=True,
-    allow_origins=["*"],
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+async def get_status_checks(
+    request: Request,
+    client_name: Optional[str] = None,
+    since: Optional[datetime] = Query(None, description="Only checks at or after this time"),
+    until: Optional[datetime] = Query(None, description="Only checks before this time"),
+    limit: int = Query(1000, ge=0, description="Maximum checks to return (0 = no limit)"),
+    format: Optional[str] = Query(None, pattern="^(json|ndjson)$", description="json array (default) or ndjson; also chosen by Accept: application/x-ndjson")
+):
+    """
+    Stream status checks newest first, as a JSON array or NDJSON
+    Rows are encoded straight from a batched cursor, so memory stays flat
+    regardless of how many checks match.
+    """
+    if since is not None and until is not None and since >= until:
+        raise HTTPException(status_code=400, detail="since must be earlier than until")
+    
+    ndjson = format == "ndjson" or (format is None and "application/x-ndjson" in request.headers.get("accept", ""))
+    checks = status_check_repository.iter_checks(client_name=client_name, since=since, until=until, limit=limit)
+    
+    async def _ndjson():
+        async for check in checks:
+            yield dump_json(check) + b"\n"
+    
+    async def _json_array():
+        separator = b"["
+        async for check in checks:
+            yield separator + dump_json(check)
+            separator = b","
+        yield b"[]" if separator == b"[" else b"]"
+    
+    if ndjson:
+        return StreamingResponse(_ndjson(), media_type="application/x-ndjson")
+    return StreamingResponse(_json_array(), media_type="application/json")
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
+@api_router.get("/upstream/status")
+async def get_upstream_status():
+    """
+    Circuit breaker and concurrency limit state per Visa TMS operation, and
+    how many reads joined an identical call already in flight
+    """
+    return {
+        "visa_tms": visa_service.guards.snapshot(),
+        "coalescing": [visa_service.coalescer.stats(), token_repository.read_coalescing_stats()],
+    }
+
+@health_router.get("/live")
+async def liveness():
+    """
+    The worker process is up and its event loop is responsive
+    """
+    return {"status": "ok"}
+
+@health_router.get("/ready")
+async def readiness(request: Request):
+    """
+    Startup has finished, shutdown has not begun and MongoDB (every
+    partition) answers a ping
+    """
+    if not request.app.state.ready:
+        return JSONResponse({"status": "unavailable", "reason": "starting or draining"}, status_code=503)
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(request.app.state.db.command("ping"), request.app.state.partitions.ping()),
+            timeout=env_float("READINESS_PING_TIMEOUT", 1.0)
+        )
+    except Exception as e:
+        return JSONResponse({"status": "unavailable", "reason": f"MongoDB ping failed: {str(e)}"}, status_code=503)
+    return {"status": "ready"}
+
+def _collect_service_metrics():
+    caches = [tokens.token_status_cache.stats(), transaction_repository.lookup_cache_stats(),
+              transaction_repository.spend_cache_stats()]
+    return (
+        render_samples("gauge", "provisioning_queue_depth", "Provisioning jobs waiting for a worker", (),
+                       {(): provisioning_worker_pool.queue_depth})
+        + render_samples("gauge", "cache_entries", "Entries held per cache", ("cache",),
+                         {(cache["name"],): cache["size"] for cache in caches})
+        + render_samples("counter", "cache_lookups_total", "Cache lookups by outcome", ("cache", "outcome"),
+                         {(cache["name"], outcome): cache[key] for cache in caches
+                          for outcome, key in (("hit", "hits"), ("stale_hit", "stale_hits"), ("miss", "misses"))})
+    )
+
+metrics_registry.add_collector(_collect_service_metrics)
+
+async def metrics():
+    """
+    Prometheus scrape endpoint (metrics of the worker that answers)
+    """
+    return Response(metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
+def create_app(client_factory: Optional[Callable[..., AsyncIOMotorClient]] = None) -> FastAPI:
+    """
+    Build the application; every worker process calls this once
+    The Mongo client, the Visa TMS connection pool, background workers and
+    caches are set up in the lifespan, inside the worker's own event loop, so
+    nothing connection-bearing exists at import time or is shared across a
+    fork. client_factory(url=None) overrides how Mongo clients are created.
+    """
+    make_client = client_factory or create_mongo_client
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        client = make_client()
+        db = client[os.environ.get('DB_NAME', 'credit_card_tokens')]
+        app.state.mongo_client = client
+        app.state.db = db
+        partitions = create_partition_router(db, make_client)
+        app.state.partitions = partitions
+
+        visa_service.guards.bind(db)
+        await visa_service.start()
+        await merchant_registry.load(db)
+        await token_repository.init(db, partitions)
+        await transaction_repository.init(db, partitions)
+        await provisioning_job_store.init(db)
+        await idempotency_store.init(db)
+        await status_check_repository.init(db)
+        await token_expiry_sweeper.init(db)
+        provisioning_worker_pool.start()
+        merchant_registry.start_auto_reload(env_float("MERCHANT_REGISTRY_REFRESH_SECONDS", 300.0))
+        transaction_repository.start_snapshot_refresh(env_float("TRANSACTION_SNAPSHOT_REFRESH_SECONDS", 60.0))
+        token_expiry_sweeper.start()
+        app.state.ready = True
+        logger.info(f"Credit Card Token Management API started successfully (pid {os.getpid()})")
+
+        try:
+            yield
+        finally:
+            # Fail readiness first so no new work is routed here, then drain
+            app.state.ready = False
+            await provisioning_worker_pool.stop(drain_timeout=env_float("SHUTDOWN_DRAIN_SECONDS", 30.0))
+            await token_expiry_sweeper.stop()
+            await status_check_repository.close()
+            await merchant_registry.stop()
+            await transaction_repository.stop()
+            await visa_service.close()
+            tokens.token_status_cache.clear()
+            partitions.close()
+            client.close()
+            logger.info(f"Credit Card Token Management API stopped (pid {os.getpid()})")
+
+    # Create the main app without a prefix
+    app = FastAPI(title="Credit Card Token Management API", version="1.0.0", lifespan=lifespan)
+    app.state.ready = False
+
+    app.add_api_route("/metrics", metrics, methods=["GET"], include_in_schema=False)
+    app.include_router(health_router)
+
+    # Include the new routers
+    app.include_router(cards.router)
+    app.include_router(tokens.router)
+    app.include_router(push_provisioning.router)
+
+    # Include the existing API router
+    app.include_router(api_router)
+
+    app.add_middleware(
+        CORSMiddleware,
+        allow_credentials=True,
+        allow_origins=["*"],
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+
+    # Outermost, so the timings include CORS and exception handling
+    if env_bool("METRICS_ENABLED", True):
+        app.add_middleware(MetricsMiddleware)
 
-@app.on_event("startup")
-async def startup_event():
-    logger.info("Credit Card Token Management API started successfully")
+    return app
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+# Single-process entry point (uvicorn server:app); run_server.py builds one app per worker
+app = create_app()
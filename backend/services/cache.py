@@ -0,0 +1,151 @@
+"""
+In-process read-through cache
+TTL + LRU cache with a size bound and stale-while-revalidate, used in front
+of upstream lookups that are polled far more often than they change.
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+logger = logging.getLogger(__name__)
+
+
+class _Entry:
+    __slots__ = ("value", "fresh_until", "stale_until")
+
+    def __init__(self, value: Any, fresh_until: float, stale_until: float):
+        self.value = value
+        self.fresh_until = fresh_until
+        self.stale_until = stale_until
+
+
+class TTLCache:
+    """
+    Read-through cache keyed by any hashable value
+
+    - entries younger than `ttl` seconds are served directly (hit)
+    - entries within a further `stale_ttl` seconds are served immediately
+      while a single background refresh reloads them (stale hit)
+    - older or missing entries are loaded inline (miss)
+    - beyond `max_size` entries the least recently used one is evicted
+
+    invalidate() drops an entry and discards any load already in flight for
+    it, so a write is never overwritten by a read that started before it.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 30.0, stale_ttl: float = 0.0, name: str = "cache"):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.name = name
+        self._entries: "OrderedDict[Hashable, _Entry]" = OrderedDict()
+        self._loads: Dict[Hashable, object] = {}
+        self._refreshes: Dict[Hashable, asyncio.Task] = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        now = time.monotonic()
+        entry = self._entries.get(key)
+
+        if entry is not None:
+            if now < entry.fresh_until:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return entry.value
+            if now < entry.stale_until:
+                self.stale_hits += 1
+                self._entries.move_to_end(key)
+                self._schedule_refresh(key, loader)
+                return entry.value
+
+        self.misses += 1
+        load_token = object()
+        self._loads[key] = load_token
+        try:
+            value = await loader()
+        finally:
+            current = self._loads.get(key)
+            if current is load_token:
+                del self._loads[key]
+        if current is load_token:
+            self.set(key, value)
+        return value
+
+    def peek(self, key: Hashable) -> Any:
+        """
+        The fresh cached value, or None; never loads and does not count as a lookup
+        """
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() >= entry.fresh_until:
+            return None
+        return entry.value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        now = time.monotonic()
+        self._entries[key] = _Entry(value, now + self.ttl, now + self.ttl + self.stale_ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        self._loads.pop(key, None)
+        refresh = self._refreshes.pop(key, None)
+        if refresh is not None:
+            refresh.cancel()
+        if self._entries.pop(key, None) is not None:
+            self.invalidations += 1
+
+    def clear(self) -> None:
+        for key in list(self._refreshes):
+            self._refreshes.pop(key).cancel()
+        self._loads.clear()
+        self._entries.clear()
+
+    def _schedule_refresh(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> None:
+        if key in self._refreshes or key in self._loads:
+            return
+
+        load_token = object()
+        self._loads[key] = load_token
+
+        async def _refresh():
+            try:
+                value = await loader()
+                if self._loads.get(key) is load_token:
+                    self.set(key, value)
+            except Exception as e:
+                logger.warning(f"{self.name}: background refresh for {key!r} failed: {str(e)}")
+            finally:
+                if self._loads.get(key) is load_token:
+                    del self._loads[key]
+                if self._refreshes.get(key) is asyncio.current_task():
+                    del self._refreshes[key]
+
+        self._refreshes[key] = asyncio.create_task(_refresh())
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            "name": self.name,
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl,
+            "stale_ttl_seconds": self.stale_ttl,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "hit_ratio": (self.hits + self.stale_hits) / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,41 @@
+"""
+Environment configuration helpers
+Small typed readers for the settings our services pick up from backend/.env
+"""
+
+import os
+from typing import Optional
+
+
+def env_str(name: str, default: Optional[str] = None) -> Optional[str]:
+    """
+    Read a string setting, treating an empty value as unset
+    """
+    value = os.environ.get(name)
+    return value if value not in (None, "") else default
+
+
+def env_int(name: str, default: int) -> int:
+    """
+    Read an integer setting
+    """
+    value = env_str(name)
+    return int(value) if value is not None else default
+
+
+def env_float(name: str, default: float) -> float:
+    """
+    Read a float setting
+    """
+    value = env_str(name)
+    return float(value) if value is not None else default
+
+
+def env_bool(name: str, default: bool) -> bool:
+    """
+    Read a boolean setting ("1", "true", "yes", "on" are truthy)
+    """
+    value = env_str(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
@@ -0,0 +1,289 @@
+"""
+Token expiry sweeper
+Renews (or flags) tokens whose token_expiry_date falls within the next
+TOKEN_EXPIRY_WINDOW_DAYS, so they are handled in bulk off-peak instead of
+failing an authorization at checkout.
+
+A sweep walks each partition's (token_expiry_date, token_reference_id)
+index in keyset order, TOKEN_EXPIRY_BATCH_SIZE tokens at a time:
+
+- each batch is renewed through VisaTokenManagementService with bounded
+  concurrency and paced to TOKEN_EXPIRY_RATE tokens per second
+- results are written back with one bulk write per partition; tokens that
+  could not be renewed (or every token, with TOKEN_EXPIRY_ACTION=flag) get
+  an `expiry_flag` for follow-up. Flag mode skips tokens already flagged.
+- the position reached is checkpointed in `sweeper_checkpoints` after each
+  batch, so a restarted sweep resumes where it stopped
+
+Sweeps start every TOKEN_EXPIRY_SWEEP_INTERVAL seconds and only run within
+TOKEN_EXPIRY_SWEEP_HOURS (UTC, e.g. "1-5"). The checkpoint document doubles
+as a lease, so with several workers only one sweeps at a time. If Visa TMS
+is unavailable the sweep stops at its last checkpoint and resumes later.
+"""
+
+import asyncio
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from services.config import env_float, env_int, env_str
+from services.metrics import registry as metrics_registry
+from services.rate_limit import rate_limit_wait
+from services.resilience import UpstreamUnavailable
+from services.token_repository import token_repository
+from services.visa_service import visa_service
+
+logger = logging.getLogger(__name__)
+
+TOKEN_EXPIRY_SWEPT = metrics_registry.counter(
+    "token_expiry_swept_tokens_total", "Tokens handled by the expiry sweeper", ("outcome",)
+)
+
+CHECKPOINT_ID = "token_expiry"
+
+
+def parse_hours(spec: Optional[str]) -> Optional[Tuple[int, int]]:
+    """
+    "1-5" -> (1, 5): sweeps may run from 01:00 up to 05:00 UTC; a window
+    may wrap midnight ("22-4"). None or empty means any time.
+    Raises ValueError for anything else.
+    """
+    if not spec:
+        return None
+    start, separator, end = spec.partition("-")
+    try:
+        hours = (int(start), int(end)) if separator else None
+    except ValueError:
+        hours = None
+    # An empty window ("3-3") would never sweep
+    if hours is None or not 0 <= hours[0] <= 23 or not 0 <= hours[1] <= 24 or hours[0] == hours[1]:
+        raise ValueError(f"Invalid TOKEN_EXPIRY_SWEEP_HOURS '{spec}': expected START-END hours in UTC, e.g. \"1-5\"")
+    return hours
+
+
+class TokenExpirySweeper:
+    """
+    Scheduled, resumable expiry sweep over the token repository
+    """
+
+    def __init__(self, collection_name: str = "sweeper_checkpoints"):
+        self.collection_name = collection_name
+        self.action = env_str("TOKEN_EXPIRY_ACTION", "renew")
+        self.window_days = env_int("TOKEN_EXPIRY_WINDOW_DAYS", 60)
+        self.batch_size = env_int("TOKEN_EXPIRY_BATCH_SIZE", 100)
+        self.rate = env_float("TOKEN_EXPIRY_RATE", 10.0)
+        self.concurrency = env_int("TOKEN_EXPIRY_CONCURRENCY", 4)
+        self.interval = env_float("TOKEN_EXPIRY_SWEEP_INTERVAL", 24 * 3600.0)
+        self.poll_interval = env_float("TOKEN_EXPIRY_POLL_SECONDS", 300.0)
+        try:
+            self.hours = parse_hours(env_str("TOKEN_EXPIRY_SWEEP_HOURS"))
+        except ValueError as e:
+            # Built at import time: a typo must not keep the API from starting
+            logger.error(f"{str(e)}; sweeping at any time")
+            self.hours = None
+        self.lease_seconds = env_float("TOKEN_EXPIRY_LEASE_SECONDS", 120.0)
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._db = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def init(self, db) -> None:
+        self._db = db
+
+    @property
+    def _checkpoints(self):
+        if self._db is None:
+            raise RuntimeError("TokenExpirySweeper has not been initialised")
+        return self._db[self.collection_name]
+
+    def in_window(self, now: Optional[datetime] = None) -> bool:
+        if self.hours is None:
+            return True
+        hour = (now or datetime.utcnow()).hour
+        start, end = self.hours
+        return start <= hour < end if start <= end else hour >= start or hour < end
+
+    def start(self) -> None:
+        """
+        Run sweeps in the background; TOKEN_EXPIRY_SWEEP_INTERVAL <= 0 disables them
+        """
+        if self.interval <= 0 or self._task is not None:
+            return
+
+        async def _sweep_loop():
+            while True:
+                try:
+                    if self.in_window():
+                        await self.run_once()
+                except Exception as e:
+                    logger.error(f"Token expiry sweep failed: {str(e)}")
+                await asyncio.sleep(self.poll_interval)
+
+        self._task = asyncio.create_task(_sweep_loop())
+
+    async def stop(self) -> None:
+        """
+        Stop sweeping; the checkpoint keeps the position of the last
+        completed batch and the lease is released
+        """
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+            if self._db is not None:
+                await self._checkpoints.update_one(
+                    {"_id": CHECKPOINT_ID, "lease_owner": self.owner}, {"$set": {"lease_until": datetime.utcnow()}}
+                )
+
+    async def _acquire(self, now: datetime) -> Optional[Dict[str, Any]]:
+        """
+        Take or extend the lease, returning the checkpoint, or None if
+        another worker holds it
+        """
+        try:
+            return await self._checkpoints.find_one_and_update(
+                {"_id": CHECKPOINT_ID, "$or": [
+                    {"lease_owner": self.owner},
+                    {"lease_until": {"$lt": now}},
+                    {"lease_until": {"$exists": False}},
+                ]},
+                {"$set": {"lease_owner": self.owner, "lease_until": now + timedelta(seconds=self.lease_seconds)}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            return None
+
+    async def _save(self, fields: Dict[str, Any]) -> bool:
+        """
+        Update the checkpoint and extend the lease; False if the lease was lost
+        """
+        fields["lease_until"] = datetime.utcnow() + timedelta(seconds=self.lease_seconds)
+        result = await self._checkpoints.update_one({"_id": CHECKPOINT_ID, "lease_owner": self.owner}, {"$set": fields})
+        if result.matched_count == 0:
+            logger.warning("Token expiry sweep lease lost to another worker; stopping")
+            return False
+        return True
+
+    async def run_once(self, force: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        Resume an unfinished sweep or start a due one (any time with force),
+        returning the checkpoint, or None if nothing ran
+        """
+        now = datetime.utcnow()
+        checkpoint = await self._acquire(now)
+        if checkpoint is None:
+            return None
+
+        if checkpoint.get("finished_at") is not None or "cutoff" not in checkpoint:
+            last_started = checkpoint.get("started_at")
+            if not force and last_started is not None and now - last_started < timedelta(seconds=self.interval):
+                return None
+            checkpoint.update({
+                "started_at": now,
+                "finished_at": None,
+                "cutoff": (now + timedelta(days=self.window_days)).strftime("%Y%m"),
+                "positions": {},
+                "counts": {"renewed": 0, "flagged": 0},
+            })
+            if not await self._save({key: checkpoint[key] for key in ("started_at", "finished_at", "cutoff", "positions", "counts")}):
+                return checkpoint
+            logger.info(f"Token expiry sweep started (cutoff {checkpoint['cutoff']})")
+
+        positions, counts = checkpoint["positions"], checkpoint["counts"]
+        for partition_name in token_repository.router.names:
+            position = positions.get(partition_name)
+            while position != "done":
+                if not force and not self.in_window():
+                    logger.info("Token expiry sweep paused outside its hours")
+                    return checkpoint
+                after = tuple(position) if position else None
+                batch = await token_repository.expiring_tokens(
+                    partition_name, checkpoint["cutoff"], after, self.batch_size,
+                    unflagged_only=self.action != "renew",
+                )
+                error = None
+                if not batch:
+                    position = "done"
+                else:
+                    results, error = await self._process(batch)
+                    completed = [result for result in results if result is not None]
+                    await token_repository.apply_expiry_results(completed)
+                    for result in completed:
+                        counts["renewed" if result.get("token_expiry_date") else "flagged"] += 1
+                    # The keyset position only moves past the unbroken run of
+                    # handled tokens; renewed tokens after a gap have left the
+                    # window, the rest are retried on resume
+                    for token, result in zip(batch, results):
+                        if result is None:
+                            break
+                        position = [token["token_expiry_date"], token["token_reference_id"]]
+                positions[partition_name] = position
+                if not await self._save({"positions": positions, "counts": counts}):
+                    return checkpoint
+                if error is not None:
+                    logger.warning(f"Token expiry sweep stopped, resumes from its checkpoint: {str(error)}")
+                    return checkpoint
+
+        checkpoint["finished_at"] = datetime.utcnow()
+        await self._save({"finished_at": checkpoint["finished_at"]})
+        logger.info(f"Token expiry sweep finished: {counts}")
+        return checkpoint
+
+    async def _process(
+        self, batch: List[Dict[str, Any]]
+    ) -> Tuple[List[Optional[Dict[str, Any]]], Optional[UpstreamUnavailable]]:
+        """
+        Renew a batch, taking at least len(batch) / rate seconds
+        Returns one result per token, None for tokens left unhandled because
+        Visa TMS rejected calls, together with that rejection. Once a call is
+        rejected no further renewals start; those already started finish and
+        their results are kept.
+        """
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        rejections: List[UpstreamUnavailable] = []
+
+        async def _renew(token: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+            result = {"token_reference_id": token["token_reference_id"], "card_identifier": token["card_identifier"]}
+            if self.action != "renew":
+                TOKEN_EXPIRY_SWEPT.inc("flagged")
+                return {**result, "reason": f"expires {token['token_expiry_date']}"}
+            async with semaphore:
+                if rejections:
+                    return None
+                try:
+                    response = await visa_service.renew_token(token["token_reference_id"])
+                except UpstreamUnavailable as e:
+                    rejections.append(e)
+                    return None
+                except Exception as e:
+                    logger.error(f"Renewal failed for token {token['token_reference_id']}: {str(e)}")
+                    TOKEN_EXPIRY_SWEPT.inc("flagged")
+                    return {**result, "reason": f"renewal failed: {str(e)}"}
+            if response.get("renewalResult") != "SUCCESS" or not response.get("tokenExpiryDate"):
+                TOKEN_EXPIRY_SWEPT.inc("flagged")
+                return {**result, "reason": f"renewal result {response.get('renewalResult')}"}
+            TOKEN_EXPIRY_SWEPT.inc("renewed")
+            return {**result, "token_expiry_date": response["tokenExpiryDate"]}
+
+        # Off-peak batch work: queue for Visa TMS rate limit tokens
+        with rate_limit_wait():
+            results = list(await asyncio.gather(*(_renew(token) for token in batch)))
+        if rejections:
+            return results, rejections[0]
+        if self.rate > 0:
+            await asyncio.sleep(max(0.0, len(batch) / self.rate - (loop.time() - started)))
+        return results, None
+
+    async def status(self) -> Optional[Dict[str, Any]]:
+        return await self._checkpoints.find_one({"_id": CHECKPOINT_ID}, {"_id": 0})
+
+
+# Shared sweeper instance; bound to the database and started in server.py
+token_expiry_sweeper = TokenExpirySweeper()
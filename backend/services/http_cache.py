@@ -0,0 +1,76 @@
+"""
+HTTP conditional caching
+For responses that only change when their underlying data does (card
+details, the merchant catalog) the JSON body is serialized once per data
+version together with a strong ETag. Requests whose If-None-Match matches
+get an empty 304; the rest get the stored bytes. Neither path encodes JSON.
+"""
+
+import hashlib
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from fastapi import Request
+from fastapi.responses import Response
+
+from services.serialization import dump_json
+
+
+class Representation:
+    """
+    A serialized JSON body and its strong ETag
+    """
+
+    __slots__ = ("body", "etag")
+
+    def __init__(self, content: Any, tag: str = ""):
+        self.body = dump_json(content)
+        digest = hashlib.sha256(self.body).hexdigest()[:32]
+        self.etag = f'"{tag}-{digest}"' if tag else f'"{digest}"'
+
+
+class RepresentationCache:
+    """
+    Keeps the Representation for the current data version; `version` is any
+    hashable value that changes whenever the content does
+    """
+
+    def __init__(self):
+        self._version: Optional[Hashable] = None
+        self._representation: Optional[Representation] = None
+
+    def get(self, version: Hashable, build: Callable[[], Representation]) -> Representation:
+        if self._representation is None or self._version != version:
+            self._representation = build()
+            self._version = version
+        return self._representation
+
+    def invalidate(self) -> None:
+        self._representation = None
+        self._version = None
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    If-None-Match uses weak comparison, so W/"x" matches "x"
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def conditional_response(request: Request, representation: Representation, cache_control: str) -> Response:
+    """
+    304 if the client already holds this representation, otherwise the body
+    """
+    headers: Dict[str, str] = {"ETag": representation.etag, "Cache-Control": cache_control}
+    if etag_matches(request.headers.get("if-none-match"), representation.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=representation.body, media_type="application/json", headers=headers)
@@ -0,0 +1,200 @@
+"""
+Idempotency keys
+Stores the first response for each Idempotency-Key in MongoDB (expired by a
+TTL index) and replays it byte for byte for retries. Concurrent duplicates
+share the in-flight call: in-process through a shared future, across
+workers by waiting on the key's IN_PROGRESS lease.
+"""
+
+import asyncio
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse, Response
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+
+from services.config import env_float, env_int
+
+logger = logging.getLogger(__name__)
+
+STATE_IN_PROGRESS = "IN_PROGRESS"
+STATE_COMPLETED = "COMPLETED"
+
+REPLAY_HEADER = "Idempotent-Replayed"
+
+
+def request_fingerprint(*parts: Any) -> str:
+    """
+    Stable hash of what makes two requests "the same" (path, body, ...)
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class IdempotencyStore:
+    """
+    Idempotency records in the `idempotency_keys` collection
+    A record is claimed (IN_PROGRESS with a lease) before the handler runs and
+    completed with the handler's status, headers and body afterwards. 5xx
+    outcomes release the claim so the client can retry for real.
+    """
+
+    def __init__(self, collection_name: str = "idempotency_keys"):
+        self.collection_name = collection_name
+        self.ttl_seconds = env_int("IDEMPOTENCY_KEY_TTL_SECONDS", 24 * 3600)
+        self.lease_seconds = env_float("IDEMPOTENCY_LEASE_SECONDS", 60.0)
+        self.wait_seconds = env_float("IDEMPOTENCY_WAIT_SECONDS", 30.0)
+        self.poll_interval = 0.1
+        self._db = None
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    async def init(self, db) -> None:
+        self._db = db
+        await db[self.collection_name].create_index(
+            [("created_at", ASCENDING)], expireAfterSeconds=self.ttl_seconds
+        )
+
+    @property
+    def _records(self):
+        if self._db is None:
+            raise RuntimeError("IdempotencyStore has not been initialised")
+        return self._db[self.collection_name]
+
+    async def run(self, key: str, fingerprint: str, handler: Callable[[], Awaitable[Response]]) -> Response:
+        """
+        Return the stored response for `key`, or run `handler` once and store it
+        """
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            record = await asyncio.shield(inflight)
+            return self._replay(record, fingerprint)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            record = await self._run_once(key, fingerprint, handler)
+            future.set_result(record)
+        except BaseException as e:
+            future.set_exception(e)
+            # Retrieve the exception so a future nobody awaited does not warn
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+        if record.get("replayed"):
+            return self._replay(record, fingerprint)
+        return self._to_response(record)
+
+    async def _run_once(self, key: str, fingerprint: str, handler: Callable[[], Awaitable[Response]]) -> Dict[str, Any]:
+        while not await self._claim(key, fingerprint):
+            existing = await self._wait_for_completion(key)
+            if existing is not None:
+                return {**existing, "replayed": True}
+            # The other holder's lease ran out (take over the key) or it
+            # released the key after a 5xx (claim it afresh)
+            if await self._take_over(key, fingerprint):
+                break
+
+        try:
+            response = await handler()
+        except HTTPException as e:
+            response = JSONResponse({"detail": e.detail}, status_code=e.status_code, headers=e.headers)
+        except BaseException:
+            await self._release(key)
+            raise
+
+        record = {
+            "fingerprint": fingerprint,
+            "status_code": response.status_code,
+            "headers": {
+                name: value for name, value in response.headers.items()
+                if name.lower() != "content-length"
+            },
+            "body": bytes(response.body),
+        }
+        if response.status_code >= 500:
+            await self._release(key)
+        else:
+            await self._records.update_one(
+                {"_id": key},
+                {"$set": {**record, "state": STATE_COMPLETED, "completed_at": datetime.utcnow()}}
+            )
+        return record
+
+    async def _claim(self, key: str, fingerprint: str) -> bool:
+        now = datetime.utcnow()
+        try:
+            await self._records.insert_one({
+                "_id": key,
+                "fingerprint": fingerprint,
+                "state": STATE_IN_PROGRESS,
+                "created_at": now,
+                "lease_expires_at": now + timedelta(seconds=self.lease_seconds),
+            })
+            return True
+        except DuplicateKeyError:
+            return False
+
+    async def _take_over(self, key: str, fingerprint: str) -> bool:
+        now = datetime.utcnow()
+        result = await self._records.update_one(
+            {"_id": key, "state": STATE_IN_PROGRESS, "lease_expires_at": {"$lt": now}},
+            {"$set": {
+                "fingerprint": fingerprint,
+                "lease_expires_at": now + timedelta(seconds=self.lease_seconds),
+            }}
+        )
+        return result.modified_count == 1
+
+    async def _release(self, key: str) -> None:
+        try:
+            await self._records.delete_one({"_id": key, "state": STATE_IN_PROGRESS})
+        except Exception as e:
+            logger.error(f"Failed to release idempotency key {key}: {str(e)}")
+
+    async def _wait_for_completion(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        Poll a key claimed elsewhere until it completes, its lease expires or
+        wait_seconds pass; returns the completed record or None
+        """
+        deadline = asyncio.get_running_loop().time() + self.wait_seconds
+        while True:
+            record = await self._records.find_one({"_id": key})
+            if record is None:
+                return None
+            if record["state"] == STATE_COMPLETED:
+                return record
+            if record["lease_expires_at"] < datetime.utcnow():
+                return None
+            if asyncio.get_running_loop().time() >= deadline:
+                raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is already in progress")
+            await asyncio.sleep(self.poll_interval)
+
+    def _replay(self, record: Dict[str, Any], fingerprint: str) -> Response:
+        if record["fingerprint"] != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+        response = self._to_response(record)
+        response.headers[REPLAY_HEADER] = "true"
+        return response
+
+    @staticmethod
+    def _to_response(record: Dict[str, Any]) -> Response:
+        headers = dict(record["headers"])
+        media_type = headers.pop("content-type", None)
+        return Response(
+            content=record["body"],
+            status_code=record["status_code"],
+            headers=headers,
+            media_type=media_type
+        )
+
+
+idempotency_store = IdempotencyStore()
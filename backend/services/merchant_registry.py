@@ -0,0 +1,137 @@
+"""
+Merchant app registry
+Indexed, hot-reloadable view of the merchant app catalog stored in MongoDB.
+Lookups by app id, Visa merchant id and name are O(1) dict hits against an
+immutable snapshot that is swapped atomically on reload.
+"""
+
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from pymongo.errors import PyMongoError
+
+from services.mock_data import MERCHANT_APPS
+
+logger = logging.getLogger(__name__)
+
+
+class MerchantSnapshot:
+    """
+    Immutable catalog snapshot with precomputed indexes and listing payload
+    """
+
+    def __init__(self, apps: Iterable[Dict[str, Any]], version: int):
+        self.apps: Tuple[Dict[str, Any], ...] = tuple(sorted(apps, key=lambda app: app["id"]))
+        self.version = version
+        self.loaded_at = datetime.utcnow()
+        self.by_id = {app["id"]: app for app in self.apps}
+        self.by_merchant_id = {app["merchant_id"]: app for app in self.apps}
+        self.by_name = {app["name"]: app for app in self.apps}
+        self.listing = {
+            "merchants": list(self.apps),
+            "total_count": len(self.apps)
+        }
+
+
+class MerchantRegistry:
+    """
+    Merchant catalog backed by the `merchant_apps` collection.
+    Starts from the built-in MERCHANT_APPS so lookups work before load() runs.
+    """
+
+    def __init__(self, collection_name: str = "merchant_apps"):
+        self.collection_name = collection_name
+        self._db = None
+        self._snapshot = MerchantSnapshot(MERCHANT_APPS, version=0)
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    @property
+    def snapshot(self) -> MerchantSnapshot:
+        return self._snapshot
+
+    def get(self, app_id: int) -> Optional[Dict[str, Any]]:
+        return self._snapshot.by_id.get(app_id)
+
+    def get_by_merchant_id(self, merchant_id: str) -> Optional[Dict[str, Any]]:
+        return self._snapshot.by_merchant_id.get(merchant_id)
+
+    def get_by_name(self, name: str) -> Optional[Dict[str, Any]]:
+        return self._snapshot.by_name.get(name)
+
+    def resolve(self, app_ids: Iterable[int]) -> Tuple[List[Dict[str, Any]], List[int]]:
+        """
+        Map app ids to merchant apps, returning (apps, invalid_ids)
+        Duplicate ids are collapsed; request order is preserved.
+        """
+        by_id = self._snapshot.by_id
+        apps, invalid_ids, seen = [], [], set()
+        for app_id in app_ids:
+            if app_id in seen:
+                continue
+            seen.add(app_id)
+            app = by_id.get(app_id)
+            if app is None:
+                invalid_ids.append(app_id)
+            else:
+                apps.append(app)
+        return apps, invalid_ids
+
+    async def load(self, db) -> MerchantSnapshot:
+        """
+        Bind the registry to a database, seeding the catalog on first run
+        """
+        self._db = db
+        collection = db[self.collection_name]
+        try:
+            await collection.create_index("id", unique=True)
+            if await collection.estimated_document_count() == 0:
+                await collection.insert_many([dict(app) for app in MERCHANT_APPS])
+                logger.info(f"Seeded {len(MERCHANT_APPS)} merchant apps into {self.collection_name}")
+            return await self.reload()
+        except PyMongoError as e:
+            logger.error(f"Failed to load merchant registry, serving built-in catalog: {str(e)}")
+            return self._snapshot
+
+    async def reload(self) -> MerchantSnapshot:
+        """
+        Re-read the catalog from MongoDB and swap in a new snapshot if it changed
+        """
+        if self._db is None:
+            raise RuntimeError("MerchantRegistry has not been loaded")
+
+        apps = await self._db[self.collection_name].find({}, {"_id": 0}).to_list(None)
+        if tuple(sorted(apps, key=lambda app: app["id"])) == self._snapshot.apps:
+            # Unchanged: keep the version so cached listings and ETags stay valid
+            return self._snapshot
+        self._snapshot = MerchantSnapshot(apps, version=self._snapshot.version + 1)
+        logger.info(f"Merchant registry loaded {len(apps)} apps (version {self._snapshot.version})")
+        return self._snapshot
+
+    def start_auto_reload(self, interval_seconds: float) -> None:
+        """
+        Periodically reload the catalog so edits show up without a restart
+        """
+        if interval_seconds <= 0 or self._refresh_task is not None:
+            return
+
+        async def _refresh_loop():
+            while True:
+                await asyncio.sleep(interval_seconds)
+                try:
+                    await self.reload()
+                except Exception as e:
+                    logger.error(f"Merchant registry reload failed: {str(e)}")
+
+        self._refresh_task = asyncio.create_task(_refresh_loop())
+
+    async def stop(self) -> None:
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            await asyncio.gather(self._refresh_task, return_exceptions=True)
+            self._refresh_task = None
+
+
+# Shared registry instance; loaded from MongoDB in server.py
+merchant_registry = MerchantRegistry()
@@ -0,0 +1,55 @@
+"""
+Keyset pagination helpers
+Cursors are opaque, URL-safe tokens wrapping the sort key of the last row
+returned, so the next page is a range query on an index instead of a skip.
+"""
+
+import base64
+import json
+from datetime import datetime
+from typing import Any, List
+
+
+def encode_cursor(values: List[Any]) -> str:
+    """
+    Encode the sort key of the last returned row into an opaque cursor
+    """
+    payload = [
+        {"$dt": value.isoformat()} if isinstance(value, datetime) else value
+        for value in values
+    ]
+    raw = json.dumps(payload, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, size: int) -> List[Any]:
+    """
+    Decode a cursor produced by encode_cursor
+    Raises ValueError when the cursor is malformed. Values go straight into
+    query filters, so anything but a scalar (a dict or list could smuggle
+    in an operator such as {"$ne": null}) is rejected.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        payload = json.loads(raw)
+    except (ValueError, TypeError) as e:
+        raise ValueError("Invalid pagination cursor") from e
+
+    if not isinstance(payload, list) or len(payload) != size:
+        raise ValueError("Invalid pagination cursor")
+
+    return [_decode_value(value) for value in payload]
+
+
+def _decode_value(value: Any) -> Any:
+    if isinstance(value, dict):
+        if set(value) != {"$dt"} or not isinstance(value["$dt"], str):
+            raise ValueError("Invalid pagination cursor")
+        try:
+            return datetime.fromisoformat(value["$dt"])
+        except ValueError as e:
+            raise ValueError("Invalid pagination cursor") from e
+    # None is what encode_cursor writes for a missing sort key
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    raise ValueError("Invalid pagination cursor")
@@ -0,0 +1,252 @@
+"""
+Partitioned storage
+Token and transaction data are spread over several MongoDB databases
+(usually on separate clusters) by a consistent hash of card_identifier, so
+a card's documents, counters and pages all live on one partition and
+per-card reads and writes touch only that partition. Lookups that only
+have a token or transaction id scatter to every partition.
+
+Each partition owns `vnodes` points on the hash ring, so adding or removing
+a partition only reassigns the cards between it and its ring neighbours.
+After changing MONGO_PARTITIONS run rebalance_partitions.py to move those
+cards; until it finishes, their listings can be incomplete.
+"""
+
+import asyncio
+import bisect
+import hashlib
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+def _ring_hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+
+def _database_key(url: str, default_database: Optional[str]) -> Tuple[str, Tuple[str, ...], Optional[str]]:
+    """
+    (scheme, hosts, database) of a MongoDB URL, to spot two partitions that
+    are really the same database
+    """
+    scheme, _, rest = url.partition("://")
+    hosts, _, path = rest.partition("/")
+    hosts = hosts.partition("?")[0].rpartition("@")[2].lower()
+    if scheme.lower() == "mongodb":
+        hosts = ",".join(host if ":" in host else f"{host}:27017" for host in hosts.split(","))
+    return scheme.lower(), tuple(sorted(hosts.split(","))), path.partition("?")[0] or default_database
+
+
+def parse_partition_spec(
+    spec: str, primary_url: Optional[str] = None, default_database: Optional[str] = None
+) -> List[Tuple[str, Optional[str]]]:
+    """
+    Parse MONGO_PARTITIONS ("p0,p1=mongodb://host-b:27017/cards") into
+    (name, url) pairs; a name without a URL lives on the primary database
+    (primary_url). Two partitions on the same database are rejected: they
+    would share their data, and rebalancing one into the other deletes it.
+    """
+    partitions = []
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        name, _, url = entry.partition("=")
+        name = name.strip()
+        if not name:
+            raise ValueError(f"Partition entry '{entry}' has no name")
+        partitions.append((name, url.strip() or None))
+    names = [name for name, _ in partitions]
+    if not names:
+        raise ValueError("MONGO_PARTITIONS does not name any partition")
+    if len(set(names)) != len(names):
+        raise ValueError("MONGO_PARTITIONS has duplicate partition names")
+    databases: Dict[Any, str] = {}
+    for name, url in partitions:
+        target = url or primary_url
+        key = _database_key(target, default_database) if target else None
+        if key in databases:
+            raise ValueError(f"MONGO_PARTITIONS puts partitions '{databases[key]}' and '{name}' on the same database")
+        databases[key] = name
+    return partitions
+
+
+class Partition:
+    """
+    One partition's database; `client` is set when the router owns (and
+    closes) a dedicated client for it
+    """
+
+    __slots__ = ("name", "db", "client")
+
+    def __init__(self, name: str, db, client=None):
+        self.name = name
+        self.db = db
+        self.client = client
+
+    def same_database(self, other: "Partition") -> bool:
+        if self.db is other.db:
+            return True
+        return self.db.name == other.db.name and self.db.client.address == other.db.client.address
+
+
+class HashRing:
+    """
+    Consistent hash ring over partition names
+    """
+
+    def __init__(self, names: Iterable[str], vnodes: int = 64):
+        points = sorted(
+            (_ring_hash(f"{name}#{replica}"), name)
+            for name in names
+            for replica in range(vnodes)
+        )
+        if not points:
+            raise ValueError("HashRing needs at least one partition")
+        self._hashes = [point for point, _ in points]
+        self._names = [name for _, name in points]
+
+    def owner(self, key: str) -> str:
+        index = bisect.bisect(self._hashes, _ring_hash(key))
+        return self._names[index % len(self._names)]
+
+
+class PartitionRouter:
+    """
+    Routes card_identifier keys to partitions and runs the cross-partition
+    operations (scatter lookups, full scans, rebalancing)
+    """
+
+    def __init__(self, partitions: List[Partition], vnodes: int = 64):
+        if not partitions:
+            raise ValueError("PartitionRouter needs at least one partition")
+        self.partitions = list(partitions)
+        self._by_name = {partition.name: partition for partition in self.partitions}
+        self._ring = HashRing(self._by_name, vnodes=vnodes)
+
+    @classmethod
+    def single(cls, db) -> "PartitionRouter":
+        """
+        Everything on one database (the unpartitioned default)
+        """
+        return cls([Partition("default", db)], vnodes=1)
+
+    @property
+    def names(self) -> List[str]:
+        return [partition.name for partition in self.partitions]
+
+    def partition(self, name: str) -> Partition:
+        return self._by_name[name]
+
+    def for_key(self, key: str) -> Partition:
+        if len(self.partitions) == 1:
+            return self.partitions[0]
+        return self._by_name[self._ring.owner(key)]
+
+    def collection(self, key: str, name: str):
+        return self.for_key(key).db[name]
+
+    async def each(self, func: Callable[[Partition], Awaitable[Any]]) -> List[Any]:
+        """
+        Run func against every partition concurrently, results in partition order
+        """
+        return list(await asyncio.gather(*(func(partition) for partition in self.partitions)))
+
+    async def find_one_any(self, name: str, query: Dict[str, Any], projection: Optional[Dict[str, Any]] = None):
+        """
+        First match for a query that does not carry the routing key
+        """
+        for document in await self.each(lambda partition: partition.db[name].find_one(query, projection)):
+            if document is not None:
+                return document
+        return None
+
+    async def scan_all(
+        self,
+        name: str,
+        query: Optional[Dict[str, Any]] = None,
+        projection: Optional[Dict[str, Any]] = None,
+        batch_size: int = 500,
+    ) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+        """
+        Yield (partition_name, document) for every match on every partition,
+        one partition at a time from batched cursors; for admin jobs
+        """
+        for partition in self.partitions:
+            cursor = partition.db[name].find(query or {}, projection).batch_size(batch_size)
+            try:
+                async for document in cursor:
+                    yield partition.name, document
+            finally:
+                await cursor.close()
+
+    async def rebalance(
+        self,
+        name: str,
+        key_field: str,
+        batch_size: int = 500,
+        on_moved: Optional[Callable[[Partition, Partition, List[Any]], Awaitable[None]]] = None,
+    ) -> Dict[str, int]:
+        """
+        Move every document of `name` whose key_field hashes to another
+        partition over to its owner
+        Documents are copied before they are deleted, and a copy that is
+        already there counts as moved, so an interrupted run can simply be
+        repeated. on_moved(source, target, keys) runs after each batch.
+        Returns the number of documents moved into each partition.
+        """
+        moved = {partition.name: 0 for partition in self.partitions}
+        if len(self.partitions) == 1:
+            return moved
+
+        for source in self.partitions:
+            # A document is never "moved" within one database: the copy would
+            # land in the collection it is then deleted from
+            colocated = {partition.name for partition in self.partitions if partition.same_database(source)}
+            misplaced: Dict[str, List[Dict[str, Any]]] = {}
+            cursor = source.db[name].find({}).batch_size(batch_size)
+            try:
+                async for document in cursor:
+                    target = self.for_key(str(document[key_field]))
+                    if target.name in colocated:
+                        continue
+                    batch = misplaced.setdefault(target.name, [])
+                    batch.append(document)
+                    if len(batch) >= batch_size:
+                        moved[target.name] += await self._move(name, key_field, source, target, batch, on_moved)
+                        misplaced[target.name] = []
+            finally:
+                await cursor.close()
+            for target_name, batch in misplaced.items():
+                if batch:
+                    moved[target_name] += await self._move(
+                        name, key_field, source, self._by_name[target_name], batch, on_moved
+                    )
+
+        logger.info(f"Rebalanced {name}: {moved}")
+        return moved
+
+    async def _move(self, name, key_field, source, target, documents, on_moved) -> int:
+        try:
+            await target.db[name].insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(error.get("code") != DUPLICATE_KEY_ERROR for error in errors):
+                raise
+        await source.db[name].delete_many({"_id": {"$in": [document["_id"] for document in documents]}})
+        if on_moved is not None:
+            await on_moved(source, target, list({document[key_field] for document in documents}))
+        return len(documents)
+
+    async def ping(self) -> None:
+        await self.each(lambda partition: partition.db.command("ping"))
+
+    def close(self) -> None:
+        for partition in self.partitions:
+            if partition.client is not None:
+                partition.client.close()
@@ -0,0 +1,260 @@
+"""
+Push provisioning jobs
+The provisioning workflow shared by the sync and async endpoints, a MongoDB
+job store recording per-merchant progress, and a bounded in-process worker
+pool that runs queued jobs off the request path.
+"""
+
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from pymongo import ASCENDING
+
+from models.token_models import (
+    PushProvisioningResponse, PushProvisioningResult, TokenStatus, ProvisioningStatus
+)
+from services.config import env_int
+from services.mock_data import MOCK_CARD_DATA
+from services.rate_limit import rate_limit_wait
+from services.token_repository import token_repository
+from services.visa_service import visa_service
+
+logger = logging.getLogger(__name__)
+
+# Job lifecycle: QUEUED -> IN_PROGRESS -> COMPLETED | PARTIAL | FAILED
+JOB_QUEUED = "QUEUED"
+JOB_IN_PROGRESS = "IN_PROGRESS"
+JOB_COMPLETED = "COMPLETED"
+JOB_PARTIAL = "PARTIAL"
+JOB_FAILED = "FAILED"
+
+
+def _parse_timestamp(value: str) -> datetime:
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def parse_visa_result(result: Dict[str, Any]) -> PushProvisioningResult:
+    """
+    Convert one Visa pushProvisioningResults entry to our API model
+    """
+    return PushProvisioningResult(
+        merchant_id=result["merchantId"],
+        merchant_name=result["merchantName"],
+        token_reference_id=result["tokenReferenceId"],
+        token_status=TokenStatus(result["tokenStatus"]),
+        provisioning_result=ProvisioningStatus(result["provisioningResult"]),
+        token_expiry_date=result["tokenExpiryDate"],
+        created_timestamp=_parse_timestamp(result["createdTimestamp"]),
+        last_updated_timestamp=_parse_timestamp(result["lastUpdatedTimestamp"])
+    )
+
+
+def job_status_for(response: PushProvisioningResponse) -> str:
+    """
+    Final job status from the per-merchant outcomes
+    """
+    outcomes = [result.provisioning_result for result in response.push_provisioning_results]
+    if all(outcome == ProvisioningStatus.SUCCESS for outcome in outcomes):
+        return JOB_COMPLETED
+    if any(outcome == ProvisioningStatus.SUCCESS for outcome in outcomes):
+        return JOB_PARTIAL
+    return JOB_FAILED
+
+
+class ProvisioningJobStore:
+    """
+    Provisioning job documents in the `provisioning_jobs` collection, one per
+    request_id, with a per-merchant result map updated as merchants finish
+    """
+
+    def __init__(self, collection_name: str = "provisioning_jobs"):
+        self.collection_name = collection_name
+        self.ttl_seconds = env_int("PROVISIONING_JOB_TTL_SECONDS", 7 * 24 * 3600)
+        self._db = None
+
+    async def init(self, db) -> None:
+        self._db = db
+        collection = db[self.collection_name]
+        await collection.create_index([("created_timestamp", ASCENDING)], expireAfterSeconds=self.ttl_seconds)
+
+    @property
+    def _jobs(self):
+        if self._db is None:
+            raise RuntimeError("ProvisioningJobStore has not been initialised")
+        return self._db[self.collection_name]
+
+    async def create(self, request_id: str, card_identifier: str, merchant_apps: List[Dict[str, Any]]) -> None:
+        now = datetime.utcnow()
+        await self._jobs.insert_one({
+            "_id": request_id,
+            "card_identifier": card_identifier,
+            "status": JOB_QUEUED,
+            "merchant_ids": [app["merchant_id"] for app in merchant_apps],
+            "merchant_names": {app["merchant_id"]: app["name"] for app in merchant_apps},
+            "results": {},
+            "completed_count": 0,
+            "created_timestamp": now,
+            "last_updated_timestamp": now,
+        })
+
+    async def mark_in_progress(self, request_id: str) -> None:
+        await self._jobs.update_one(
+            {"_id": request_id},
+            {"$set": {"status": JOB_IN_PROGRESS, "last_updated_timestamp": datetime.utcnow()}}
+        )
+
+    async def record_result(self, request_id: str, result: PushProvisioningResult) -> None:
+        finished = result.provisioning_result != ProvisioningStatus.PENDING
+        await self._jobs.update_one(
+            {"_id": request_id},
+            {
+                "$set": {
+                    f"results.{result.merchant_id}": result.model_dump(mode="json"),
+                    "last_updated_timestamp": datetime.utcnow(),
+                },
+                "$inc": {"completed_count": 1 if finished else 0},
+            }
+        )
+
+    async def finish(self, request_id: str, status: str, error: Optional[str] = None) -> None:
+        update = {"status": status, "last_updated_timestamp": datetime.utcnow()}
+        if error:
+            update["error"] = error
+        await self._jobs.update_one({"_id": request_id}, {"$set": update})
+
+    async def get(self, request_id: str) -> Optional[Dict[str, Any]]:
+        return await self._jobs.find_one({"_id": request_id})
+
+
+provisioning_job_store = ProvisioningJobStore()
+
+
+async def run_provisioning(
+    request_id: str,
+    card_identifier: str,
+    merchant_apps: List[Dict[str, Any]],
+    on_result: Optional[Callable[[PushProvisioningResult], Awaitable[None]]] = None,
+) -> PushProvisioningResponse:
+    """
+    Provision tokens for the selected merchants, recording each merchant's
+    outcome in the job store as it completes and persisting minted tokens
+    The job document must already exist (see ProvisioningJobStore.create).
+    A job that fails or is cancelled (e.g. at shutdown) is marked FAILED.
+    """
+    async def _record(raw_result: Dict[str, Any]) -> None:
+        result = parse_visa_result(raw_result)
+        await provisioning_job_store.record_result(request_id, result)
+        if on_result is not None:
+            await on_result(result)
+
+    try:
+        await provisioning_job_store.mark_in_progress(request_id)
+        # Merchants queue for Visa TMS rate limit tokens rather than failing
+        with rate_limit_wait():
+            visa_response = await visa_service.create_push_provisioning_request(
+                card_data=MOCK_CARD_DATA,
+                merchant_apps=merchant_apps,
+                request_id=request_id,
+                on_result=_record
+            )
+
+        response = PushProvisioningResponse(
+            request_id=visa_response["requestId"],
+            status=visa_response["status"],
+            timestamp=_parse_timestamp(visa_response["timestamp"]),
+            push_provisioning_results=[
+                parse_visa_result(result) for result in visa_response["pushProvisioningResults"]
+            ]
+        )
+
+        # Persist the minted tokens so they can be listed and managed later
+        await token_repository.insert_provisioned(card_identifier, response.push_provisioning_results)
+    except asyncio.CancelledError:
+        await provisioning_job_store.finish(request_id, JOB_FAILED, error="provisioning cancelled")
+        raise
+    except Exception as e:
+        await provisioning_job_store.finish(request_id, JOB_FAILED, error=str(e))
+        raise
+
+    await provisioning_job_store.finish(request_id, job_status_for(response))
+    return response
+
+
+class ProvisioningWorkerPool:
+    """
+    Fixed set of worker tasks draining a bounded queue of provisioning jobs
+    submit() never blocks: when the queue is full the caller sheds the request.
+    """
+
+    def __init__(self, workers: Optional[int] = None, queue_size: Optional[int] = None):
+        self.workers = workers or env_int("PROVISIONING_WORKERS", 4)
+        self.queue_size = queue_size or env_int("PROVISIONING_QUEUE_SIZE", 100)
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._tasks = [
+            asyncio.create_task(self._worker(index)) for index in range(self.workers)
+        ]
+        logger.info(f"Provisioning worker pool started ({self.workers} workers, queue size {self.queue_size})")
+
+    async def stop(self, drain_timeout: float = 30.0) -> None:
+        """
+        Let queued jobs finish (up to drain_timeout seconds), then stop the
+        workers; jobs still queued or running by then are marked FAILED
+        """
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Provisioning queue not drained within {drain_timeout}s; {self._queue.qsize()} jobs dropped")
+            while not self._queue.empty():
+                request_id, _, _ = self._queue.get_nowait()
+                try:
+                    await provisioning_job_store.finish(request_id, JOB_FAILED, error="server shutting down")
+                except Exception as e:
+                    logger.error(f"Failed to mark provisioning job {request_id} as failed: {str(e)}")
+                finally:
+                    self._queue.task_done()
+        # Cancelled jobs mark themselves FAILED in run_provisioning
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, request_id: str, card_identifier: str, merchant_apps: List[Dict[str, Any]]) -> bool:
+        """
+        Queue a job that was already created in the job store
+        Returns False when the pool is not running or the queue is full.
+        """
+        if self._queue is None or not self._tasks:
+            return False
+        try:
+            self._queue.put_nowait((request_id, card_identifier, merchant_apps))
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def _worker(self, index: int) -> None:
+        while True:
+            request_id, card_identifier, merchant_apps = await self._queue.get()
+            try:
+                response = await run_provisioning(request_id, card_identifier, merchant_apps)
+                logger.info(f"Provisioning job {request_id} finished with status {response.status} (worker {index})")
+            except Exception as e:
+                logger.error(f"Provisioning job {request_id} failed: {str(e)}")
+            finally:
+                self._queue.task_done()
+
+
+provisioning_worker_pool = ProvisioningWorkerPool()
@@ -0,0 +1,251 @@
+"""
+Outbound rate limiting
+Token buckets that keep calls to an upstream within its contracted rate.
+Each bucket is a GCRA (generic cell rate algorithm) token bucket: its whole
+state is one "theoretical arrival time" (tat), so it can live in process
+memory, in a small file in /dev/shm shared by the workers on a host, or in
+a MongoDB document shared by every host:
+
+- local: per process; the effective rate is rate x worker processes
+- shm:   per host; one flock-guarded 8-byte file per operation
+- mongo: cluster wide; compare-and-set on a `rate_limits` document
+         (uses each host's wall clock, so hosts must be NTP-synced)
+
+A caller either fails fast or waits its turn in a bounded queue (at most
+max_queue waiters, each for at most max_wait seconds). The default is to
+fail fast; code that can afford to wait, such as background jobs, opts in
+with `with rate_limit_wait():`.
+"""
+
+import asyncio
+import contextlib
+import fcntl
+import logging
+import os
+import struct
+import time
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+from pymongo.errors import DuplicateKeyError
+
+from services.metrics import registry as metrics_registry
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_WAIT_SECONDS = metrics_registry.histogram(
+    "upstream_rate_limit_wait_seconds", "Time callers waited for an upstream rate limit token", ("operation",)
+)
+
+_WAIT: ContextVar[bool] = ContextVar("rate_limit_wait", default=False)
+
+
+@contextlib.contextmanager
+def rate_limit_wait(wait: bool = True) -> Iterator[None]:
+    """
+    Make rate-limited calls in this context (and tasks started from it)
+    queue for a token, and guarded calls for a concurrency slot, instead of
+    failing fast
+    """
+    reset = _WAIT.set(wait)
+    try:
+        yield
+    finally:
+        _WAIT.reset(reset)
+
+
+def wait_requested() -> bool:
+    """
+    Whether the current context opted in with rate_limit_wait()
+    """
+    return _WAIT.get()
+
+
+def gcra(tat: float, now: float, interval: float, burst: int, max_wait: float) -> Tuple[Optional[float], float]:
+    """
+    Reserve one token: returns (wait, new_tat), or (None, wait) when the
+    wait would exceed max_wait and nothing was reserved
+    """
+    start = max(tat, now)
+    wait = start - now - (burst - 1) * interval
+    if wait > max_wait:
+        return None, wait
+    return max(0.0, wait), start + interval
+
+
+class LocalBucket:
+    backend = "local"
+
+    def __init__(self, operation: str, rate: float, burst: int):
+        self.interval = 1.0 / rate
+        self.burst = burst
+        self._tat = 0.0
+
+    async def reserve(self, max_wait: float) -> Tuple[Optional[float], float]:
+        wait, value = gcra(self._tat, time.monotonic(), self.interval, self.burst, max_wait)
+        if wait is not None:
+            self._tat = value
+        return wait, value
+
+    async def backoff(self, seconds: float) -> None:
+        self._tat = max(self._tat, time.monotonic() + seconds + (self.burst - 1) * self.interval)
+
+
+class SharedFileBucket:
+    """
+    Bucket state in a file (normally under /dev/shm, i.e. shared memory)
+    updated under an exclusive flock; the lock is held for a read, a few
+    arithmetic operations and a write. It is taken non-blocking and retried
+    after a short sleep, so a worker that holds it never stalls another
+    worker's event loop.
+    """
+
+    backend = "shm"
+
+    def __init__(self, operation: str, rate: float, burst: int, path: str, lock_retry_seconds: float = 0.0005):
+        self.interval = 1.0 / rate
+        self.burst = burst
+        self.path = path
+        self.lock_retry_seconds = lock_retry_seconds
+        self._fd: Optional[int] = None
+
+    async def _update(self, func: Callable[[float, float], Tuple[Any, Optional[float]]]) -> Any:
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        # Nothing awaits while the lock is held, so this process never
+        # contends with itself; only other workers make us retry
+        while True:
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                await asyncio.sleep(self.lock_retry_seconds)
+        try:
+            raw = os.pread(self._fd, 8, 0)
+            tat = struct.unpack("d", raw)[0] if len(raw) == 8 else 0.0
+            result, new_tat = func(tat, time.time())
+            if new_tat is not None:
+                os.pwrite(self._fd, struct.pack("d", new_tat), 0)
+            return result
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    async def reserve(self, max_wait: float) -> Tuple[Optional[float], float]:
+        def _reserve(tat, now):
+            wait, value = gcra(tat, now, self.interval, self.burst, max_wait)
+            return (wait, value), (value if wait is not None else None)
+        return await self._update(_reserve)
+
+    async def backoff(self, seconds: float) -> None:
+        floor = seconds + (self.burst - 1) * self.interval
+        await self._update(lambda tat, now: (None, max(tat, now + floor)))
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class MongoBucket:
+    """
+    Bucket state in one document, advanced with compare-and-set
+    """
+
+    backend = "mongo"
+
+    def __init__(self, operation: str, rate: float, burst: int, key: str, collection: Callable[[], Any],
+                 max_attempts: int = 8):
+        self.interval = 1.0 / rate
+        self.burst = burst
+        self.key = key
+        self.collection = collection
+        self.max_attempts = max_attempts
+
+    async def reserve(self, max_wait: float) -> Tuple[Optional[float], float]:
+        collection = self.collection()
+        for _ in range(self.max_attempts):
+            document = await collection.find_one({"_id": self.key})
+            tat = document["tat"] if document else None
+            wait, value = gcra(tat or 0.0, time.time(), self.interval, self.burst, max_wait)
+            if wait is None:
+                return wait, value
+            try:
+                if document is None:
+                    await collection.insert_one({"_id": self.key, "tat": value})
+                    return wait, value
+                result = await collection.update_one({"_id": self.key, "tat": tat}, {"$set": {"tat": value}})
+                if result.modified_count == 1:
+                    return wait, value
+            except DuplicateKeyError:
+                pass
+        # Too contended to get a slot in time; treat as over the limit
+        return None, self.interval
+
+    async def backoff(self, seconds: float) -> None:
+        floor = time.time() + seconds + (self.burst - 1) * self.interval
+        await self.collection().update_one({"_id": self.key}, {"$max": {"tat": floor}}, upsert=True)
+
+
+class RateLimiter:
+    """
+    A bucket plus the bounded wait queue in front of it
+    """
+
+    def __init__(self, operation: str, rate: float, burst: int, bucket, max_wait: float = 5.0, max_queue: int = 100):
+        self.operation = operation
+        self.rate = rate
+        self.burst = burst
+        self.bucket = bucket
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.waiting = 0
+        self.waited = 0
+        self.wait_seconds = 0.0
+        self.rejected = 0
+
+    async def acquire(self) -> Optional[float]:
+        """
+        Take a token, waiting if the caller opted in; returns None when
+        granted or the seconds until a token frees up when rejected
+        """
+        wait_allowed = wait_requested() and self.waiting < self.max_queue
+        wait, value = await self.bucket.reserve(self.max_wait if wait_allowed else 0.0)
+        if wait is None:
+            self.rejected += 1
+            return value
+        if wait > 0:
+            self.waiting += 1
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                self.waiting -= 1
+            self.waited += 1
+            self.wait_seconds += wait
+        RATE_LIMIT_WAIT_SECONDS.observe(wait, self.operation)
+        return None
+
+    async def backoff(self, seconds: float) -> None:
+        """
+        Upstream throttled us (429): hold new calls back for `seconds`
+        """
+        await self.bucket.backoff(seconds)
+
+    def close(self) -> None:
+        """
+        Release the bucket's resources (the shm bucket's file descriptor)
+        """
+        close = getattr(self.bucket, "close", None)
+        if close is not None:
+            close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.bucket.backend,
+            "rate_per_second": self.rate,
+            "burst": self.burst,
+            "waiting": self.waiting,
+            "max_queue": self.max_queue,
+            "waited": self.waited,
+            "average_wait_seconds": self.wait_seconds / self.waited if self.waited else 0.0,
+            "rejected": self.rejected,
+        }
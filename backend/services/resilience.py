@@ -0,0 +1,476 @@
+"""
+Upstream resilience
+Per-operation circuit breakers and adaptive concurrency limits for calls to
+an upstream service (Visa TMS). When an operation keeps failing or getting
+slow its breaker opens and calls are rejected immediately with
+UpstreamUnavailable (mapped to 503 by the routes) instead of piling up on
+the event loop; after open_seconds a few probe calls decide whether it
+closes again. Independently, an AIMD limiter caps concurrent calls per
+operation, growing the cap while calls are fast and cutting it when they
+fail or exceed the latency target, and sheds calls over the cap (callers
+inside rate_limit_wait() queue for a slot instead). An operation can also
+have a token-bucket rate limit (services/rate_limit.py), taken once the
+call holds a concurrency slot so a shed call never spends a token.
+"""
+
+import asyncio
+import functools
+import os
+import re
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+import httpx
+from fastapi import HTTPException
+
+from services.config import env_float, env_int, env_str
+from services.metrics import registry as metrics_registry, render_samples
+from services.rate_limit import LocalBucket, MongoBucket, RateLimiter, SharedFileBucket, wait_requested
+
+STATE_CLOSED = "CLOSED"
+STATE_OPEN = "OPEN"
+STATE_HALF_OPEN = "HALF_OPEN"
+
+_STATE_VALUES = {STATE_CLOSED: 0, STATE_HALF_OPEN: 1, STATE_OPEN: 2}
+
+UPSTREAM_REJECTED = metrics_registry.counter(
+    "upstream_calls_rejected_total", "Upstream calls rejected without being sent", ("operation", "reason")
+)
+
+
+class UpstreamUnavailable(Exception):
+    """
+    An upstream call was rejected by its circuit breaker, concurrency limit
+    or rate limit
+    """
+
+    def __init__(self, operation: str, reason: str, retry_after: float):
+        super().__init__(f"Upstream operation '{operation}' unavailable ({reason}), retry in {retry_after:.1f}s")
+        self.operation = operation
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def service_unavailable(error: UpstreamUnavailable) -> HTTPException:
+    """
+    HTTP 503 with Retry-After for a rejected upstream call
+    """
+    return HTTPException(
+        status_code=503,
+        detail=str(error),
+        headers={"Retry-After": str(max(1, int(error.retry_after + 0.5)))}
+    )
+
+
+def is_upstream_failure(error: BaseException) -> bool:
+    """
+    Whether an exception says something about upstream health; 4xx responses
+    are our request's fault and do not count against the breaker
+    """
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    return isinstance(error, Exception)
+
+
+class CircuitBreaker:
+    """
+    Count-based sliding-window breaker
+    Opens when, over the last window_size calls (and at least minimum_calls),
+    the failure rate or the slow-call rate reaches its threshold. While open
+    every call is rejected; after open_seconds it goes half-open and lets
+    half_open_calls probes through: all succeed -> closed, any fails -> open.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_rate_threshold: float = 0.5,
+        slow_call_seconds: float = 5.0,
+        slow_call_rate_threshold: float = 0.8,
+        window_size: int = 20,
+        minimum_calls: int = 10,
+        open_seconds: float = 30.0,
+        half_open_calls: int = 3,
+    ):
+        self.name = name
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate_threshold = slow_call_rate_threshold
+        self.window_size = window_size
+        self.minimum_calls = minimum_calls
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+
+        self.state = STATE_CLOSED
+        self.opened_at = 0.0
+        self.times_opened = 0
+        # (failed, slow) per recorded call
+        self._window: Deque[Tuple[bool, bool]] = deque(maxlen=window_size)
+        self._probes_started = 0
+        self._probes_succeeded = 0
+
+    def retry_after(self) -> float:
+        return max(0.0, self.opened_at + self.open_seconds - time.monotonic())
+
+    def allow(self) -> bool:
+        """
+        Whether a call may go ahead now; a half-open breaker admits a limited
+        number of probes
+        """
+        if self.state == STATE_OPEN:
+            if self.retry_after() > 0:
+                return False
+            self.state = STATE_HALF_OPEN
+            self._probes_started = 0
+            self._probes_succeeded = 0
+        if self.state == STATE_HALF_OPEN:
+            if self._probes_started >= self.half_open_calls:
+                return False
+            self._probes_started += 1
+        return True
+
+    def abandon(self) -> None:
+        """
+        A call admitted by allow() ended without an outcome (it was
+        cancelled); a half-open breaker gets its probe back
+        """
+        if self.state == STATE_HALF_OPEN and self._probes_started > self._probes_succeeded:
+            self._probes_started -= 1
+
+    def record(self, failed: bool, elapsed: float) -> None:
+        slow = elapsed >= self.slow_call_seconds
+        if self.state == STATE_HALF_OPEN:
+            if failed or slow:
+                self._open()
+                return
+            self._probes_succeeded += 1
+            if self._probes_succeeded >= self.half_open_calls:
+                self.state = STATE_CLOSED
+                self._window.clear()
+            return
+        if self.state == STATE_OPEN:
+            # A call admitted before the breaker opened
+            return
+
+        self._window.append((failed, slow))
+        calls = len(self._window)
+        if calls < self.minimum_calls:
+            return
+        failure_rate = sum(1 for failed_call, _ in self._window if failed_call) / calls
+        slow_rate = sum(1 for _, slow_call in self._window if slow_call) / calls
+        if failure_rate >= self.failure_rate_threshold or slow_rate >= self.slow_call_rate_threshold:
+            self._open()
+
+    def _open(self) -> None:
+        self.state = STATE_OPEN
+        self.opened_at = time.monotonic()
+        self.times_opened += 1
+        self._window.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        calls = len(self._window)
+        return {
+            "state": self.state,
+            "retry_after_seconds": self.retry_after() if self.state == STATE_OPEN else 0.0,
+            "times_opened": self.times_opened,
+            "window_calls": calls,
+            "failure_rate": sum(1 for failed, _ in self._window if failed) / calls if calls else 0.0,
+            "slow_call_rate": sum(1 for _, slow in self._window if slow) / calls if calls else 0.0,
+        }
+
+
+class AIMDLimiter:
+    """
+    Additive-increase / multiplicative-decrease concurrency limit
+    A call that succeeds under latency_target while the limiter is at least
+    half used raises the limit by one; a failed or slow call multiplies it
+    by backoff_ratio. try_acquire() rejects calls over the limit; acquire()
+    queues them (first come, first served) for a bounded time.
+    """
+
+    def __init__(
+        self,
+        initial_limit: int = 20,
+        min_limit: int = 1,
+        max_limit: int = 200,
+        latency_target: float = 1.0,
+        backoff_ratio: float = 0.9,
+    ):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.backoff_ratio = backoff_ratio
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.in_flight = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    def try_acquire(self) -> bool:
+        if self._waiters or self.in_flight >= int(self.limit):
+            return False
+        self.in_flight += 1
+        return True
+
+    async def acquire(self, timeout: float) -> bool:
+        """
+        Take a slot, waiting up to timeout seconds for one to free up
+        """
+        if self.try_acquire():
+            return True
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            return await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            # A slot handed over just as the wait timed out is still ours
+            return waiter.done() and not waiter.cancelled()
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.abandon()
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    def abandon(self) -> None:
+        """
+        Give back a slot whose call was never made
+        """
+        self.in_flight -= 1
+        self._hand_over()
+
+    def release(self, failed: bool, elapsed: float) -> None:
+        in_flight = self.in_flight
+        self.in_flight -= 1
+        if failed or elapsed > self.latency_target:
+            self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+        elif in_flight * 2 >= int(self.limit):
+            self.limit = min(self.max_limit, self.limit + 1)
+        self._hand_over()
+
+    def _hand_over(self) -> None:
+        """
+        Pass free slots straight to queued callers, oldest first
+        """
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"limit": int(self.limit), "in_flight": self.in_flight, "waiting": len(self._waiters)}
+
+
+def throttled_for(error: BaseException) -> Optional[float]:
+    """
+    Seconds the upstream asked us to back off for, if it answered 429
+    """
+    if isinstance(error, httpx.HTTPStatusError) and error.response.status_code == 429:
+        try:
+            return float(error.response.headers.get("Retry-After", 1))
+        except ValueError:
+            return 1.0
+    return None
+
+
+class UpstreamGuard:
+    """
+    Circuit breaker, concurrency limiter and optional rate limiter for one
+    upstream operation
+    """
+
+    def __init__(self, operation: str, breaker: CircuitBreaker, limiter: AIMDLimiter,
+                 rate_limiter: Optional[RateLimiter] = None, max_wait: float = 5.0):
+        self.operation = operation
+        self.breaker = breaker
+        self.limiter = limiter
+        self.rate_limiter = rate_limiter
+        self.max_wait = max_wait
+        self.rejected = 0
+
+    def check(self) -> None:
+        """
+        Fail fast if the breaker is open, without taking a slot
+        """
+        if self.breaker.state == STATE_OPEN and self.breaker.retry_after() > 0:
+            self._reject("circuit_open", self.breaker.retry_after())
+
+    async def call(self, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        # Don't queue for a slot or a token on a call the breaker would reject
+        self.check()
+        if wait_requested():
+            acquired = await self.limiter.acquire(self.max_wait)
+        else:
+            acquired = self.limiter.try_acquire()
+        if not acquired:
+            self._reject("concurrency_limit", 1.0)
+        if self.rate_limiter is not None:
+            try:
+                retry_after = await self.rate_limiter.acquire()
+            except BaseException:
+                self.limiter.abandon()
+                raise
+            if retry_after is not None:
+                self.limiter.abandon()
+                self._reject("rate_limited", retry_after)
+        if not self.breaker.allow():
+            self.limiter.abandon()
+            self._reject("circuit_open", self.breaker.retry_after() or 1.0)
+
+        start = time.monotonic()
+        failed = cancelled = False
+        try:
+            return await func(*args, **kwargs)
+        except asyncio.CancelledError:
+            # Cancelled at a deadline: only its latency says anything, and
+            # it is no evidence that the upstream is healthy
+            cancelled = True
+            raise
+        except BaseException as e:
+            failed = is_upstream_failure(e)
+            backoff = throttled_for(e)
+            if backoff is not None and self.rate_limiter is not None:
+                await self.rate_limiter.backoff(backoff)
+            raise
+        finally:
+            elapsed = time.monotonic() - start
+            self.limiter.release(failed, elapsed)
+            if cancelled:
+                self.breaker.abandon()
+            else:
+                self.breaker.record(failed, elapsed)
+
+    def _reject(self, reason: str, retry_after: float) -> None:
+        self.rejected += 1
+        UPSTREAM_REJECTED.inc(self.operation, reason)
+        raise UpstreamUnavailable(self.operation, reason, retry_after)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "operation": self.operation,
+            "circuit": self.breaker.stats(),
+            "concurrency": self.limiter.stats(),
+            "rate_limit": self.rate_limiter.stats() if self.rate_limiter is not None else None,
+            "rejected": self.rejected,
+        }
+
+
+class UpstreamGuards:
+    """
+    Lazily created guard per operation, configured from `<prefix>_BREAKER_*`,
+    `<prefix>_LIMIT_*` and `<prefix>_RATE_*` environment variables
+    """
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self._guards: Dict[str, UpstreamGuard] = {}
+        self._db = None
+        metrics_registry.add_collector(self._collect_metrics)
+
+    def bind(self, db) -> None:
+        """
+        Database holding shared rate limit state (RATE_BACKEND=mongo)
+        """
+        self._db = db
+
+    def _rate_limits(self):
+        if self._db is None:
+            raise RuntimeError(f"{self.prefix} rate limits use MongoDB but no database is bound")
+        return self._db["rate_limits"]
+
+    def get(self, operation: str) -> UpstreamGuard:
+        guard = self._guards.get(operation)
+        if guard is None:
+            guard = self._guards[operation] = self._create(operation)
+        return guard
+
+    def check(self, operation: str) -> None:
+        self.get(operation).check()
+
+    def _create(self, operation: str) -> UpstreamGuard:
+        prefix = self.prefix
+        breaker = CircuitBreaker(
+            operation,
+            failure_rate_threshold=env_float(f"{prefix}_BREAKER_FAILURE_RATE", 0.5),
+            slow_call_seconds=env_float(f"{prefix}_BREAKER_SLOW_CALL_SECONDS", 5.0),
+            slow_call_rate_threshold=env_float(f"{prefix}_BREAKER_SLOW_CALL_RATE", 0.8),
+            window_size=env_int(f"{prefix}_BREAKER_WINDOW", 20),
+            minimum_calls=env_int(f"{prefix}_BREAKER_MIN_CALLS", 10),
+            open_seconds=env_float(f"{prefix}_BREAKER_OPEN_SECONDS", 30.0),
+            half_open_calls=env_int(f"{prefix}_BREAKER_HALF_OPEN_CALLS", 3),
+        )
+        limiter = AIMDLimiter(
+            initial_limit=env_int(f"{prefix}_LIMIT_INITIAL", 20),
+            min_limit=env_int(f"{prefix}_LIMIT_MIN", 2),
+            max_limit=env_int(f"{prefix}_LIMIT_MAX", 200),
+            latency_target=env_float(f"{prefix}_LIMIT_LATENCY_TARGET", 2.0),
+        )
+        return UpstreamGuard(
+            operation, breaker, limiter, self._create_rate_limiter(operation),
+            max_wait=env_float(f"{prefix}_LIMIT_MAX_WAIT", 5.0),
+        )
+
+    def _create_rate_limiter(self, operation: str) -> Optional[RateLimiter]:
+        """
+        `<prefix>_RATE_<OPERATION>` (or `<prefix>_RATE` for every operation)
+        calls per second; unset or 0 means unlimited
+        """
+        prefix = self.prefix
+        rate = env_float(f"{prefix}_RATE_{operation.upper()}", env_float(f"{prefix}_RATE", 0.0))
+        if rate <= 0:
+            return None
+        burst = env_int(f"{prefix}_RATE_BURST_{operation.upper()}", env_int(f"{prefix}_RATE_BURST", max(1, int(rate))))
+        backend = env_str(f"{prefix}_RATE_BACKEND", "local")
+        name = re.sub(r"[^A-Za-z0-9_.-]", "_", f"{prefix.lower()}.{operation}")
+        if backend == "local":
+            bucket = LocalBucket(operation, rate, burst)
+        elif backend == "shm":
+            directory = env_str(f"{prefix}_RATE_SHM_DIR", "/dev/shm" if os.path.isdir("/dev/shm") else "/tmp")
+            bucket = SharedFileBucket(operation, rate, burst, os.path.join(directory, f"{name}.bucket"))
+        elif backend == "mongo":
+            bucket = MongoBucket(operation, rate, burst, name, self._rate_limits)
+        else:
+            raise ValueError(f"Unknown {prefix}_RATE_BACKEND '{backend}' (local, shm or mongo)")
+        return RateLimiter(
+            operation, rate, burst, bucket,
+            max_wait=env_float(f"{prefix}_RATE_MAX_WAIT", 5.0),
+            max_queue=env_int(f"{prefix}_RATE_MAX_QUEUE", 100),
+        )
+
+    def close(self) -> None:
+        """
+        Release rate limit resources; called on shutdown
+        """
+        for guard in self._guards.values():
+            if guard.rate_limiter is not None:
+                guard.rate_limiter.close()
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        return [guard.stats() for guard in self._guards.values()]
+
+    def _collect_metrics(self) -> List[str]:
+        guards = list(self._guards.values())
+        return (
+            render_samples("gauge", "upstream_circuit_state", "Breaker state (0 closed, 1 half-open, 2 open)",
+                           ("operation",), {(g.operation,): _STATE_VALUES[g.breaker.state] for g in guards})
+            + render_samples("gauge", "upstream_concurrency_limit", "Current adaptive concurrency limit",
+                             ("operation",), {(g.operation,): int(g.limiter.limit) for g in guards})
+            + render_samples("gauge", "upstream_calls_in_flight", "Upstream calls in flight",
+                             ("operation",), {(g.operation,): g.limiter.in_flight for g in guards})
+            + render_samples("gauge", "upstream_rate_limit_waiting", "Callers queued for a rate limit token",
+                             ("operation",), {(g.operation,): g.rate_limiter.waiting
+                                              for g in guards if g.rate_limiter is not None})
+        )
+
+
+def guarded(operation: str):
+    """
+    Decorator running a method through `self.guards.get(operation)`
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            return await self.guards.get(operation).call(func, self, *args, **kwargs)
+        return wrapper
+    return decorator
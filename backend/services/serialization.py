@@ -0,0 +1,37 @@
+"""
+Fast JSON responses
+FastAPI re-validates a returned model against response_model and then walks
+it with jsonable_encoder before json.dumps. Returning FastJSONResponse skips
+both: pydantic models are written by their compiled pydantic-core
+serializer and anything else by pydantic_core.to_json, both in Rust.
+Routes keep response_model for the OpenAPI schema.
+
+Rows read from our own collections are already in response shape (the
+repositories project exactly the model's fields), so list endpoints encode
+them as plain data instead of building a model per row; with pydantic v2
+that is cheaper than both validation and model_construct.
+"""
+
+from typing import Any
+
+import pydantic_core
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+
+def dump_json(content: Any) -> bytes:
+    """
+    Encode a model (via its compiled serializer) or plain data as JSON bytes
+    """
+    if isinstance(content, BaseModel):
+        return content.__pydantic_serializer__.to_json(content)
+    return pydantic_core.to_json(content)
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSONResponse that encodes with pydantic-core instead of json.dumps
+    """
+
+    def render(self, content: Any) -> bytes:
+        return dump_json(content)
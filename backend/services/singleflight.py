@@ -0,0 +1,77 @@
+"""
+Single-flight request coalescing
+Concurrent calls with the same key share one in-flight call: the first
+caller starts it and every caller that arrives before it finishes awaits
+the same task and receives the same result or exception. Nothing is
+cached; the next call after completion starts a new one.
+
+The shared call runs as its own task, so a caller that is cancelled (for
+example a client that disconnected) does not cancel it for the others.
+"""
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+from services.metrics import registry as metrics_registry
+
+logger = logging.getLogger(__name__)
+
+SINGLEFLIGHT_CALLS = metrics_registry.counter(
+    "singleflight_calls_total", "Coalescable calls by whether they started or joined an in-flight call",
+    ("group", "outcome")
+)
+
+
+class SingleFlight:
+    """
+    Group of coalesced calls, keyed by any hashable value
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+        self.started = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        """
+        Await `func(*args, **kwargs)`, or the identical call already in flight for `key`
+        """
+        task = self._calls.get(key)
+        if task is None:
+            self.started += 1
+            SINGLEFLIGHT_CALLS.inc(self.name, "started")
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        else:
+            self.coalesced += 1
+            SINGLEFLIGHT_CALLS.inc(self.name, "coalesced")
+        return await asyncio.shield(task)
+
+    def forget(self, key: Hashable) -> None:
+        """
+        Stop sharing the in-flight call for `key` (it keeps running for the
+        callers already waiting); use after a write that call may not see
+        """
+        self._calls.pop(key, None)
+
+    def forget_where(self, predicate: Callable[[Hashable], bool]) -> None:
+        for key in [key for key in self._calls if predicate(key)]:
+            del self._calls[key]
+
+    def _finish(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Mark the exception retrieved in case every caller was cancelled
+        if not task.cancelled() and task.exception() is not None:
+            logger.debug(f"{self.name}: call for {key!r} failed: {str(task.exception())}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "in_flight": len(self._calls),
+            "started": self.started,
+            "coalesced": self.coalesced,
+        }
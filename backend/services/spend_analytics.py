@@ -0,0 +1,84 @@
+"""
+Spend analytics
+Per-card spend totals and counts by merchant, type, month and token_used.
+Transactions are aggregated a chunk at a time with pandas group-bys over
+columnar frames, and a card's aggregates are kept as small indexed frames
+that later transactions are added into, so a new transaction costs a
+group-by over the new rows rather than over the whole history.
+"""
+
+from typing import Any, Dict, Iterable, List
+
+import numpy as np
+import pandas as pd
+
+DIMENSIONS = ("merchant", "type", "month", "token_used")
+
+# Transactions that moved no money are left out of the totals
+EXCLUDED_STATUSES = ("failed", "declined")
+
+SPEND_PROJECTION = {"_id": 0, "merchant": 1, "amount": 1, "date": 1, "type": 1, "status": 1, "token_used": 1}
+
+_COLUMNS = ["merchant", "amount", "date", "type", "status", "token_used"]
+
+
+def _frame(documents: List[Dict[str, Any]]) -> pd.DataFrame:
+    frame = pd.DataFrame.from_records(documents, columns=_COLUMNS)
+    frame = frame[~frame["status"].astype(str).str.lower().isin(EXCLUDED_STATUSES)]
+    return pd.DataFrame({
+        "merchant": frame["merchant"].astype(str),
+        "type": frame["type"].astype(str),
+        "month": frame["date"].astype(str).str.slice(0, 7),
+        "token_used": frame["token_used"].fillna(False).astype(bool).map({True: "true", False: "false"}),
+        "amount": pd.to_numeric(frame["amount"]).astype(np.int64),
+    })
+
+
+class SpendSummary:
+    """
+    One card's spend aggregates; add() folds in further transactions
+    """
+
+    def __init__(self):
+        empty = pd.DataFrame({"total_amount": pd.Series(dtype=np.int64), "transaction_count": pd.Series(dtype=np.int64)})
+        self._buckets: Dict[str, pd.DataFrame] = {dimension: empty for dimension in DIMENSIONS}
+        self.total_amount = 0
+        self.transaction_count = 0
+
+    def add(self, documents: Iterable[Dict[str, Any]]) -> None:
+        documents = list(documents)
+        if not documents:
+            return
+        frame = _frame(documents)
+        if frame.empty:
+            return
+
+        self.total_amount += int(frame["amount"].sum())
+        self.transaction_count += len(frame)
+        for dimension in DIMENSIONS:
+            delta = frame.groupby(dimension, sort=False)["amount"].agg(total_amount="sum", transaction_count="size")
+            self._buckets[dimension] = (
+                self._buckets[dimension].add(delta, fill_value=0).astype(np.int64)
+            )
+
+    def buckets(self, dimension: str, by: str = "total_amount") -> List[Dict[str, Any]]:
+        """
+        Rows of one dimension, sorted by `by` ("total_amount" descending or
+        "key" ascending)
+        """
+        table = self._buckets[dimension]
+        table = table.sort_index() if by == "key" else table.sort_values(by, ascending=False, kind="stable")
+        return [
+            {"key": key, "total_amount": int(total), "transaction_count": int(count)}
+            for key, total, count in zip(table.index, table["total_amount"].to_numpy(), table["transaction_count"].to_numpy())
+        ]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "total_amount": self.total_amount,
+            "transaction_count": self.transaction_count,
+            "by_merchant": self.buckets("merchant"),
+            "by_type": self.buckets("type"),
+            "by_month": self.buckets("month", by="key"),
+            "by_token_used": self.buckets("token_used", by="key"),
+        }
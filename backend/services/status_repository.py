@@ -0,0 +1,111 @@
+"""
+Status check repository
+MongoDB persistence for the /api/status client check-ins. Checks expire via
+a TTL index on `timestamp`, which also serves time-window queries; reads
+stream from a batched cursor so a listing never holds the collection in
+memory. With STATUS_CHECK_WRITE_BEHIND enabled, inserts are buffered and
+written in batches, so a check may take up to
+STATUS_CHECK_FLUSH_INTERVAL seconds to show up in listings.
+"""
+
+import logging
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, Optional
+
+from pymongo import ASCENDING, DESCENDING
+
+from services.config import env_bool, env_float, env_int
+from services.write_behind import WriteBehindBuffer
+
+logger = logging.getLogger(__name__)
+
+STATUS_CHECK_PROJECTION = {"_id": 0, "id": 1, "client_name": 1, "timestamp": 1}
+
+
+class StatusCheckRepository:
+    """
+    Stores status checks in the `status_checks` collection
+    """
+
+    def __init__(self, collection_name: str = "status_checks"):
+        self.collection_name = collection_name
+        self.ttl_seconds = env_int("STATUS_CHECK_TTL_SECONDS", 7 * 24 * 3600)
+        self.batch_size = env_int("STATUS_CHECK_BATCH_SIZE", 500)
+        self._db = None
+        self._buffer = None
+        if env_bool("STATUS_CHECK_WRITE_BEHIND", False):
+            self._buffer = WriteBehindBuffer(
+                "status_checks",
+                max_batch=env_int("STATUS_CHECK_FLUSH_SIZE", 500),
+                flush_interval=env_float("STATUS_CHECK_FLUSH_INTERVAL", 0.2),
+                max_pending=env_int("STATUS_CHECK_MAX_PENDING", 10000),
+                enqueue_timeout=env_float("STATUS_CHECK_ENQUEUE_TIMEOUT", 1.0),
+            )
+
+    async def init(self, db) -> None:
+        """
+        Bind the repository to a database and make sure its indexes exist
+        """
+        self._db = db
+        collection = db[self.collection_name]
+        # Expires old checks and serves since/until ranges and the sort
+        await collection.create_index([("timestamp", ASCENDING)], expireAfterSeconds=self.ttl_seconds)
+        await collection.create_index([("client_name", ASCENDING), ("timestamp", DESCENDING)])
+        if self._buffer is not None:
+            self._buffer.start(collection)
+
+    async def close(self) -> None:
+        """
+        Write any buffered checks; called at shutdown
+        """
+        if self._buffer is not None:
+            await self._buffer.stop(timeout=env_float("STATUS_CHECK_FLUSH_TIMEOUT", 10.0))
+
+    @property
+    def _checks(self):
+        if self._db is None:
+            raise RuntimeError("StatusCheckRepository has not been initialised")
+        return self._db[self.collection_name]
+
+    async def insert(self, document: Dict[str, Any]) -> None:
+        """
+        Store a check, or queue it for the next batch in write-behind mode
+        Raises BufferFullError if the buffer stays full past its enqueue timeout.
+        """
+        if self._buffer is not None:
+            await self._buffer.add(document)
+        else:
+            await self._checks.insert_one(document)
+
+    async def iter_checks(
+        self,
+        client_name: Optional[str] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Yield checks newest first, fetched from the server batch_size at a time
+        """
+        query: Dict[str, Any] = {}
+        if client_name is not None:
+            query["client_name"] = client_name
+        if since is not None or until is not None:
+            query["timestamp"] = {}
+            if since is not None:
+                query["timestamp"]["$gte"] = since
+            if until is not None:
+                query["timestamp"]["$lt"] = until
+
+        cursor = self._checks.find(query, STATUS_CHECK_PROJECTION).sort("timestamp", DESCENDING).batch_size(self.batch_size)
+        if limit:
+            cursor = cursor.limit(limit)
+        try:
+            async for document in cursor:
+                yield document
+        finally:
+            await cursor.close()
+
+
+# Shared repository instance; bound to the database in server.py
+status_check_repository = StatusCheckRepository()
@@ -0,0 +1,395 @@
+"""
+Token repository
+MongoDB persistence for provisioned tokens, built on the motor database
+from server.py. Listing is keyset-paginated on
+(card_identifier, token_status, created_timestamp) and per-card counts are
+kept in a counter document so total_count never needs a collection count.
+Tokens and counters are partitioned by card_identifier (see
+services/partitioning.py); lookups by token id scatter to every partition.
+"""
+
+import logging
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, UpdateOne
+
+from models.token_models import PushProvisioningResult, ProvisioningStatus, TokenStatus
+from services.pagination import decode_cursor, encode_cursor
+from services.partitioning import Partition, PartitionRouter
+from services.singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# Statuses returned when the caller does not filter explicitly
+VISIBLE_STATUSES = [TokenStatus.ACTIVE, TokenStatus.INACTIVE, TokenStatus.SUSPENDED]
+
+TOKEN_PROJECTION = {
+    "_id": 0,
+    "token_reference_id": 1,
+    "merchant_id": 1,
+    "merchant_name": 1,
+    "token_status": 1,
+    "created_timestamp": 1,
+    "last_used_timestamp": 1,
+    "token_expiry_date": 1,
+}
+
+
+class TokenRepository:
+    """
+    Stores tokens in the `tokens` collection and per-card status counts in
+    `token_counters`
+    """
+
+    def __init__(self, collection_name: str = "tokens", counters_collection_name: str = "token_counters"):
+        self.collection_name = collection_name
+        self.counters_collection_name = counters_collection_name
+        self._router: Optional[PartitionRouter] = None
+        # Identical concurrent reads (same card, filters and page) share one
+        # query; keys start with the card so writes can stop sharing them
+        self._reads = SingleFlight("token_repository")
+
+    async def init(self, db, router: Optional[PartitionRouter] = None) -> None:
+        """
+        Bind the repository to a database (or to the partitions of `router`)
+        and make sure its indexes exist on each
+        """
+        self._router = router or PartitionRouter.single(db)
+        for partition in self._router.partitions:
+            await self._create_indexes(partition.db[self.collection_name])
+
+    async def _create_indexes(self, collection) -> None:
+        await collection.create_index("token_reference_id", unique=True)
+        # Status-filtered listing: equality on card and status, range/sort on time
+        await collection.create_index([
+            ("card_identifier", ASCENDING),
+            ("token_status", ASCENDING),
+            ("created_timestamp", DESCENDING),
+            ("token_reference_id", DESCENDING),
+        ])
+        # Unfiltered listing for a card
+        await collection.create_index([
+            ("card_identifier", ASCENDING),
+            ("created_timestamp", DESCENDING),
+            ("token_reference_id", DESCENDING),
+        ])
+        # Expiry sweeps: range on expiry, keyset on token id
+        await collection.create_index([
+            ("token_expiry_date", ASCENDING),
+            ("token_reference_id", ASCENDING),
+        ])
+
+    @property
+    def router(self) -> PartitionRouter:
+        if self._router is None:
+            raise RuntimeError("TokenRepository has not been initialised")
+        return self._router
+
+    def _tokens(self, card_identifier: str):
+        return self.router.collection(card_identifier, self.collection_name)
+
+    def _counters(self, card_identifier: str):
+        return self.router.collection(card_identifier, self.counters_collection_name)
+
+    async def insert_provisioned(self, card_identifier: str, results: Iterable[PushProvisioningResult]) -> int:
+        """
+        Persist the tokens minted by a push provisioning request
+        Only successful results carry a token; the rest are skipped.
+        """
+        documents = [
+            {
+                "token_reference_id": result.token_reference_id,
+                "card_identifier": card_identifier,
+                "merchant_id": result.merchant_id,
+                "merchant_name": result.merchant_name,
+                "token_status": result.token_status.value,
+                "created_timestamp": result.created_timestamp,
+                "last_updated_timestamp": result.last_updated_timestamp,
+                "last_used_timestamp": None,
+                "token_expiry_date": result.token_expiry_date,
+            }
+            for result in results
+            if result.provisioning_result == ProvisioningStatus.SUCCESS and result.token_reference_id
+        ]
+        if not documents:
+            return 0
+
+        await self._tokens(card_identifier).insert_many(documents, ordered=False)
+
+        increments: Dict[str, int] = {}
+        for document in documents:
+            key = f"counts.{document['token_status']}"
+            increments[key] = increments.get(key, 0) + 1
+        await self._counters(card_identifier).update_one({"_id": card_identifier}, {"$inc": increments}, upsert=True)
+        self._forget_reads({card_identifier})
+
+        return len(documents)
+
+    async def get(self, token_reference_id: str) -> Optional[Dict[str, Any]]:
+        return await self.router.find_one_any(
+            self.collection_name,
+            {"token_reference_id": token_reference_id},
+            {**TOKEN_PROJECTION, "card_identifier": 1}
+        )
+
+    async def update_status(
+        self,
+        token_reference_id: str,
+        status: TokenStatus,
+        updated_at: Optional[datetime] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Set a token's status and keep the per-card counters in step
+        Returns the previous document, or None if the token is not stored here.
+        """
+        # The token id does not say which partition holds it; at most one matches
+        updated = await self.router.each(lambda partition: partition.db[self.collection_name].find_one_and_update(
+            {"token_reference_id": token_reference_id},
+            {"$set": {
+                "token_status": status.value,
+                "last_updated_timestamp": updated_at or datetime.utcnow(),
+            }},
+            projection={"_id": 0, "card_identifier": 1, "token_status": 1},
+            return_document=ReturnDocument.BEFORE,
+        ))
+        previous = next((document for document in updated if document is not None), None)
+        if previous is None:
+            return None
+
+        if previous["token_status"] != status.value:
+            await self._counters(previous["card_identifier"]).update_one(
+                {"_id": previous["card_identifier"]},
+                {"$inc": {
+                    f"counts.{previous['token_status']}": -1,
+                    f"counts.{status.value}": 1,
+                }},
+                upsert=True,
+            )
+        self._forget_reads({previous["card_identifier"]})
+        return previous
+
+    async def bulk_update_status(self, updates: List[Tuple[str, TokenStatus, datetime]]) -> int:
+        """
+        Apply many (token_reference_id, status, updated_at) changes with one
+        bulk write, adjusting per-card counters with a second one
+        Tokens not stored here are skipped. Returns the number of tokens updated.
+        """
+        if not updates:
+            return 0
+
+        query = {"token_reference_id": {"$in": [token_reference_id for token_reference_id, _, _ in updates]}}
+        found = await self.router.each(lambda partition: partition.db[self.collection_name].find(
+            query, {"_id": 0, "token_reference_id": 1, "card_identifier": 1, "token_status": 1}
+        ).to_list(None))
+        previous: Dict[str, Tuple[Partition, Dict[str, Any]]] = {
+            document["token_reference_id"]: (partition, document)
+            for partition, documents in zip(self.router.partitions, found)
+            for document in documents
+        }
+
+        operations: Dict[str, List[UpdateOne]] = {}
+        cards = set()
+        increments: Dict[str, Dict[str, int]] = {}
+        for token_reference_id, status, updated_at in updates:
+            if token_reference_id not in previous:
+                continue
+            partition, document = previous[token_reference_id]
+            # Conditional on the status we read, so a concurrent change is not double counted
+            operations.setdefault(partition.name, []).append(UpdateOne(
+                {"token_reference_id": token_reference_id, "token_status": document["token_status"]},
+                {"$set": {"token_status": status.value, "last_updated_timestamp": updated_at}}
+            ))
+            cards.add(document["card_identifier"])
+            if document["token_status"] != status.value:
+                card_increments = increments.setdefault(document["card_identifier"], {})
+                for key, delta in ((f"counts.{document['token_status']}", -1), (f"counts.{status.value}", 1)):
+                    card_increments[key] = card_increments.get(key, 0) + delta
+        if not operations:
+            return 0
+
+        results = await self.router.each(lambda partition: self._bulk_write(
+            partition.db[self.collection_name], operations.get(partition.name)
+        ))
+        matched_count = sum(results)
+
+        if matched_count != sum(len(partition_operations) for partition_operations in operations.values()):
+            # Some tokens changed between the read and the write; recount the
+            # affected cards rather than guess which increments still apply
+            logger.warning("Concurrent token updates during bulk write; rebuilding counters")
+            for card_identifier in cards:
+                await self.rebuild_counters(card_identifier)
+            self._forget_reads(cards)
+            return matched_count
+
+        counter_operations: Dict[str, List[UpdateOne]] = {}
+        for card_identifier, card_increments in increments.items():
+            counter_operations.setdefault(self.router.for_key(card_identifier).name, []).append(
+                UpdateOne({"_id": card_identifier}, {"$inc": card_increments}, upsert=True)
+            )
+        await self.router.each(lambda partition: self._bulk_write(
+            partition.db[self.counters_collection_name], counter_operations.get(partition.name)
+        ))
+        self._forget_reads(cards)
+        return matched_count
+
+    @staticmethod
+    async def _bulk_write(collection, operations: Optional[List[UpdateOne]]) -> int:
+        if not operations:
+            return 0
+        result = await collection.bulk_write(operations, ordered=False)
+        return result.matched_count
+
+    async def rebuild_counters(self, card_identifier: str) -> None:
+        """
+        Recompute a card's status counters from the tokens collection
+        """
+        counts = {status.value: 0 for status in TokenStatus}
+        async for row in self._tokens(card_identifier).aggregate([
+            {"$match": {"card_identifier": card_identifier}},
+            {"$group": {"_id": "$token_status", "count": {"$sum": 1}}},
+        ]):
+            counts[row["_id"]] = row["count"]
+        await self._counters(card_identifier).update_one(
+            {"_id": card_identifier}, {"$set": {"counts": counts}}, upsert=True
+        )
+
+    async def rebalance(self, batch_size: int = 500) -> Dict[str, int]:
+        """
+        Move tokens to the partition that now owns their card, then rebuild
+        the moved cards' counters there and drop the stale ones
+        """
+        async def _on_moved(source: Partition, target: Partition, cards: List[str]) -> None:
+            for card_identifier in cards:
+                await self.rebuild_counters(card_identifier)
+            await source.db[self.counters_collection_name].delete_many({"_id": {"$in": cards}})
+            self._forget_reads(set(cards))
+
+        return await self.router.rebalance(
+            self.collection_name, "card_identifier", batch_size=batch_size, on_moved=_on_moved
+        )
+
+    async def expiring_tokens(
+        self,
+        partition_name: str,
+        cutoff: str,
+        after: Optional[Tuple[str, str]] = None,
+        limit: int = 100,
+        unflagged_only: bool = False,
+    ) -> List[Dict[str, Any]]:
+        """
+        One partition's undeleted tokens expiring in or before `cutoff`
+        (YYYYMM), ordered by (token_expiry_date, token_reference_id) and
+        starting after the keyset position `after`; unflagged_only skips
+        tokens that already carry an expiry_flag
+        """
+        query: Dict[str, Any] = {
+            "token_expiry_date": {"$lte": cutoff},
+            "token_status": {"$ne": TokenStatus.DELETED.value},
+        }
+        if unflagged_only:
+            query["expiry_flag"] = {"$exists": False}
+        if after:
+            expiry_date, token_reference_id = after
+            query["$or"] = [
+                {"token_expiry_date": {"$gt": expiry_date, "$lte": cutoff}},
+                {"token_expiry_date": expiry_date, "token_reference_id": {"$gt": token_reference_id}},
+            ]
+        return await self.router.partition(partition_name).db[self.collection_name].find(
+            query, {"_id": 0, "token_reference_id": 1, "card_identifier": 1, "token_expiry_date": 1}
+        ).sort([
+            ("token_expiry_date", ASCENDING),
+            ("token_reference_id", ASCENDING),
+        ]).limit(limit).to_list(limit)
+
+    async def apply_expiry_results(self, results: List[Dict[str, Any]]) -> None:
+        """
+        Record a sweep batch with one bulk write per partition: renewed
+        tokens ({"token_expiry_date": ...}) get their new expiry and lose any
+        flag, the rest ({"reason": ...}) are flagged for follow-up
+        """
+        now = datetime.utcnow()
+        operations: Dict[str, List[UpdateOne]] = {}
+        for result in results:
+            if result.get("token_expiry_date"):
+                update = {
+                    "$set": {"token_expiry_date": result["token_expiry_date"], "last_updated_timestamp": now},
+                    "$unset": {"expiry_flag": ""},
+                }
+            else:
+                update = {"$set": {"expiry_flag": {"reason": result["reason"], "flagged_at": now}}}
+            operations.setdefault(self.router.for_key(result["card_identifier"]).name, []).append(
+                UpdateOne({"token_reference_id": result["token_reference_id"]}, update)
+            )
+        await self.router.each(lambda partition: self._bulk_write(
+            partition.db[self.collection_name], operations.get(partition.name)
+        ))
+        self._forget_reads({result["card_identifier"] for result in results})
+
+    def read_coalescing_stats(self) -> Dict[str, Any]:
+        return self._reads.stats()
+
+    def _forget_reads(self, cards) -> None:
+        self._reads.forget_where(lambda key: key[0] in cards)
+
+    async def list_tokens(
+        self,
+        card_identifier: str,
+        statuses: Optional[List[TokenStatus]] = None,
+        limit: int = 50,
+        cursor: Optional[str] = None,
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        One page of a card's tokens, newest first
+        Returns (tokens, next_cursor); next_cursor is None on the last page.
+        Raises ValueError for a malformed cursor. Callers share the returned
+        list with concurrent identical calls and must not modify it.
+        """
+        statuses = statuses or VISIBLE_STATUSES
+        key = (card_identifier, "list", tuple(status.value for status in statuses), limit, cursor)
+        return await self._reads.do(key, self._find_page, card_identifier, statuses, limit, cursor)
+
+    async def _find_page(
+        self,
+        card_identifier: str,
+        statuses: List[TokenStatus],
+        limit: int,
+        cursor: Optional[str],
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        query: Dict[str, Any] = {
+            "card_identifier": card_identifier,
+            "token_status": {"$in": [status.value for status in statuses]},
+        }
+        if cursor:
+            created_timestamp, token_reference_id = decode_cursor(cursor, 2)
+            query["$or"] = [
+                {"created_timestamp": {"$lt": created_timestamp}},
+                {"created_timestamp": created_timestamp, "token_reference_id": {"$lt": token_reference_id}},
+            ]
+
+        documents = await self._tokens(card_identifier).find(query, TOKEN_PROJECTION).sort([
+            ("created_timestamp", DESCENDING),
+            ("token_reference_id", DESCENDING),
+        ]).limit(limit + 1).to_list(limit + 1)
+
+        next_cursor = None
+        if len(documents) > limit:
+            documents = documents[:limit]
+            last = documents[-1]
+            next_cursor = encode_cursor([last["created_timestamp"], last["token_reference_id"]])
+        return documents, next_cursor
+
+    async def count_tokens(self, card_identifier: str, statuses: Optional[List[TokenStatus]] = None) -> int:
+        """
+        Token count for a card from the maintained counters (a single _id lookup)
+        """
+        statuses = statuses or VISIBLE_STATUSES
+        counter = await self._reads.do(
+            (card_identifier, "counts"), self._counters(card_identifier).find_one, {"_id": card_identifier}
+        )
+        counts = (counter or {}).get("counts", {})
+        return sum(max(counts.get(status.value, 0), 0) for status in statuses)
+
+
+# Shared repository instance; bound to the database in server.py
+token_repository = TokenRepository()
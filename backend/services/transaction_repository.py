@@ -0,0 +1,368 @@
+"""
+Transaction repository
+MongoDB-backed card transaction history. Pages are keyset ranges over the
+(card_identifier, date desc, id desc) index, so a deep page costs the same
+as the first one. Transactions and counters are partitioned by
+card_identifier (see services/partitioning.py); lookups by transaction id
+scatter to every partition. Per-card spend aggregates are cached and
+updated in place as transactions are inserted.
+
+With TRANSACTION_SNAPSHOT_DIR set, history pages are served from the
+memory-mapped columnar snapshot (services/transaction_snapshot.py) plus a
+MongoDB query for the rows recorded after the snapshot's watermark.
+"""
+
+import asyncio
+import logging
+from datetime import date, datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from services.cache import TTLCache
+from services.config import env_float, env_int, env_str
+from services.mock_data import MOCK_TRANSACTIONS
+from services.pagination import decode_cursor, encode_cursor
+from services.partitioning import Partition, PartitionRouter
+from services.singleflight import SingleFlight
+from services.spend_analytics import SPEND_PROJECTION, SpendSummary
+from services.transaction_snapshot import TransactionSnapshot, current_snapshot_name
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CARD_IDENTIFIER = "default_card"
+
+DUPLICATE_KEY_ERROR = 11000
+
+TRANSACTION_PROJECTION = {
+    "_id": 0,
+    "id": 1,
+    "merchant": 1,
+    "amount": 1,
+    "date": 1,
+    "type": 1,
+    "status": 1,
+    "token_used": 1,
+    "token_reference_id": 1,
+}
+
+
+def normalize_transaction(transaction: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Map a camelCase mock/upstream transaction onto our snake_case fields
+    """
+    return {
+        "id": transaction["id"],
+        "merchant": transaction["merchant"],
+        "amount": transaction["amount"],
+        "date": transaction["date"],
+        "type": transaction["type"],
+        "status": transaction["status"],
+        "token_used": transaction.get("token_used", transaction.get("tokenUsed", False)),
+        "token_reference_id": transaction.get("token_reference_id", transaction.get("tokenReferenceId")),
+    }
+
+
+class TransactionRepository:
+    """
+    Stores transactions in the `transactions` collection and per-card totals
+    in `transaction_counters`
+    """
+
+    def __init__(self, collection_name: str = "transactions", counters_collection_name: str = "transaction_counters"):
+        self.collection_name = collection_name
+        self.counters_collection_name = counters_collection_name
+        self._router: Optional[PartitionRouter] = None
+        # Point lookups by id, including misses (cached as None) so bursts of
+        # receipt deep-links for the same id cost one indexed find_one
+        self._lookup_cache = TTLCache(
+            max_size=env_int("TRANSACTION_LOOKUP_CACHE_SIZE", 10000),
+            ttl=env_float("TRANSACTION_LOOKUP_CACHE_TTL", 60.0),
+            name="transaction_lookup"
+        )
+        # Spend aggregates per card: loaded once from the full history, then
+        # kept current by insert(). The TTL bounds how long inserts made by
+        # other workers go unseen.
+        self._spend_cache = TTLCache(
+            max_size=env_int("SPEND_ANALYTICS_CACHE_SIZE", 1000),
+            ttl=env_float("SPEND_ANALYTICS_CACHE_TTL", 300.0),
+            name="spend_analytics"
+        )
+        self._spend_loads = SingleFlight("spend_analytics")
+        self.spend_chunk_size = env_int("SPEND_ANALYTICS_CHUNK_SIZE", 10000)
+        self.snapshot_dir = env_str("TRANSACTION_SNAPSHOT_DIR")
+        self.snapshot: Optional[TransactionSnapshot] = None
+        self._snapshot_task: Optional[asyncio.Task] = None
+
+    async def init(self, db, router: Optional[PartitionRouter] = None) -> None:
+        """
+        Bind the repository to a database (or to the partitions of `router`),
+        create indexes on each and seed the mock history
+        """
+        self._router = router or PartitionRouter.single(db)
+        for partition in self._router.partitions:
+            await self._create_indexes(partition.db[self.collection_name])
+        self.reload_snapshot()
+
+        if await self._counters(DEFAULT_CARD_IDENTIFIER).find_one({"_id": DEFAULT_CARD_IDENTIFIER}) is None:
+            await self._seed(DEFAULT_CARD_IDENTIFIER, MOCK_TRANSACTIONS)
+            logger.info(f"Seeded {len(MOCK_TRANSACTIONS)} mock transactions for {DEFAULT_CARD_IDENTIFIER}")
+
+    async def _seed(self, card_identifier: str, transactions: Iterable[Dict[str, Any]]) -> None:
+        """
+        Write fixed transactions idempotently: several workers starting on a
+        fresh database may all seed at once, and must all come up
+        """
+        recorded_at = datetime.utcnow()
+        await self._transactions(card_identifier).bulk_write([
+            UpdateOne(
+                {"id": document["id"]},
+                {"$setOnInsert": {**document, "card_identifier": card_identifier, "recorded_at": recorded_at}},
+                upsert=True,
+            )
+            for document in map(normalize_transaction, transactions)
+        ], ordered=False)
+        count = await self._transactions(card_identifier).count_documents({"card_identifier": card_identifier})
+        await self._counters(card_identifier).update_one(
+            {"_id": card_identifier}, {"$max": {"count": count}}, upsert=True
+        )
+
+    async def _create_indexes(self, collection) -> None:
+        await collection.create_index("id", unique=True)
+        await collection.create_index([
+            ("card_identifier", ASCENDING),
+            ("date", DESCENDING),
+            ("id", DESCENDING),
+        ])
+        await collection.create_index([
+            ("card_identifier", ASCENDING),
+            ("merchant", ASCENDING),
+            ("date", DESCENDING),
+            ("id", DESCENDING),
+        ])
+        # Rows recorded after a snapshot's watermark
+        await collection.create_index([("card_identifier", ASCENDING), ("recorded_at", ASCENDING)])
+
+    def reload_snapshot(self) -> bool:
+        """
+        Switch to the snapshot CURRENT now names, if it changed
+        """
+        if self.snapshot_dir is None:
+            return False
+        name = current_snapshot_name(self.snapshot_dir)
+        if name is None or (self.snapshot is not None and self.snapshot.name == name):
+            return False
+        self.snapshot = TransactionSnapshot.open_current(self.snapshot_dir)
+        logger.info(f"Serving transaction history from snapshot {name} ({self.snapshot.row_count} rows)")
+        return True
+
+    def start_snapshot_refresh(self, interval_seconds: float) -> None:
+        """
+        Periodically pick up snapshots written by build_transaction_snapshot.py
+        """
+        if self.snapshot_dir is None or interval_seconds <= 0 or self._snapshot_task is not None:
+            return
+
+        async def _refresh_loop():
+            while True:
+                await asyncio.sleep(interval_seconds)
+                try:
+                    self.reload_snapshot()
+                except Exception as e:
+                    logger.error(f"Transaction snapshot reload failed: {str(e)}")
+
+        self._snapshot_task = asyncio.create_task(_refresh_loop())
+
+    async def stop(self) -> None:
+        if self._snapshot_task is not None:
+            self._snapshot_task.cancel()
+            await asyncio.gather(self._snapshot_task, return_exceptions=True)
+            self._snapshot_task = None
+
+    @property
+    def router(self) -> PartitionRouter:
+        if self._router is None:
+            raise RuntimeError("TransactionRepository has not been initialised")
+        return self._router
+
+    def _transactions(self, card_identifier: str):
+        return self.router.collection(card_identifier, self.collection_name)
+
+    def _counters(self, card_identifier: str):
+        return self.router.collection(card_identifier, self.counters_collection_name)
+
+    async def insert(self, card_identifier: str, transactions: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Store new transactions for a card and bump its counter
+        Transactions whose id is already stored are skipped, so a retried
+        ingestion batch is harmless. Returns the normalized documents that
+        were written.
+        """
+        recorded_at = datetime.utcnow()
+        documents = [
+            {**normalize_transaction(transaction), "card_identifier": card_identifier, "recorded_at": recorded_at}
+            for transaction in transactions
+        ]
+        if not documents:
+            return []
+
+        try:
+            await self._transactions(card_identifier).insert_many(
+                [dict(document) for document in documents], ordered=False
+            )
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(error.get("code") != DUPLICATE_KEY_ERROR for error in errors):
+                raise
+            # Unordered: everything but the duplicates was written
+            duplicates = {error["index"] for error in errors}
+            documents = [document for index, document in enumerate(documents) if index not in duplicates]
+            if not documents:
+                return []
+
+        await self._counters(card_identifier).update_one(
+            {"_id": card_identifier}, {"$inc": {"count": len(documents)}}, upsert=True
+        )
+        for document in documents:
+            self._lookup_cache.invalidate(document["id"])
+
+        summary = self._spend_cache.peek(card_identifier)
+        if summary is not None:
+            summary.add(documents)
+        else:
+            # A load already under way may have read the history before these rows
+            self._spend_cache.invalidate(card_identifier)
+            self._spend_loads.forget(card_identifier)
+        return documents
+
+    async def get(self, transaction_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Single transaction by id via the unique index, or None if it does not exist
+        """
+        return await self._lookup_cache.get_or_load(
+            transaction_id,
+            lambda: self.router.find_one_any(self.collection_name, {"id": transaction_id}, TRANSACTION_PROJECTION)
+        )
+
+    async def rebalance(self, batch_size: int = 500) -> Dict[str, int]:
+        """
+        Move transactions to the partition that now owns their card, then
+        recount the moved cards there and drop the stale counters
+        """
+        async def _on_moved(source: Partition, target: Partition, cards: List[str]) -> None:
+            for card_identifier in cards:
+                count = await target.db[self.collection_name].count_documents({"card_identifier": card_identifier})
+                await target.db[self.counters_collection_name].update_one(
+                    {"_id": card_identifier}, {"$set": {"count": count}}, upsert=True
+                )
+            await source.db[self.counters_collection_name].delete_many({"_id": {"$in": cards}})
+
+        return await self.router.rebalance(
+            self.collection_name, "card_identifier", batch_size=batch_size, on_moved=_on_moved
+        )
+
+    def lookup_cache_stats(self) -> Dict[str, Any]:
+        return self._lookup_cache.stats()
+
+    def spend_cache_stats(self) -> Dict[str, Any]:
+        return self._spend_cache.stats()
+
+    async def spend_summary(self, card_identifier: str) -> SpendSummary:
+        """
+        Spend aggregates for a card; callers must not modify the result
+        """
+        return await self._spend_cache.get_or_load(
+            card_identifier,
+            lambda: self._spend_loads.do(card_identifier, self._load_spend, card_identifier)
+        )
+
+    async def _load_spend(self, card_identifier: str) -> SpendSummary:
+        summary = SpendSummary()
+        cursor = self._transactions(card_identifier).find(
+            {"card_identifier": card_identifier}, SPEND_PROJECTION
+        ).batch_size(self.spend_chunk_size)
+        try:
+            # Aggregate a chunk at a time so the raw history is never held at once
+            while True:
+                chunk = await cursor.to_list(self.spend_chunk_size)
+                if not chunk:
+                    break
+                summary.add(chunk)
+        finally:
+            await cursor.close()
+        return summary
+
+    async def list_transactions(
+        self,
+        card_identifier: str,
+        limit: int = 10,
+        after: Optional[str] = None,
+        date_from: Optional[date] = None,
+        date_to: Optional[date] = None,
+        merchant: Optional[str] = None,
+        token_used: Optional[bool] = None,
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        One page of a card's transactions, newest first
+        Returns (transactions, next_cursor); next_cursor is None on the last page.
+        Raises ValueError for a malformed cursor.
+        """
+        snapshot = self.snapshot
+        last = decode_cursor(after, 2) if after else None
+
+        query: Dict[str, Any] = {"card_identifier": card_identifier}
+        if snapshot is not None:
+            query["recorded_at"] = {"$gt": snapshot.watermark}
+        if merchant:
+            query["merchant"] = merchant
+        if token_used is not None:
+            query["token_used"] = token_used
+        if date_from or date_to:
+            query["date"] = {}
+            if date_from:
+                query["date"]["$gte"] = date_from.isoformat()
+            if date_to:
+                query["date"]["$lte"] = date_to.isoformat()
+        if last:
+            last_date, last_id = last
+            query["$or"] = [
+                {"date": {"$lt": last_date}},
+                {"date": last_date, "id": {"$lt": last_id}},
+            ]
+
+        documents = await self._transactions(card_identifier).find(query, TRANSACTION_PROJECTION).sort([
+            ("date", DESCENDING),
+            ("id", DESCENDING),
+        ]).limit(limit + 1).to_list(limit + 1)
+
+        if snapshot is not None:
+            sealed = snapshot.page(
+                card_identifier,
+                limit + 1,
+                after=tuple(last) if last else None,
+                date_from=date_from.isoformat() if date_from else None,
+                date_to=date_to.isoformat() if date_to else None,
+                merchant=merchant or None,
+                token_used=token_used,
+            )
+            documents = sorted(
+                documents + sealed, key=lambda document: (document["date"], document["id"]), reverse=True
+            )[:limit + 1]
+
+        next_cursor = None
+        if len(documents) > limit:
+            documents = documents[:limit]
+            next_cursor = encode_cursor([documents[-1]["date"], documents[-1]["id"]])
+        return documents, next_cursor
+
+    async def count_transactions(self, card_identifier: str) -> int:
+        """
+        Total transactions on a card from the maintained counter
+        """
+        counter = await self._counters(card_identifier).find_one({"_id": card_identifier})
+        return (counter or {}).get("count", 0)
+
+
+# Shared repository instance; bound to the database in server.py
+transaction_repository = TransactionRepository()
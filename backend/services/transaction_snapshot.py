@@ -0,0 +1,211 @@
+"""
+Columnar transaction snapshot
+A read-only copy of the transaction history laid out as one NumPy array per
+column, sorted by (card, date, id). Card, merchant, type, status and token
+reference columns are dictionary-encoded as int32 codes. Each column is an
+.npy file opened with mmap_mode="r", so opening a snapshot reads nothing
+up front and every worker on the host shares the same page-cache pages.
+
+A card's rows are one contiguous range found by binary search. Date range,
+merchant, token_used and cursor filters are boolean masks over that range,
+and only the rows of the page returned are turned back into dicts.
+
+Snapshots are built offline (build_transaction_snapshot.py) into a new
+directory under the snapshot root; CURRENT names the live one and is
+swapped atomically. A snapshot holds the rows recorded up to its
+`watermark`; rows recorded after that are read from MongoDB.
+"""
+
+import json
+import logging
+import os
+import shutil
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+CURRENT_FILE = "CURRENT"
+MANIFEST_FILE = "manifest.json"
+
+# Dictionary-encoded columns: field name in the document -> column name
+ENCODED_COLUMNS = {
+    "card_identifier": "card",
+    "merchant": "merchant",
+    "type": "type",
+    "status": "status",
+    "token_reference_id": "token_reference_id",
+}
+
+SNAPSHOT_PROJECTION = {
+    "_id": 0, "id": 1, "card_identifier": 1, "merchant": 1, "amount": 1, "date": 1,
+    "type": 1, "status": 1, "token_used": 1, "token_reference_id": 1,
+}
+
+
+def current_snapshot_name(root: str) -> Optional[str]:
+    try:
+        with open(os.path.join(root, CURRENT_FILE)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+class TransactionSnapshot:
+    """
+    An opened, memory-mapped snapshot
+    """
+
+    def __init__(self, directory: str, manifest: Dict[str, Any]):
+        self.directory = directory
+        self.name = os.path.basename(directory)
+        self.watermark = datetime.fromisoformat(manifest["watermark"])
+        self.row_count = manifest["row_count"]
+        self.dictionaries: Dict[str, List[Optional[str]]] = manifest["dictionaries"]
+        self._codes = {
+            column: {value: code for code, value in enumerate(values)}
+            for column, values in self.dictionaries.items()
+        }
+        columns = ["date", "id", "amount", "token_used", *self.dictionaries]
+        self._columns = {
+            column: np.load(os.path.join(directory, f"{column}.npy"), mmap_mode="r")
+            for column in columns
+        }
+
+    @classmethod
+    def open_current(cls, root: str) -> Optional["TransactionSnapshot"]:
+        """
+        Open the snapshot CURRENT points at, or None if there is none yet
+        """
+        name = current_snapshot_name(root)
+        if name is None:
+            return None
+        directory = os.path.join(root, name)
+        with open(os.path.join(directory, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+        return cls(directory, manifest)
+
+    def card_range(self, card_identifier: str) -> Tuple[int, int]:
+        code = self._codes["card"].get(card_identifier)
+        if code is None:
+            return 0, 0
+        cards = self._columns["card"]
+        return int(np.searchsorted(cards, code, side="left")), int(np.searchsorted(cards, code, side="right"))
+
+    def page(
+        self,
+        card_identifier: str,
+        limit: int,
+        after: Optional[Tuple[str, str]] = None,
+        date_from: Optional[str] = None,
+        date_to: Optional[str] = None,
+        merchant: Optional[str] = None,
+        token_used: Optional[bool] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        Up to `limit` of a card's rows, newest first (date desc, id desc),
+        starting after the (date, id) keyset position `after`
+        """
+        lo, hi = self.card_range(card_identifier)
+        if lo == hi:
+            return []
+
+        dates = self._columns["date"][lo:hi]
+        mask = np.ones(hi - lo, dtype=bool)
+        if merchant is not None:
+            code = self._codes["merchant"].get(merchant)
+            if code is None:
+                return []
+            mask &= self._columns["merchant"][lo:hi] == code
+        if date_from is not None:
+            mask &= dates >= date_from
+        if date_to is not None:
+            mask &= dates <= date_to
+        if token_used is not None:
+            mask &= self._columns["token_used"][lo:hi] == token_used
+        if after is not None:
+            last_date, last_id = after
+            mask &= (dates < last_date) | ((dates == last_date) & (self._columns["id"][lo:hi] < last_id))
+
+        # Rows are stored oldest first; the page is the tail of the mask, reversed
+        rows = np.flatnonzero(mask)[::-1][:limit] + lo
+        return [self._row(int(row)) for row in rows]
+
+    def _decode(self, column: str, row: int) -> Optional[str]:
+        # Code -1 is a missing value; as an index it would pick the last entry
+        code = int(self._columns[column][row])
+        return self.dictionaries[column][code] if code >= 0 else None
+
+    def _row(self, row: int) -> Dict[str, Any]:
+        columns = self._columns
+        return {
+            "id": str(columns["id"][row]),
+            "merchant": self._decode("merchant", row),
+            "amount": int(columns["amount"][row]),
+            "date": str(columns["date"][row]),
+            "type": self._decode("type", row),
+            "status": self._decode("status", row),
+            "token_used": bool(columns["token_used"][row]),
+            "token_reference_id": self._decode("token_reference_id", row),
+        }
+
+
+async def build_snapshot(router, collection_name: str, root: str, margin_seconds: float = 60.0,
+                         batch_size: int = 10000, keep: int = 2) -> str:
+    """
+    Write a snapshot of every partition's transactions under `root` and
+    make it CURRENT
+    The watermark sits margin_seconds before the build started, so a write
+    still in flight when the scan passes is left to the MongoDB side rather
+    than lost. Only the newest `keep` snapshots are kept.
+    Returns the new snapshot's directory.
+    """
+    watermark = datetime.utcnow() - timedelta(seconds=margin_seconds)
+    query = {"$or": [{"recorded_at": {"$lte": watermark}}, {"recorded_at": {"$exists": False}}]}
+
+    chunks, batch = [], []
+    async for _, document in router.scan_all(collection_name, query, SNAPSHOT_PROJECTION, batch_size=batch_size):
+        batch.append(document)
+        if len(batch) >= batch_size:
+            chunks.append(pd.DataFrame.from_records(batch))
+            batch = []
+    if batch:
+        chunks.append(pd.DataFrame.from_records(batch))
+    frame = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=list(SNAPSHOT_PROJECTION)[1:])
+
+    columns: Dict[str, np.ndarray] = {
+        "date": frame["date"].astype(str).to_numpy(dtype="U"),
+        "id": frame["id"].astype(str).to_numpy(dtype="U"),
+        "amount": pd.to_numeric(frame["amount"]).to_numpy(dtype=np.int64),
+        "token_used": frame["token_used"].fillna(False).astype(bool).to_numpy(),
+    }
+    dictionaries: Dict[str, List[Optional[str]]] = {}
+    for field, column in ENCODED_COLUMNS.items():
+        # sort=True keeps card codes in card order; None becomes code -1
+        codes, values = pd.factorize(frame[field], sort=True)
+        columns[column] = codes.astype(np.int32)
+        dictionaries[column] = [str(value) for value in values]
+
+    order = np.lexsort((columns["id"], columns["date"], columns["card"]))
+    name = f"snapshot-{watermark.strftime('%Y%m%dT%H%M%S%f')}"
+    directory = os.path.join(root, name)
+    os.makedirs(directory)
+    for column, values in columns.items():
+        np.save(os.path.join(directory, f"{column}.npy"), values[order])
+    with open(os.path.join(directory, MANIFEST_FILE), "w") as f:
+        json.dump({"watermark": watermark.isoformat(), "row_count": len(order), "dictionaries": dictionaries}, f)
+
+    pointer = os.path.join(root, f"{CURRENT_FILE}.tmp")
+    with open(pointer, "w") as f:
+        f.write(name)
+    os.replace(pointer, os.path.join(root, CURRENT_FILE))
+    logger.info(f"Wrote transaction snapshot {name} ({len(order)} rows)")
+
+    # Workers still mapping an older snapshot keep their pages after unlink
+    snapshots = sorted(entry for entry in os.listdir(root) if entry.startswith("snapshot-"))
+    for stale in snapshots[:-keep]:
+        shutil.rmtree(os.path.join(root, stale), ignore_errors=True)
+    return directory
@@ -4,62 +4,297 @@ This service layer mimics Visa TMS API calls for push provisioning.
 Replace this entire service with actual Visa API calls when ready.
 """
 
+import asyncio
+import importlib.util
 import json
+import logging
 import uuid
 from datetime import datetime, timedelta
-from typing import Dict, List, Any
+from typing import Awaitable, Callable, Dict, List, Any, Optional
+
+import httpx
+
+from services.config import env_bool, env_float, env_int, env_str
+from services.metrics import VISA_CALL_SECONDS, timed
+from services.resilience import UpstreamGuards, guarded
+from services.singleflight import SingleFlight
 from services.mock_data import MOCK_VISA_RESPONSES, MERCHANT_APPS
 
+logger = logging.getLogger(__name__)
+
+DEFAULT_BASE_URL = "https://sandbox.api.visa.com/cybersource/tms/v1"
+
 
 class VisaTokenManagementService:
     """
     Mock implementation of Visa Token Management Service
     Based on: https://developer.visaacceptance.com/docs/vas/en-us/tms/developer/ctv/rest/tms/tms-workflows/tms-workflow-push-provisioning.html
+
+    All upstream traffic goes through one pooled, keep-alive httpx.AsyncClient
+    that is opened by start() and closed by close() from the app lifecycle.
+    With VISA_TMS_MOCK enabled (the default) the methods return mock data;
+    otherwise they call VISA_TMS_BASE_URL, which can point at a local stand-in.
     """
     
-    def __init__(self):
-        self.base_url = "https://sandbox.api.visa.com/cybersource/tms/v1"  # Mock URL
-        self.api_key = "mock_api_key"  # Will be replaced with real credentials
+    def __init__(
+        self,
+        base_url: Optional[str] = None,
+        api_key: Optional[str] = None,
+        mock_mode: Optional[bool] = None,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.base_url = base_url or env_str("VISA_TMS_BASE_URL", DEFAULT_BASE_URL)
+        self.api_key = api_key or env_str("VISA_TMS_API_KEY", "mock_api_key")  # Will be replaced with real credentials
+        self.mock_mode = env_bool("VISA_TMS_MOCK", True) if mock_mode is None else mock_mode
+        
+        # Connection pool settings. Every call goes to the same TMS host, so the
+        # pool-wide limits are effectively per-host limits.
+        self.max_connections = env_int("VISA_TMS_MAX_CONNECTIONS", 20)
+        self.max_keepalive_connections = env_int("VISA_TMS_MAX_KEEPALIVE", 10)
+        self.keepalive_expiry = env_float("VISA_TMS_KEEPALIVE_EXPIRY", 30.0)
+        self.connect_timeout = env_float("VISA_TMS_CONNECT_TIMEOUT", 3.0)
+        self.read_timeout = env_float("VISA_TMS_READ_TIMEOUT", 10.0)
+        self.pool_timeout = env_float("VISA_TMS_POOL_TIMEOUT", 5.0)
+        self.http2 = env_bool("VISA_TMS_HTTP2", True)
+        self.warmup_connections = env_int("VISA_TMS_WARMUP_CONNECTIONS", 2)
+        
+        # Push provisioning fan-out: merchants provisioned in parallel and the
+        # overall time budget for a single provisioning request (seconds)
+        self.provisioning_concurrency = env_int("VISA_TMS_PROVISIONING_CONCURRENCY", 8)
+        self.provisioning_deadline = env_float("VISA_TMS_PROVISIONING_DEADLINE", 20.0)
+        
+        # Circuit breaker and adaptive concurrency limit per TMS operation
+        # (VISA_TMS_BREAKER_* / VISA_TMS_LIMIT_* settings)
+        self.guards = UpstreamGuards("VISA_TMS")
+        
+        # Identical concurrent reads share one upstream call
+        self.coalescer = SingleFlight("visa_tms")
+        
+        self._transport = transport
+        self._client: Optional[httpx.AsyncClient] = None
+    
+    async def start(self) -> None:
+        """
+        Open the pooled HTTP client and pre-establish connections to TMS
+        """
+        if self._client is not None:
+            return
+        
+        http2 = self.http2
+        if http2 and importlib.util.find_spec("h2") is None:
+            logger.warning("HTTP/2 requested for Visa TMS but 'h2' is not installed; falling back to HTTP/1.1")
+            http2 = False
+        
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            http2=http2,
+            transport=self._transport,
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(
+                connect=self.connect_timeout,
+                read=self.read_timeout,
+                write=self.read_timeout,
+                pool=self.pool_timeout,
+            ),
+            headers={
+                "Accept": "application/json",
+                "x-api-key": self.api_key,
+            },
+        )
+        
+        if not self.mock_mode:
+            await self.warm_up()
+        
+        logger.info(f"Visa TMS client started (base_url={self.base_url}, mock_mode={self.mock_mode}, http2={http2})")
+    
+    async def warm_up(self) -> None:
+        """
+        Open keep-alive connections ahead of the first real request so the
+        TCP/TLS handshakes are not paid on the provisioning path
+        """
+        client = self._get_client()
+        
+        async def _ping():
+            try:
+                await client.head("/")
+            except httpx.HTTPError as e:
+                logger.warning(f"Visa TMS warm-up request failed: {str(e)}")
+        
+        await asyncio.gather(*(_ping() for _ in range(max(1, self.warmup_connections))))
+    
+    async def close(self) -> None:
+        """
+        Close the pooled HTTP client and release its connections, and the
+        rate limit buckets' files
+        """
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        self.guards.close()
+    
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            raise RuntimeError("VisaTokenManagementService has not been started")
+        return self._client
     
-    async def create_push_provisioning_request(self, card_data: Dict, merchant_apps: List[str]) -> Dict[str, Any]:
+    async def _request(self, method: str, path: str, **kwargs) -> Dict[str, Any]:
         """
-        Mock implementation of Visa TMS Push Provisioning Request
+        Send a request to TMS over the shared connection pool and decode the JSON body
+        """
+        response = await self._get_client().request(method, path, **kwargs)
+        response.raise_for_status()
+        return response.json()
+    
+    @timed(VISA_CALL_SECONDS, "create_push_provisioning_request")
+    async def create_push_provisioning_request(
+        self,
+        card_data: Dict,
+        merchant_apps: List[Dict[str, Any]],
+        deadline: Optional[float] = None,
+        request_id: Optional[str] = None,
+        on_result: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Visa TMS Push Provisioning Request
         POST /pushProvisioning
+
+        Each merchant is provisioned by its own call, run concurrently under
+        provisioning_concurrency. A merchant that raises (including a call
+        shed by the push_provisioning guard) is reported as FAILED and one
+        still running at the overall deadline is cancelled and reported as
+        PENDING, so one slow merchant never fails the whole request. If the
+        push_provisioning circuit is already open, UpstreamUnavailable is
+        raised before any merchant is tried.
+        
+        If given, on_result is awaited with each merchant's result as soon as
+        that merchant finishes (and for PENDING merchants at the deadline).
+        Callbacks run here rather than in the merchant tasks, so the deadline
+        only ever cancels upstream calls: a merchant whose call returned is
+        reported with its result even if its callback is still running.
         """
-        # Simulate API processing time
-        request_id = str(uuid.uuid4())
+        # Reject up front rather than failing every merchant while TMS is down
+        self.guards.check("push_provisioning")
+        
+        request_id = request_id or str(uuid.uuid4())
+        deadline = self.provisioning_deadline if deadline is None else deadline
+        semaphore = asyncio.Semaphore(self.provisioning_concurrency)
+        
+        async def _notify(result: Dict[str, Any]) -> None:
+            if on_result is None:
+                return
+            try:
+                await on_result(result)
+            except Exception as e:
+                logger.error(f"Push provisioning result callback failed: {str(e)}")
+        
+        async def _provision(app: Dict[str, Any]) -> Dict[str, Any]:
+            try:
+                async with semaphore:
+                    return await self._provision_merchant(card_data, app)
+            except Exception as e:
+                logger.error(f"Push provisioning for {app['name']} failed: {str(e)}")
+                return self._unfinished_result(app, "FAILED")
         
-        # Mock response based on Visa TMS structure
-        response = {
+        loop = asyncio.get_running_loop()
+        expires = None if deadline is None else loop.time() + deadline
+        tasks = [asyncio.ensure_future(_provision(app)) for app in merchant_apps]
+        pending = set(tasks)
+        while pending:
+            timeout = None if expires is None else max(0.0, expires - loop.time())
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break
+            for task in done:
+                await _notify(task.result())
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        
+        results = []
+        for app, task in zip(merchant_apps, tasks):
+            if task in pending:
+                logger.warning(f"Push provisioning for {app['name']} did not finish within {deadline}s")
+                result = self._unfinished_result(app, "PENDING")
+                await _notify(result)
+                results.append(result)
+            else:
+                results.append(task.result())
+        
+        succeeded = sum(1 for result in results if result["provisioningResult"] == "SUCCESS")
+        if succeeded == len(results):
+            status = "ACCEPTED"
+        elif succeeded == 0:
+            status = "FAILED"
+        else:
+            status = "PARTIAL"
+        
+        return {
             "requestId": request_id,
-            "status": "ACCEPTED",
+            "status": status,
             "timestamp": datetime.utcnow().isoformat(),
-            "pushProvisioningResults": []
+            "pushProvisioningResults": results
         }
+    
+    @guarded("push_provisioning")
+    @timed(VISA_CALL_SECONDS, "provision_merchant")
+    async def _provision_merchant(self, card_data: Dict, app: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Provision a single merchant token
+        """
+        if not self.mock_mode:
+            return await self._request(
+                "POST", "/pushProvisioning",
+                json={"cardData": card_data, "merchantId": app["merchant_id"], "merchantName": app["name"]}
+            )
         
-        # Create mock token for each merchant app
-        for app_name in merchant_apps:
-            app_data = next((app for app in MERCHANT_APPS if app["name"] == app_name), None)
-            if app_data:
-                token_data = {
-                    "merchantId": app_data["merchant_id"],
-                    "merchantName": app_name,
-                    "tokenReferenceId": f"TKN_{str(uuid.uuid4())[:8].upper()}",
-                    "tokenStatus": "ACTIVE",
-                    "provisioningResult": "SUCCESS",
-                    "tokenExpiryDate": (datetime.utcnow() + timedelta(days=1095)).strftime("%Y%m"),  # 3 years
-                    "createdTimestamp": datetime.utcnow().isoformat(),
-                    "lastUpdatedTimestamp": datetime.utcnow().isoformat()
-                }
-                response["pushProvisioningResults"].append(token_data)
-        
-        return response
+        # Mock token based on Visa TMS structure
+        return {
+            "merchantId": app["merchant_id"],
+            "merchantName": app["name"],
+            "tokenReferenceId": f"TKN_{str(uuid.uuid4())[:8].upper()}",
+            "tokenStatus": "ACTIVE",
+            "provisioningResult": "SUCCESS",
+            "tokenExpiryDate": (datetime.utcnow() + timedelta(days=1095)).strftime("%Y%m"),  # 3 years
+            "createdTimestamp": datetime.utcnow().isoformat(),
+            "lastUpdatedTimestamp": datetime.utcnow().isoformat()
+        }
+    
+    def _unfinished_result(self, app: Dict[str, Any], provisioning_result: str) -> Dict[str, Any]:
+        """
+        Result entry for a merchant whose provisioning failed or hit the deadline
+        """
+        now = datetime.utcnow().isoformat()
+        return {
+            "merchantId": app["merchant_id"],
+            "merchantName": app["name"],
+            "tokenReferenceId": None,
+            "tokenStatus": "INACTIVE",
+            "provisioningResult": provisioning_result,
+            "tokenExpiryDate": None,
+            "createdTimestamp": now,
+            "lastUpdatedTimestamp": now
+        }
     
     async def get_token_status(self, token_reference_id: str) -> Dict[str, Any]:
         """
         Mock implementation of Get Token Status
         GET /tokens/{tokenReferenceId}
+        Concurrent lookups of the same token share one upstream call.
         """
+        return await self.coalescer.do(
+            ("get_token_status", token_reference_id), self._fetch_token_status, token_reference_id
+        )
+    
+    @guarded("get_token_status")
+    @timed(VISA_CALL_SECONDS, "get_token_status")
+    async def _fetch_token_status(self, token_reference_id: str) -> Dict[str, Any]:
+        if not self.mock_mode:
+            return await self._request("GET", f"/tokens/{token_reference_id}")
+        
         # Return mock token status
         return {
             "tokenReferenceId": token_reference_id,
@@ -69,34 +304,83 @@ class VisaTokenManagementService:
             "tokenExpiryDate": (datetime.utcnow() + timedelta(days=1095)).strftime("%Y%m")
         }
     
+    @guarded("update_token_status")
+    @timed(VISA_CALL_SECONDS, "update_token_status")
     async def update_token_status(self, token_reference_id: str, status: str) -> Dict[str, Any]:
         """
         Mock implementation of Update Token Status
         PUT /tokens/{tokenReferenceId}
         """
-        return {
-            "tokenReferenceId": token_reference_id,
-            "tokenStatus": status.upper(),
-            "lastUpdatedTimestamp": datetime.utcnow().isoformat(),
-            "updateResult": "SUCCESS"
-        }
+        try:
+            if not self.mock_mode:
+                return await self._request(
+                    "PUT", f"/tokens/{token_reference_id}",
+                    json={"tokenStatus": status.upper()}
+                )
+            
+            return {
+                "tokenReferenceId": token_reference_id,
+                "tokenStatus": status.upper(),
+                "lastUpdatedTimestamp": datetime.utcnow().isoformat(),
+                "updateResult": "SUCCESS"
+            }
+        finally:
+            # A status lookup still in flight may predate this write
+            self.coalescer.forget(("get_token_status", token_reference_id))
     
+    @guarded("delete_token")
+    @timed(VISA_CALL_SECONDS, "delete_token")
     async def delete_token(self, token_reference_id: str) -> Dict[str, Any]:
         """
         Mock implementation of Delete Token
         DELETE /tokens/{tokenReferenceId}
         """
-        return {
-            "tokenReferenceId": token_reference_id,
-            "deletionResult": "SUCCESS",
-            "deletedTimestamp": datetime.utcnow().isoformat()
-        }
-    
+        try:
+            if not self.mock_mode:
+                return await self._request("DELETE", f"/tokens/{token_reference_id}")
+            
+            return {
+                "tokenReferenceId": token_reference_id,
+                "deletionResult": "SUCCESS",
+                "deletedTimestamp": datetime.utcnow().isoformat()
+            }
+        finally:
+            self.coalescer.forget(("get_token_status", token_reference_id))
+
+    @guarded("renew_token")
+    @timed(VISA_CALL_SECONDS, "renew_token")
+    async def renew_token(self, token_reference_id: str) -> Dict[str, Any]:
+        """
+        Mock implementation of Token Renewal (extends the token's expiry)
+        POST /tokens/{tokenReferenceId}/renew
+        """
+        try:
+            if not self.mock_mode:
+                return await self._request("POST", f"/tokens/{token_reference_id}/renew")
+
+            return {
+                "tokenReferenceId": token_reference_id,
+                "tokenExpiryDate": (datetime.utcnow() + timedelta(days=1095)).strftime("%Y%m"),  # 3 years
+                "lastUpdatedTimestamp": datetime.utcnow().isoformat(),
+                "renewalResult": "SUCCESS"
+            }
+        finally:
+            self.coalescer.forget(("get_token_status", token_reference_id))
+
     async def list_tokens(self, card_identifier: str) -> Dict[str, Any]:
         """
         Mock implementation of List Tokens
         GET /tokens?cardIdentifier={cardIdentifier}
+        Concurrent listings for the same card share one upstream call.
         """
+        return await self.coalescer.do(("list_tokens", card_identifier), self._fetch_tokens, card_identifier)
+    
+    @guarded("list_tokens")
+    @timed(VISA_CALL_SECONDS, "list_tokens")
+    async def _fetch_tokens(self, card_identifier: str) -> Dict[str, Any]:
+        if not self.mock_mode:
+            return await self._request("GET", "/tokens", params={"cardIdentifier": card_identifier})
+        
         # Return mock list of tokens
         mock_tokens = []
         for i, app in enumerate(MERCHANT_APPS[:5]):  # Return first 5 apps with tokens
@@ -114,4 +398,8 @@ class VisaTokenManagementService:
             "tokens": mock_tokens,
             "totalCount": len(mock_tokens),
             "responseTimestamp": datetime.utcnow().isoformat()
-        }
\ No newline at end of file
+        }
+
+
+# Shared service instance used by all routers; started and closed from server.py
+visa_service = VisaTokenManagementService()
@@ -0,0 +1,189 @@
+"""
+Write-behind buffer
+Collects documents in a bounded in-memory queue and writes them with one
+insert_many per batch instead of one insert_one per request. A batch is
+flushed when it reaches max_batch documents or when the oldest document in
+it has waited flush_interval seconds. When the queue is full, add() waits
+up to enqueue_timeout for room (backpressure) and then raises
+BufferFullError, so a stalled database slows and then rejects callers
+rather than growing memory. stop() waits for whatever is still queued and
+then writes any residue itself, including documents from add() calls that
+were still waiting for room.
+"""
+
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional
+
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from services.metrics import registry as metrics_registry, render_samples
+
+logger = logging.getLogger(__name__)
+
+WRITE_BEHIND_DOCUMENTS = metrics_registry.counter(
+    "write_behind_documents_total", "Documents handled by write-behind buffers", ("buffer", "outcome")
+)
+WRITE_BEHIND_BATCHES = metrics_registry.counter(
+    "write_behind_batches_total", "insert_many calls made by write-behind buffers", ("buffer",)
+)
+
+
+class BufferFullError(Exception):
+    """
+    The write-behind queue stayed full for longer than enqueue_timeout
+    """
+
+
+class WriteBehindBuffer:
+    """
+    Batches inserts into one collection
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_batch: int = 500,
+        flush_interval: float = 0.2,
+        max_pending: int = 10000,
+        enqueue_timeout: float = 1.0,
+        max_attempts: int = 3,
+    ):
+        self.name = name
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.enqueue_timeout = enqueue_timeout
+        self.max_attempts = max_attempts
+        self.max_pending = max_pending
+        self.collection = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        metrics_registry.add_collector(self._collect_metrics)
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def start(self, collection) -> None:
+        """
+        Start flushing into `collection`; call from inside the running event loop
+        """
+        if self._task is None:
+            self.collection = collection
+            self._queue = asyncio.Queue(maxsize=self.max_pending)
+            self._closing = False
+            self._task = asyncio.create_task(self._run())
+
+    async def add(self, document: Dict[str, Any]) -> None:
+        """
+        Queue a document for the next batch
+        """
+        if self._closing or self._task is None:
+            raise RuntimeError(f"Write-behind buffer '{self.name}' is not running")
+        try:
+            self._queue.put_nowait(document)
+        except asyncio.QueueFull:
+            try:
+                await asyncio.wait_for(self._queue.put(document), timeout=self.enqueue_timeout)
+            except asyncio.TimeoutError:
+                WRITE_BEHIND_DOCUMENTS.inc(self.name, "rejected")
+                raise BufferFullError(f"Write-behind buffer '{self.name}' is full")
+            if self._task is None:
+                # stop() finished while we waited; nobody reads the queue now
+                await self._flush_residue()
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """
+        Stop accepting documents and wait (up to timeout) for everything
+        queued to be written
+        """
+        if self._task is None:
+            return
+        self._closing = True
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"{self.name}: {self.pending} buffered documents not written within {timeout}s")
+        # The flusher is now idle waiting for a document that will not come
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        await self._flush_residue()
+
+    async def _flush_residue(self) -> None:
+        """
+        Write what is left in the queue once the flusher has stopped
+        """
+        while not self._queue.empty():
+            batch = self._drain(self.max_batch)
+            try:
+                await self._write(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _drain(self, limit: int) -> List[Dict[str, Any]]:
+        batch = []
+        while len(batch) < limit and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.max_batch:
+                batch.extend(self._drain(self.max_batch - len(batch)))
+                remaining = deadline - loop.time()
+                if len(batch) >= self.max_batch or remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self._write(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _write(self, batch: List[Dict[str, Any]]) -> None:
+        """
+        Flush a batch; an unexpected error drops the batch but never the flusher
+        """
+        try:
+            await self._flush(batch)
+        except Exception as e:
+            WRITE_BEHIND_DOCUMENTS.inc(self.name, "dropped", amount=len(batch))
+            logger.error(f"{self.name}: dropping {len(batch)} buffered documents: {str(e)}")
+
+    async def _flush(self, batch: List[Dict[str, Any]]) -> None:
+        if not batch:
+            return
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                await self.collection.insert_many(batch, ordered=False)
+                WRITE_BEHIND_BATCHES.inc(self.name)
+                WRITE_BEHIND_DOCUMENTS.inc(self.name, "written", amount=len(batch))
+                return
+            except BulkWriteError as e:
+                # Unordered: everything but the failed documents was written
+                failed = len(e.details.get("writeErrors", []))
+                WRITE_BEHIND_BATCHES.inc(self.name)
+                WRITE_BEHIND_DOCUMENTS.inc(self.name, "written", amount=len(batch) - failed)
+                WRITE_BEHIND_DOCUMENTS.inc(self.name, "dropped", amount=failed)
+                logger.error(f"{self.name}: {failed} of {len(batch)} buffered documents rejected: {str(e)}")
+                return
+            except PyMongoError as e:
+                if attempt == self.max_attempts:
+                    WRITE_BEHIND_DOCUMENTS.inc(self.name, "dropped", amount=len(batch))
+                    logger.error(f"{self.name}: dropping {len(batch)} buffered documents after {attempt} attempts: {str(e)}")
+                    return
+                logger.warning(f"{self.name}: batch insert failed (attempt {attempt}), retrying: {str(e)}")
+                await asyncio.sleep(0.1 * 2 ** attempt)
+
+    def _collect_metrics(self) -> List[str]:
+        return render_samples("gauge", "write_behind_pending", "Documents waiting in write-behind buffers",
+                              ("buffer",), {(self.name,): self.pending})
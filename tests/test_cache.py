@@ -0,0 +1,88 @@
+import asyncio
+
+from services.cache import TTLCache
+
+
+def _counting_loader(values):
+    calls = []
+
+    async def _load():
+        calls.append(1)
+        await asyncio.sleep(0)
+        return values[len(calls) - 1]
+    return _load, calls
+
+
+def test_fresh_entries_are_served_without_loading():
+    async def scenario():
+        cache = TTLCache(ttl=60.0)
+        load, calls = _counting_loader(["v1", "v2"])
+        values = [await cache.get_or_load("k", load) for _ in range(3)]
+        return values, calls, cache.stats()
+
+    values, calls, stats = asyncio.run(scenario())
+
+    assert values == ["v1"] * 3
+    assert len(calls) == 1
+    assert (stats["hits"], stats["misses"]) == (2, 1)
+
+
+def test_stale_entry_is_served_while_one_background_refresh_runs():
+    async def scenario():
+        cache = TTLCache(ttl=0.0, stale_ttl=60.0)
+        load, calls = _counting_loader(["v1", "v2", "v3"])
+        first = await cache.get_or_load("k", load)
+        stale = [await cache.get_or_load("k", load) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        return first, stale, calls, cache.stats()
+
+    first, stale, calls, stats = asyncio.run(scenario())
+
+    assert first == "v1"
+    assert stale == ["v1"] * 3
+    assert len(calls) == 2
+    assert stats["stale_hits"] == 3
+
+
+def test_refreshed_value_replaces_the_stale_one():
+    async def scenario():
+        cache = TTLCache(ttl=0.05, stale_ttl=60.0)
+        load, _ = _counting_loader(["v1", "v2"])
+        await cache.get_or_load("k", load)
+        await asyncio.sleep(0.06)
+        stale = await cache.get_or_load("k", load)
+        await asyncio.sleep(0.01)
+        return stale, await cache.get_or_load("k", load)
+
+    assert asyncio.run(scenario()) == ("v1", "v2")
+
+
+def test_invalidate_discards_a_load_that_started_before_the_write():
+    async def scenario():
+        cache = TTLCache(ttl=60.0)
+        release = asyncio.Event()
+
+        async def _slow_load():
+            await release.wait()
+            return "before-write"
+
+        read = asyncio.create_task(cache.get_or_load("k", _slow_load))
+        await asyncio.sleep(0)
+        cache.invalidate("k")
+        release.set()
+        return await read, cache.peek("k")
+
+    assert asyncio.run(scenario()) == ("before-write", None)
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = TTLCache(max_size=2, ttl=60.0)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.peek("a") == 1
+    asyncio.run(cache.get_or_load("a", None))
+    cache.set("c", 3)
+
+    assert cache.peek("b") is None
+    assert (cache.peek("a"), cache.peek("c")) == (1, 3)
+    assert cache.evictions == 1
@@ -0,0 +1,139 @@
+import asyncio
+from collections import Counter
+from datetime import datetime
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+from services.expiry_sweeper import TokenExpirySweeper, parse_hours
+from services.resilience import UpstreamUnavailable
+from services.token_repository import token_repository
+from services.visa_service import visa_service
+
+RENEWED_EXPIRY = "209912"
+
+
+async def _setup(db, count: int, **settings) -> TokenExpirySweeper:
+    await token_repository.init(db)
+    expiring = datetime.utcnow().strftime("%Y%m")
+    await db[token_repository.collection_name].insert_many([
+        {"token_reference_id": f"tok{index:03d}", "card_identifier": "card_1",
+         "token_status": "ACTIVE", "token_expiry_date": expiring}
+        for index in range(count)
+    ])
+    sweeper = TokenExpirySweeper()
+    sweeper.rate = 0
+    for name, value in settings.items():
+        setattr(sweeper, name, value)
+    await sweeper.init(db)
+    return sweeper
+
+
+async def _expiries(db):
+    return {
+        token["token_reference_id"]: token
+        async for token in db[token_repository.collection_name].find({}, {"_id": 0})
+    }
+
+
+def test_rejection_keeps_finished_renewals_and_resumes_without_repeating_them(monkeypatch):
+    renewed = Counter()
+    rejected = []
+
+    async def _renew(token_reference_id):
+        if token_reference_id == "tok004" and not rejected:
+            await asyncio.sleep(0.01)
+            rejected.append(token_reference_id)
+            raise UpstreamUnavailable("renew_token", "circuit_open", 5.0)
+        await asyncio.sleep(0.02)
+        renewed[token_reference_id] += 1
+        return {"renewalResult": "SUCCESS", "tokenExpiryDate": RENEWED_EXPIRY}
+
+    monkeypatch.setattr(visa_service, "renew_token", _renew)
+
+    async def scenario():
+        db = AsyncMongoMockClient()["test"]
+        sweeper = await _setup(db, 12, batch_size=10, concurrency=4)
+        stopped = await sweeper.run_once(force=True)
+        stopped = {"positions": dict(stopped["positions"]), "counts": dict(stopped["counts"])}
+        after_stop = dict(renewed)
+        finished = await sweeper.run_once(force=True)
+        return stopped, after_stop, finished, await _expiries(db)
+
+    stopped, after_stop, finished, tokens = asyncio.run(scenario())
+
+    # Every renewal that went through before the rejection is recorded...
+    assert stopped["counts"] == {"renewed": len(after_stop), "flagged": 0}
+    assert all(tokens[token]["token_expiry_date"] == RENEWED_EXPIRY for token in after_stop)
+    # ...and the checkpoint sits before the first token left unhandled
+    assert stopped["positions"]["default"][1] == "tok003"
+    # The resumed sweep renews the rest, and nothing twice
+    assert finished["finished_at"] is not None
+    assert finished["counts"] == {"renewed": 12, "flagged": 0}
+    assert renewed == Counter({f"tok{index:03d}": 1 for index in range(12)})
+
+
+def test_flag_mode_does_not_reflag_tokens(monkeypatch):
+    async def _renew(token_reference_id):
+        raise AssertionError("flag mode must not call Visa TMS")
+
+    monkeypatch.setattr(visa_service, "renew_token", _renew)
+
+    async def scenario():
+        db = AsyncMongoMockClient()["test"]
+        sweeper = await _setup(db, 5, action="flag", batch_size=2)
+        first = dict((await sweeper.run_once(force=True))["counts"])
+        flagged_at = {token: doc["expiry_flag"]["flagged_at"] for token, doc in (await _expiries(db)).items()}
+        second = dict((await sweeper.run_once(force=True))["counts"])
+        flagged_again = {token: doc["expiry_flag"]["flagged_at"] for token, doc in (await _expiries(db)).items()}
+        return first, second, flagged_at, flagged_again
+
+    first, second, flagged_at, flagged_again = asyncio.run(scenario())
+
+    assert first == {"renewed": 0, "flagged": 5}
+    assert second == {"renewed": 0, "flagged": 0}
+    assert flagged_again == flagged_at
+
+
+def test_only_the_lease_holder_sweeps():
+    async def scenario():
+        db = AsyncMongoMockClient()["test"]
+        holder = await _setup(db, 1, action="flag")
+        other = TokenExpirySweeper()
+        await other.init(db)
+        checkpoint = await holder.run_once(force=True)
+        return checkpoint, await other.run_once(force=True)
+
+    checkpoint, blocked = asyncio.run(scenario())
+
+    assert checkpoint["positions"] == {"default": "done"}
+    assert blocked is None
+
+
+@pytest.mark.parametrize("hours, hour, inside", [
+    ("1-5", 3, True), ("1-5", 5, False), ("22-4", 23, True), ("22-4", 2, True), ("22-4", 12, False),
+])
+def test_sweep_hours_may_wrap_midnight(hours, hour, inside):
+    sweeper = TokenExpirySweeper()
+    sweeper.hours = tuple(int(value) for value in hours.split("-"))
+    assert sweeper.in_window(datetime(2024, 1, 1, hour)) is inside
+
+
+@pytest.mark.parametrize("spec, hours", [
+    (None, None), ("", None), ("1-5", (1, 5)), ("22-4", (22, 4)), ("0-24", (0, 24)),
+])
+def test_sweep_hours_parse(spec, hours):
+    assert parse_hours(spec) == hours
+
+
+@pytest.mark.parametrize("spec", ["5", "1-x", "x-5", "-5", "25-3", "24-3", "1-25", "3-3", "1-5-7"])
+def test_invalid_sweep_hours_name_the_setting(spec):
+    with pytest.raises(ValueError, match="TOKEN_EXPIRY_SWEEP_HOURS"):
+        parse_hours(spec)
+
+
+def test_invalid_sweep_hours_fall_back_to_any_time(monkeypatch):
+    monkeypatch.setenv("TOKEN_EXPIRY_SWEEP_HOURS", "5")
+    sweeper = TokenExpirySweeper()
+    assert sweeper.hours is None
+    assert sweeper.in_window(datetime(2024, 1, 1, 12))
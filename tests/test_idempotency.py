@@ -0,0 +1,103 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from mongomock_motor import AsyncMongoMockClient
+
+from services.idempotency import REPLAY_HEADER, STATE_IN_PROGRESS, IdempotencyStore
+
+
+async def _store(db) -> IdempotencyStore:
+    store = IdempotencyStore()
+    store.poll_interval = 0.01
+    await store.init(db)
+    return store
+
+
+def _handler(calls, status_code=200, delay=0.0):
+    async def _handle():
+        calls.append(status_code)
+        await asyncio.sleep(delay)
+        return JSONResponse({"attempt": len(calls)}, status_code=status_code)
+    return _handle
+
+
+def test_retry_replays_the_stored_response():
+    async def scenario():
+        store = await _store(AsyncMongoMockClient()["test"])
+        calls = []
+        first = await store.run("key-1", "fp", _handler(calls))
+        second = await store.run("key-1", "fp", _handler(calls))
+        return calls, first, second
+
+    calls, first, second = asyncio.run(scenario())
+
+    assert calls == [200]
+    assert second.body == first.body
+    assert second.headers[REPLAY_HEADER] == "true"
+
+
+def test_reused_key_with_a_different_request_is_rejected():
+    async def scenario():
+        store = await _store(AsyncMongoMockClient()["test"])
+        await store.run("key-1", "fp-a", _handler([]))
+        await store.run("key-1", "fp-b", _handler([]))
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(scenario())
+    assert error.value.status_code == 422
+
+
+def test_server_error_releases_the_key_for_a_real_retry():
+    async def scenario():
+        store = await _store(AsyncMongoMockClient()["test"])
+        calls = []
+        failed = await store.run("key-1", "fp", _handler(calls, status_code=503))
+        retried = await store.run("key-1", "fp", _handler(calls))
+        return calls, failed, retried
+
+    calls, failed, retried = asyncio.run(scenario())
+
+    assert calls == [503, 200]
+    assert failed.status_code == 503
+    assert retried.status_code == 200
+    assert REPLAY_HEADER not in retried.headers
+
+
+def test_waiter_claims_the_key_when_the_holder_releases_it_after_a_server_error():
+    async def scenario():
+        db = AsyncMongoMockClient()["test"]
+        # Two workers: the retry waits on the other worker's lease
+        holder, waiter = await _store(db), await _store(db)
+        calls = []
+        first = asyncio.create_task(holder.run("key-1", "fp", _handler(calls, status_code=503, delay=0.05)))
+        await asyncio.sleep(0.01)
+        second = await waiter.run("key-1", "fp", _handler(calls))
+        return calls, await first, second
+
+    calls, first, second = asyncio.run(scenario())
+
+    assert calls == [503, 200]
+    assert first.status_code == 503
+    assert second.status_code == 200
+
+
+def test_expired_lease_is_taken_over():
+    async def scenario():
+        db = AsyncMongoMockClient()["test"]
+        store = await _store(db)
+        now = datetime.utcnow()
+        await db[store.collection_name].insert_one({
+            "_id": "key-1", "fingerprint": "fp", "state": STATE_IN_PROGRESS,
+            "created_at": now, "lease_expires_at": now - timedelta(seconds=1),
+        })
+        calls = []
+        response = await store.run("key-1", "fp", _handler(calls))
+        return calls, response
+
+    calls, response = asyncio.run(scenario())
+
+    assert calls == [200]
+    assert response.status_code == 200
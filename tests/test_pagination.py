@@ -0,0 +1,36 @@
+import base64
+import json
+from datetime import datetime
+
+import pytest
+
+from services.pagination import decode_cursor, encode_cursor
+
+
+def _raw_cursor(payload) -> str:
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip("=")
+
+
+def test_cursor_round_trips_strings_numbers_and_datetimes():
+    values = [datetime(2024, 1, 15, 10, 30, 5, 123000), "TKN_0001", 42]
+
+    cursor = encode_cursor(values)
+
+    assert "=" not in cursor
+    assert decode_cursor(cursor, 3) == values
+
+
+@pytest.mark.parametrize("cursor", [
+    "not base64 at all!",
+    _raw_cursor({"date": "2024-01-15"}),
+    _raw_cursor(["2024-01-15"]),
+    _raw_cursor([{"$dt": 20240115}, "TXN_001"]),
+    _raw_cursor([{"$dt": None}, "TXN_001"]),
+    _raw_cursor([{"$dt": "yesterday"}, "TXN_001"]),
+    _raw_cursor([{"$ne": None}, {"$gt": ""}]),
+    _raw_cursor([{"$dt": "2024-01-15T00:00:00", "$ne": None}, "TXN_001"]),
+    _raw_cursor(["2024-01-15", ["TXN_001"]]),
+])
+def test_malformed_cursor_raises_value_error(cursor):
+    with pytest.raises(ValueError, match="Invalid pagination cursor"):
+        decode_cursor(cursor, 2)
@@ -0,0 +1,34 @@
+import asyncio
+
+from mongomock_motor import AsyncMongoMockClient
+
+from services.mock_data import MERCHANT_APPS
+from services.provisioning_jobs import JOB_FAILED, ProvisioningWorkerPool, provisioning_job_store
+from services.visa_service import visa_service
+
+
+def test_stopping_with_work_left_marks_running_and_queued_jobs_failed(monkeypatch):
+    async def _hang(**kwargs):
+        await asyncio.sleep(10)
+
+    monkeypatch.setattr(visa_service, "create_push_provisioning_request", _hang)
+
+    async def scenario():
+        await provisioning_job_store.init(AsyncMongoMockClient()["test"])
+        pool = ProvisioningWorkerPool(workers=1, queue_size=10)
+        pool.start()
+        for request_id in ("job-1", "job-2", "job-3"):
+            await provisioning_job_store.create(request_id, "card_1", MERCHANT_APPS[:1])
+            assert pool.submit(request_id, "card_1", MERCHANT_APPS[:1])
+        await asyncio.sleep(0.01)
+        await pool.stop(drain_timeout=0.05)
+        return {
+            request_id: await provisioning_job_store.get(request_id)
+            for request_id in ("job-1", "job-2", "job-3")
+        }
+
+    jobs = asyncio.run(scenario())
+
+    assert {job["status"] for job in jobs.values()} == {JOB_FAILED}
+    assert jobs["job-1"]["error"] == "provisioning cancelled"
+    assert jobs["job-2"]["error"] == jobs["job-3"]["error"] == "server shutting down"
@@ -0,0 +1,47 @@
+import asyncio
+
+from services.mock_data import MERCHANT_APPS
+from services.visa_service import VisaTokenManagementService
+
+
+def test_slow_result_callback_does_not_turn_finished_merchants_pending():
+    service = VisaTokenManagementService(mock_mode=True)
+    apps = MERCHANT_APPS[:3]
+    notified = []
+
+    async def _slow_callback(result):
+        notified.append(result)
+        await asyncio.sleep(0.2)
+
+    response = asyncio.run(service.create_push_provisioning_request(
+        card_data={}, merchant_apps=apps, deadline=0.05, on_result=_slow_callback
+    ))
+
+    results = response["pushProvisioningResults"]
+    assert response["status"] == "ACCEPTED"
+    assert [result["provisioningResult"] for result in results] == ["SUCCESS"] * len(apps)
+    # Each merchant is reported exactly once, with the token Visa returned
+    assert sorted(result["tokenReferenceId"] for result in notified) == sorted(
+        result["tokenReferenceId"] for result in results
+    )
+
+
+def test_merchant_still_running_at_the_deadline_is_pending():
+    service = VisaTokenManagementService(mock_mode=True)
+    apps = MERCHANT_APPS[:2]
+    notified = []
+
+    async def _hang(card_data, app):
+        await asyncio.sleep(10)
+
+    async def _callback(result):
+        notified.append(result["provisioningResult"])
+
+    service._provision_merchant = _hang
+    response = asyncio.run(service.create_push_provisioning_request(
+        card_data={}, merchant_apps=apps, deadline=0.05, on_result=_callback
+    ))
+
+    assert response["status"] == "FAILED"
+    assert [result["provisioningResult"] for result in response["pushProvisioningResults"]] == ["PENDING"] * 2
+    assert notified == ["PENDING"] * 2
@@ -0,0 +1,129 @@
+import asyncio
+import fcntl
+import os
+import threading
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+from services.rate_limit import LocalBucket, MongoBucket, RateLimiter, SharedFileBucket, gcra, rate_limit_wait
+
+
+def test_gcra_allows_a_burst_then_spaces_calls_by_the_interval():
+    tat, waits = 0.0, []
+    for _ in range(4):
+        wait, tat = gcra(tat, 100.0, 1.0, 3, max_wait=10.0)
+        waits.append(wait)
+
+    assert waits == [0.0, 0.0, 0.0, 1.0]
+    assert tat == 104.0
+
+
+def test_gcra_rejects_without_reserving_when_the_wait_is_too_long():
+    wait, retry_after = gcra(105.0, 100.0, 1.0, 1, max_wait=2.0)
+    assert wait is None
+    assert retry_after == 5.0
+
+
+def test_limiter_fails_fast_unless_the_caller_opts_in_to_waiting():
+    async def scenario():
+        limiter = RateLimiter("test", 50.0, 1, LocalBucket("test", 50.0, 1), max_wait=1.0)
+        granted = await limiter.acquire()
+        rejected = await limiter.acquire()
+        with rate_limit_wait():
+            waited = await limiter.acquire()
+        return granted, rejected, waited, limiter.stats()
+
+    granted, rejected, waited, stats = asyncio.run(scenario())
+
+    assert granted is None and waited is None
+    assert 0 < rejected <= 0.02
+    assert (stats["rejected"], stats["waited"]) == (1, 1)
+
+
+def test_waiters_beyond_the_queue_bound_fail_fast():
+    async def scenario():
+        limiter = RateLimiter("test", 20.0, 1, LocalBucket("test", 20.0, 1), max_wait=5.0, max_queue=2)
+        with rate_limit_wait():
+            results = await asyncio.gather(*(limiter.acquire() for _ in range(4)))
+        return results
+
+    results = asyncio.run(scenario())
+
+    # One immediate grant, two queued, the fourth over the queue bound
+    assert results[:3] == [None, None, None]
+    assert results[3] is not None
+
+
+def test_shm_bucket_is_shared_by_every_handle_on_the_file(tmp_path):
+    path = str(tmp_path / "visa_tms.renew_token.bucket")
+
+    async def scenario():
+        workers = [SharedFileBucket("renew_token", 1.0, 2, path) for _ in range(3)]
+        try:
+            return [(await worker.reserve(0.0))[0] for worker in workers]
+        finally:
+            for worker in workers:
+                worker.close()
+
+    assert asyncio.run(scenario()) == [0.0, 0.0, None]
+
+
+def test_contended_shm_lock_does_not_block_the_event_loop(tmp_path):
+    path = str(tmp_path / "bucket")
+    holder = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    fcntl.flock(holder, fcntl.LOCK_EX)
+    # Let a loop that did block recover, so the test fails instead of hanging
+    safety = threading.Timer(1.0, fcntl.flock, (holder, fcntl.LOCK_UN))
+    safety.start()
+
+    async def scenario():
+        bucket = SharedFileBucket("test", 10.0, 1, path)
+        reserve = asyncio.create_task(bucket.reserve(0.0))
+        ticks = 0
+        for _ in range(5):
+            await asyncio.sleep(0.002)
+            ticks += 1
+        assert not reserve.done()
+        fcntl.flock(holder, fcntl.LOCK_UN)
+        wait, _ = await reserve
+        bucket.close()
+        return ticks, wait, bucket._fd
+
+    try:
+        ticks, wait, fd = asyncio.run(scenario())
+    finally:
+        safety.cancel()
+        os.close(holder)
+
+    assert ticks == 5
+    assert wait == 0.0
+    assert fd is None
+
+
+@pytest.mark.parametrize("backend", ["local", "shm", "mongo"])
+def test_backoff_holds_new_calls_back(backend, tmp_path):
+    async def scenario():
+        if backend == "local":
+            bucket = LocalBucket("test", 100.0, 1)
+        elif backend == "shm":
+            bucket = SharedFileBucket("test", 100.0, 1, str(tmp_path / "bucket"))
+        else:
+            collection = AsyncMongoMockClient()["test"]["rate_limits"]
+            bucket = MongoBucket("test", 100.0, 1, "visa_tms.test", lambda: collection)
+        await bucket.backoff(2.0)
+        return await bucket.reserve(0.5)
+
+    wait, retry_after = asyncio.run(scenario())
+
+    assert wait is None
+    assert 1.5 < retry_after <= 2.0
+
+
+def test_mongo_bucket_state_is_shared_across_hosts():
+    async def scenario():
+        collection = AsyncMongoMockClient()["test"]["rate_limits"]
+        hosts = [MongoBucket("test", 1.0, 2, "visa_tms.test", lambda: collection) for _ in range(3)]
+        return [(await host.reserve(0.0))[0] for host in hosts]
+
+    assert asyncio.run(scenario()) == [0.0, 0.0, None]
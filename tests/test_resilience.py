@@ -0,0 +1,186 @@
+import asyncio
+
+import httpx
+import pytest
+
+from services.rate_limit import LocalBucket, RateLimiter, rate_limit_wait
+from services.resilience import (
+    STATE_CLOSED, STATE_HALF_OPEN, STATE_OPEN, AIMDLimiter, CircuitBreaker, UpstreamGuard, UpstreamUnavailable,
+)
+
+
+def _breaker(**kwargs) -> CircuitBreaker:
+    options = {"window_size": 4, "minimum_calls": 4, "open_seconds": 30.0, "half_open_calls": 2}
+    options.update(kwargs)
+    return CircuitBreaker("test", **options)
+
+
+def _guard(limit: int = 5, rate_limiter=None, max_wait: float = 1.0) -> UpstreamGuard:
+    limiter = AIMDLimiter(initial_limit=limit, min_limit=1, max_limit=limit)
+    return UpstreamGuard("test", _breaker(), limiter, rate_limiter, max_wait=max_wait)
+
+
+async def _ok(value="ok", delay=0.0):
+    await asyncio.sleep(delay)
+    return value
+
+
+def test_breaker_opens_at_the_failure_rate():
+    breaker = _breaker(failure_rate_threshold=0.5)
+    for failed in (False, True, False):
+        breaker.record(failed, 0.01)
+    assert breaker.state == STATE_CLOSED
+
+    breaker.record(True, 0.01)
+
+    assert breaker.state == STATE_OPEN
+    assert not breaker.allow()
+
+
+def test_breaker_opens_on_slow_calls():
+    breaker = _breaker(slow_call_seconds=1.0, slow_call_rate_threshold=0.75)
+    for _ in range(3):
+        breaker.record(False, 2.0)
+    breaker.record(False, 0.1)
+    assert breaker.state == STATE_OPEN
+
+
+def test_half_open_probes_close_or_reopen_the_breaker():
+    breaker = _breaker()
+    breaker._open()
+    breaker.opened_at -= breaker.open_seconds
+
+    assert breaker.allow() and breaker.state == STATE_HALF_OPEN
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record(False, 0.01)
+    breaker.record(False, 0.01)
+    assert breaker.state == STATE_CLOSED
+
+    breaker._open()
+    breaker.opened_at -= breaker.open_seconds
+    assert breaker.allow()
+    breaker.record(True, 0.01)
+    assert breaker.state == STATE_OPEN
+    assert breaker.times_opened == 3
+
+
+def test_aimd_grows_when_busy_and_backs_off_on_failure():
+    limiter = AIMDLimiter(initial_limit=4, min_limit=2, max_limit=5, latency_target=1.0, backoff_ratio=0.5)
+    assert limiter.try_acquire() and limiter.try_acquire()
+    limiter.release(False, 0.1)
+    assert limiter.limit == 5
+    limiter.release(True, 0.1)
+    assert limiter.limit == 2.5
+
+    for _ in range(2):
+        assert limiter.try_acquire()
+    assert not limiter.try_acquire()
+    limiter.release(False, 5.0)
+    assert limiter.limit == 2
+    assert limiter.in_flight == 1
+
+
+def test_aimd_acquire_waits_for_a_released_slot():
+    async def scenario():
+        limiter = AIMDLimiter(initial_limit=1, min_limit=1, max_limit=1)
+        assert limiter.try_acquire()
+        waiter = asyncio.create_task(limiter.acquire(1.0))
+        await asyncio.sleep(0.01)
+        assert not limiter.try_acquire()
+        limiter.release(False, 0.01)
+        granted = await waiter
+        timed_out = await limiter.acquire(0.01)
+        return granted, timed_out, limiter.stats()
+
+    granted, timed_out, stats = asyncio.run(scenario())
+
+    assert granted is True
+    assert timed_out is False
+    assert stats == {"limit": 1, "in_flight": 1, "waiting": 0}
+
+
+def test_concurrency_rejection_does_not_spend_a_rate_limit_token():
+    async def scenario():
+        rate_limiter = RateLimiter("test", 1.0, 1, LocalBucket("test", 1.0, 1), max_wait=0.0)
+        guard = _guard(limit=1, rate_limiter=rate_limiter)
+        slow = asyncio.create_task(guard.call(_ok, delay=0.05))
+        await asyncio.sleep(0.01)
+        with pytest.raises(UpstreamUnavailable) as error:
+            await guard.call(_ok)
+        assert error.value.reason == "concurrency_limit"
+        await slow
+        return rate_limiter.stats()
+
+    stats = asyncio.run(scenario())
+
+    # Only the first call took the single token
+    assert stats["rejected"] == 0
+
+
+def test_rate_limit_rejection_gives_the_slot_back():
+    async def scenario():
+        rate_limiter = RateLimiter("test", 1.0, 1, LocalBucket("test", 1.0, 1), max_wait=0.0)
+        guard = _guard(limit=1, rate_limiter=rate_limiter)
+        await guard.call(_ok)
+        with pytest.raises(UpstreamUnavailable) as error:
+            await guard.call(_ok)
+        return error.value.reason, guard.limiter.in_flight
+
+    assert asyncio.run(scenario()) == ("rate_limited", 0)
+
+
+def test_waiting_callers_queue_for_a_slot_instead_of_being_shed():
+    async def scenario():
+        guard = _guard(limit=1)
+        with rate_limit_wait():
+            return await asyncio.gather(*(guard.call(_ok, index, 0.01) for index in range(4))), guard.rejected
+
+    results, rejected = asyncio.run(scenario())
+
+    assert results == [0, 1, 2, 3]
+    assert rejected == 0
+
+
+def test_upstream_429_backs_the_rate_limit_off():
+    async def scenario():
+        rate_limiter = RateLimiter("test", 100.0, 1, LocalBucket("test", 100.0, 1), max_wait=0.0)
+        guard = _guard(rate_limiter=rate_limiter)
+
+        async def _throttled():
+            request = httpx.Request("GET", "https://tms.example/tokens")
+            response = httpx.Response(429, headers={"Retry-After": "2"}, request=request)
+            raise httpx.HTTPStatusError("throttled", request=request, response=response)
+
+        with pytest.raises(httpx.HTTPStatusError):
+            await guard.call(_throttled)
+        with pytest.raises(UpstreamUnavailable) as error:
+            await guard.call(_ok)
+        return error.value
+
+    error = asyncio.run(scenario())
+
+    assert error.reason == "rate_limited"
+    assert error.retry_after > 1.5
+
+
+def test_cancelled_half_open_probe_does_not_close_the_breaker():
+    async def _never_answers():
+        await asyncio.sleep(10)
+
+    async def scenario():
+        guard = _guard()
+        guard.breaker.half_open_calls = 1
+        guard.breaker._open()
+        guard.breaker.opened_at -= guard.breaker.open_seconds
+        probe = asyncio.create_task(guard.call(_never_answers))
+        await asyncio.sleep(0.01)
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        state = guard.breaker.state
+        # The probe slot is handed back, so a real probe can still decide
+        await guard.call(_ok)
+        return state, guard.breaker.state, guard.limiter.in_flight
+
+    assert asyncio.run(scenario()) == (STATE_HALF_OPEN, STATE_CLOSED, 0)
@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+from services.singleflight import SingleFlight
+
+
+def test_concurrent_calls_with_the_same_key_share_one_call():
+    calls = []
+
+    async def _load(key):
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        return {"key": key}
+
+    async def scenario():
+        flight = SingleFlight("test")
+        results = await asyncio.gather(*(flight.do("a", _load, "a") for _ in range(5)), flight.do("b", _load, "b"))
+        return results, flight.stats()
+
+    results, stats = asyncio.run(scenario())
+
+    assert sorted(calls) == ["a", "b"]
+    assert results[0] is results[4]
+    assert stats == {"name": "test", "in_flight": 0, "started": 2, "coalesced": 4}
+
+
+def test_failure_is_shared_and_the_next_call_starts_afresh():
+    attempts = []
+
+    async def _flaky():
+        attempts.append(1)
+        await asyncio.sleep(0.01)
+        if len(attempts) == 1:
+            raise RuntimeError("upstream down")
+        return "ok"
+
+    async def scenario():
+        flight = SingleFlight("test")
+        first = await asyncio.gather(flight.do("a", _flaky), flight.do("a", _flaky), return_exceptions=True)
+        return first, await flight.do("a", _flaky)
+
+    first, retried = asyncio.run(scenario())
+
+    assert [type(result) for result in first] == [RuntimeError, RuntimeError]
+    assert retried == "ok"
+    assert len(attempts) == 2
+
+
+def test_cancelled_caller_does_not_cancel_the_shared_call():
+    async def _load():
+        await asyncio.sleep(0.02)
+        return "ok"
+
+    async def scenario():
+        flight = SingleFlight("test")
+        leaving = asyncio.create_task(flight.do("a", _load))
+        staying = asyncio.create_task(flight.do("a", _load))
+        await asyncio.sleep(0.005)
+        leaving.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leaving
+        return await staying
+
+    assert asyncio.run(scenario()) == "ok"
+
+
+def test_forget_stops_sharing_a_call_that_may_miss_a_write():
+    calls = []
+
+    async def _load(label):
+        calls.append(label)
+        await asyncio.sleep(0.01)
+        return label
+
+    async def scenario():
+        flight = SingleFlight("test")
+        before = asyncio.create_task(flight.do("a", _load, "before"))
+        await asyncio.sleep(0)
+        flight.forget("a")
+        after = await flight.do("a", _load, "after")
+        return await before, after
+
+    assert asyncio.run(scenario()) == ("before", "after")
+    assert calls == ["before", "after"]
@@ -0,0 +1,31 @@
+import asyncio
+import json
+
+import httpx
+from mongomock_motor import AsyncMongoMockClient
+
+from models.token_models import TokenBatchItem, TokenBatchRequest, TokenStatus
+from routes.tokens import batch_update_tokens, token_status_cache
+from services.token_repository import token_repository
+from services.visa_service import visa_service
+
+
+def test_failed_batch_update_still_drops_the_cached_status(monkeypatch):
+    async def _timeout(token_reference_id, status):
+        raise httpx.ReadTimeout("no answer from Visa TMS")
+
+    monkeypatch.setattr(visa_service, "update_token_status", _timeout)
+
+    async def scenario():
+        await token_repository.init(AsyncMongoMockClient()["test"])
+        token_status_cache.set("TKN_1", {"tokenStatus": "ACTIVE"})
+        response = await batch_update_tokens(TokenBatchRequest(
+            updates=[TokenBatchItem(token_reference_id="TKN_1", token_status=TokenStatus.SUSPENDED)]
+        ))
+        return json.loads(response.body)
+
+    body = asyncio.run(scenario())
+
+    assert body["failure_count"] == 1
+    # The upstream may have applied the change before timing out
+    assert token_status_cache.peek("TKN_1") is None
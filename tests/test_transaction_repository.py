@@ -0,0 +1,57 @@
+import asyncio
+
+from mongomock_motor import AsyncMongoMockClient
+
+from services.mock_data import MOCK_TRANSACTIONS
+from services.transaction_repository import DEFAULT_CARD_IDENTIFIER, TransactionRepository
+
+
+def test_seeding_tolerates_a_worker_that_seeded_first():
+    async def scenario():
+        db = AsyncMongoMockClient()["test"]
+        first = TransactionRepository()
+        await first.init(db)
+        # Another worker saw no counter yet, as if it checked before `first` wrote it
+        await db["transaction_counters"].delete_many({})
+        second = TransactionRepository()
+        await second.init(db)
+        return (
+            await db["transactions"].count_documents({}),
+            await db["transaction_counters"].find_one({"_id": DEFAULT_CARD_IDENTIFIER}),
+            await second.count_transactions(DEFAULT_CARD_IDENTIFIER),
+        )
+
+    documents, counter, counted = asyncio.run(scenario())
+
+    assert documents == len(MOCK_TRANSACTIONS)
+    assert counter["count"] == len(MOCK_TRANSACTIONS)
+    assert counted == len(MOCK_TRANSACTIONS)
+
+
+def test_insert_updates_the_cached_spend_summary_without_reloading(monkeypatch):
+    new_transaction = {
+        "id": "txn_new_1", "merchant": "Corner Shop", "amount": 1234,
+        "date": "2030-01-15", "type": "purchase", "status": "completed",
+    }
+
+    async def scenario():
+        repository = TransactionRepository()
+        await repository.init(AsyncMongoMockClient()["test"])
+        before = (await repository.spend_summary(DEFAULT_CARD_IDENTIFIER)).to_dict()
+
+        async def _no_reload(card_identifier):
+            raise AssertionError("spend summary recomputed from the full history")
+
+        monkeypatch.setattr(repository, "_load_spend", _no_reload)
+        recorded = await repository.insert(DEFAULT_CARD_IDENTIFIER, [new_transaction, MOCK_TRANSACTIONS[0]])
+        after = (await repository.spend_summary(DEFAULT_CARD_IDENTIFIER)).to_dict()
+        return before, recorded, after, await repository.count_transactions(DEFAULT_CARD_IDENTIFIER)
+
+    before, recorded, after, counted = asyncio.run(scenario())
+
+    # The mock transaction is already stored and is skipped
+    assert [document["id"] for document in recorded] == ["txn_new_1"]
+    assert counted == len(MOCK_TRANSACTIONS) + 1
+    assert after["total_amount"] == before["total_amount"] + 1234
+    assert after["transaction_count"] == before["transaction_count"] + 1
+    assert {"key": "Corner Shop", "total_amount": 1234, "transaction_count": 1} in after["by_merchant"]
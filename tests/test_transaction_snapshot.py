@@ -0,0 +1,70 @@
+import asyncio
+
+from mongomock_motor import AsyncMongoMockClient
+
+from models.token_models import TransactionListResponse
+from routes import cards
+from services.partitioning import PartitionRouter
+from services.transaction_repository import TransactionRepository
+from services.transaction_snapshot import TransactionSnapshot, build_snapshot
+
+ROWS = [
+    {"id": "TXN_001", "merchant": "Zepto", "amount": 300, "date": "2024-01-12", "type": "grocery",
+     "status": "completed", "token_used": True, "token_reference_id": "TKN_ZEPTO_001"},
+    {"id": "TXN_002", "merchant": None, "amount": 120, "date": "2024-01-13", "type": None,
+     "status": None, "token_used": False, "token_reference_id": None},
+    {"id": "TXN_003", "merchant": "Amazon", "amount": 250, "date": "2024-01-14", "type": "shopping",
+     "status": "pending", "token_used": False, "token_reference_id": None},
+]
+
+
+def _build(tmp_path, rows):
+    async def scenario():
+        db = AsyncMongoMockClient()["test"]
+        await db["transactions"].insert_many([{**row, "card_identifier": "card_1"} for row in rows])
+        await build_snapshot(PartitionRouter.single(db), "transactions", str(tmp_path), margin_seconds=0)
+    asyncio.run(scenario())
+    return TransactionSnapshot.open_current(str(tmp_path))
+
+
+def test_rows_round_trip_including_missing_values(tmp_path):
+    snapshot = _build(tmp_path, ROWS)
+
+    page = snapshot.page("card_1", limit=10)
+
+    assert snapshot.row_count == len(ROWS)
+    assert page == list(reversed(ROWS))
+
+
+def test_pages_follow_the_keyset_and_filters(tmp_path):
+    snapshot = _build(tmp_path, ROWS)
+
+    first = snapshot.page("card_1", limit=2)
+    rest = snapshot.page("card_1", limit=2, after=(first[-1]["date"], first[-1]["id"]))
+
+    assert [row["id"] for row in first + rest] == ["TXN_003", "TXN_002", "TXN_001"]
+    assert [row["id"] for row in snapshot.page("card_1", 10, merchant="Zepto")] == ["TXN_001"]
+    assert [row["id"] for row in snapshot.page("card_1", 10, token_used=False, date_to="2024-01-13")] == ["TXN_002"]
+    assert snapshot.page("card_1", 10, merchant="Uber") == []
+    assert snapshot.page("card_2", 10) == []
+
+
+def test_missing_values_survive_the_history_route(tmp_path, monkeypatch):
+    async def scenario():
+        db = AsyncMongoMockClient()["test"]
+        await db["transactions"].insert_many([{**row, "card_identifier": "card_1"} for row in ROWS])
+        await build_snapshot(PartitionRouter.single(db), "transactions", str(tmp_path), margin_seconds=0)
+        await db["transactions"].delete_many({})
+        repository = TransactionRepository()
+        repository.snapshot_dir = str(tmp_path)
+        await repository.init(db)
+        monkeypatch.setattr(cards, "transaction_repository", repository)
+        return await cards.get_transaction_history(card_identifier="card_1", limit=10, after=None,
+                                                   date_from=None, date_to=None, merchant=None, token_used=None)
+
+    response = asyncio.run(scenario())
+
+    body = TransactionListResponse.model_validate_json(response.body)
+    missing = next(transaction for transaction in body.transactions if transaction.id == "TXN_002")
+    assert len(body.transactions) == len(ROWS)
+    assert (missing.merchant, missing.type, missing.status) == (None, None, None)
@@ -0,0 +1,53 @@
+import asyncio
+
+from services.write_behind import WriteBehindBuffer
+
+
+class _Collection:
+    def __init__(self, failures=(), stall_first=False):
+        self.failures = list(failures)
+        self.stall_first = stall_first
+        self.written = []
+
+    async def insert_many(self, documents, ordered=True):
+        if self.stall_first:
+            self.stall_first = False
+            await asyncio.sleep(10)
+        if self.failures:
+            raise self.failures.pop(0)
+        self.written.extend(doc["n"] for doc in documents)
+
+
+def test_unexpected_flush_error_drops_the_batch_but_keeps_the_flusher():
+    collection = _Collection(failures=[TypeError("boom")])
+
+    async def scenario():
+        buffer = WriteBehindBuffer("test", flush_interval=0.01)
+        buffer.start(collection)
+        await buffer.add({"n": 1})
+        await asyncio.sleep(0.05)
+        await buffer.add({"n": 2})
+        await buffer.stop(timeout=1)
+
+    asyncio.run(scenario())
+
+    assert collection.written == [2]
+
+
+def test_add_waiting_for_room_during_stop_is_still_written():
+    collection = _Collection(stall_first=True)
+
+    async def scenario():
+        buffer = WriteBehindBuffer("test", flush_interval=0.01, max_pending=1, enqueue_timeout=1)
+        buffer.start(collection)
+        await buffer.add({"n": 1})
+        await asyncio.sleep(0.01)  # the flusher is now stuck writing 1
+        await buffer.add({"n": 2})
+        late = asyncio.create_task(buffer.add({"n": 3}))
+        await asyncio.sleep(0.01)
+        await buffer.stop(timeout=0.05)
+        await late
+
+    asyncio.run(scenario())
+
+    assert sorted(collection.written) == [2, 3]